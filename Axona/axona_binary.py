@@ -0,0 +1,232 @@
+"""
+Python replacement for the C++ AxonaBinary converter.
+
+Converts a raw Axona .bin file into a _shuff.bin file, per tetrode
+recording.dat files for spike sorting, and a .inp file of the digital
+inputs and outputs, in one blocked pass over the raw data.
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import numpy as np
+
+from raw_axona_loading import init_info, memmap_packets, decode_packets
+
+
+def get_inp_changes(packets, last_values):
+    """
+    Find the packets where the digital input or output changed.
+
+    Parameters
+    ----------
+    packets : np.ndarray
+        A block of raw packets.
+    last_values : list of int
+        The [input, output] values of the packet before the block,
+        -1 before the first block. Updated in place.
+
+    Returns
+    -------
+    np.ndarray
+        .inp records as an array of (packet index in block, type, value).
+
+    """
+    records = []
+    for i, (char, field) in enumerate(
+            ((b"I", "digital_in"), (b"O", "digital_out"))):
+        values = packets[field].astype(np.int64)
+        previous = np.concatenate(([last_values[i]], values[:-1]))
+        changed = np.flatnonzero(values != previous)
+        block = np.zeros(len(changed), dtype=[
+            ("packet", np.int64), ("type", "S1"), ("value", np.int64)])
+        block["packet"] = changed
+        block["type"] = char
+        block["value"] = values[changed]
+        records.append(block)
+        if len(values):
+            last_values[i] = int(values[-1])
+    records = np.concatenate(records)
+    # Within a packet the C++ writes the input change before the output
+    return records[np.argsort(records["packet"], kind="stable")]
+
+
+def write_inp(out_location, records, timebase=16000):
+    """Write .inp records in the same format as AxonaBinary."""
+    out = np.zeros(len(records), dtype=[
+        ("timestamp", ">u4"), ("type", "S1"), ("value", ">u2")])
+    out["timestamp"] = records["packet"]
+    out["type"] = records["type"]
+    out["value"] = records["value"]
+    with open(out_location, "wb") as f:
+        f.write("bytes_per_sample {}\n".format(out.dtype.itemsize).encode())
+        f.write("timebase {}\n".format(timebase).encode())
+        f.write("num_inp_samples {}\n".format(len(out)).encode())
+        f.write(b"data_start")
+        out.tofile(f)
+        f.write(b"data_end")
+
+
+def _decode_block(packets, channels, info, start, stop):
+    """Decode one block in the pool, (channels x samples) and inp info."""
+    block = packets[start:stop]
+    return start, decode_packets(block, channels, info), block
+
+
+def convert_axona_binary(
+        set_location, chans_per_tetrode=4, transpose=True, do_split=True,
+        split_transpose=True, out_split_dir="results_klusta",
+        tetrodes=None, write_shuff=True, do_inp=True,
+        block_packets=160000, workers=None, verbose=True):
+    """
+    Convert a raw Axona .bin file, replacing the AxonaBinary executable.
+
+    The .bin next to set_location is decoded in blocks of packets in a
+    thread pool, and each block is written to every output in one pass,
+    so memory use is bounded by the block size and the number of workers.
+
+    Parameters
+    ----------
+    set_location : str
+        The path to the .set file, the .bin must be next to it.
+    chans_per_tetrode : int, optional. Defaults to 4.
+        The channels to keep from each tetrode in the split files,
+        use 3 to drop the last channel when it is an EEG channel.
+    transpose : bool, optional. Defaults to True.
+        Write _shuff.bin as (samples x 64) instead of (64 x samples).
+    do_split : bool, optional. Defaults to True.
+        Write out_split_dir/tetrode/recording.dat for each tetrode,
+        where tetrode is 0-indexed.
+    split_transpose : bool, optional. Defaults to True.
+        Write the split files as (samples x channels). As in AxonaBinary,
+        this is always the case when transpose is True.
+    out_split_dir : str, optional. Defaults to "results_klusta".
+        The folder for the split files, relative to the .set file.
+    tetrodes : list of int, optional. Defaults to None.
+        The 1-indexed tetrodes to split out, None or [] for all 16.
+    write_shuff : bool, optional. Defaults to True.
+        Whether to write the _shuff.bin file with all 64 channels.
+        If False only the requested tetrode channels are decoded.
+    do_inp : bool, optional. Defaults to True.
+        Whether to write the .inp file of digital inputs and outputs.
+    block_packets : int, optional. Defaults to 160000.
+        The packets per block, 160000 is 10 seconds.
+    workers : int, optional. Defaults to None.
+        The decoding threads, None for the CPU count.
+    verbose : bool, optional. Defaults to True.
+        Whether to print the progress.
+
+    Returns
+    -------
+    dict
+        The paths written, keyed by "shuff", "inp" and tetrode number.
+
+    """
+    info = init_info()
+    base_name = os.path.splitext(set_location)[0]
+    bin_location = base_name + ".bin"
+    packets = memmap_packets(bin_location, info)
+    total_samples = info["samples_per_chunk"] * len(packets)
+    if not tetrodes:
+        tetrodes = [i + 1 for i in range(info["num_channels"] // 4)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    split_transpose = split_transpose or transpose
+
+    # The decoded rows and the outputs each is written to
+    if write_shuff:
+        channels = [i for i in range(info["num_channels"])]
+    else:
+        channels = sorted(
+            4 * (t - 1) + i for t in tetrodes
+            for i in range(chans_per_tetrode))
+    row_of = {c: i for i, c in enumerate(channels)}
+    decode_channels = [c + 1 for c in channels]
+
+    outputs = {}
+    if write_shuff:
+        outputs["shuff"] = {
+            "path": base_name + "_shuff.bin",
+            "rows": list(range(len(channels))),
+            "transpose": transpose}
+    if do_split:
+        split_dir = os.path.join(os.path.dirname(base_name), out_split_dir)
+        for t in tetrodes:
+            rows = [
+                row_of[4 * (t - 1) + i] for i in range(chans_per_tetrode)]
+            path = os.path.join(split_dir, str(t - 1), "recording.dat")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            outputs[t] = {
+                "path": path, "rows": rows, "transpose": split_transpose}
+
+    # Time major files are appended, channel major files are memory mapped
+    handles = {}
+    for key, output in outputs.items():
+        if output["transpose"]:
+            handles[key] = open(output["path"], "wb")
+        elif total_samples == 0:
+            open(output["path"], "wb").close()
+            handles[key] = None
+        else:
+            handles[key] = np.memmap(
+                output["path"], dtype=np.int16, mode="w+",
+                shape=(len(output["rows"]), total_samples))
+
+    start_time = time()
+    inp_records = []
+    last_values = [-1, -1]
+    samples_per_chunk = info["samples_per_chunk"]
+
+    def write_block(start, block, raw_block):
+        sample_start = samples_per_chunk * start
+        sample_end = sample_start + block.shape[1]
+        for key, output in outputs.items():
+            rows = block[output["rows"]]
+            if output["transpose"]:
+                np.ascontiguousarray(rows.T).tofile(handles[key])
+            else:
+                handles[key][:, sample_start:sample_end] = rows
+        if do_inp:
+            changes = get_inp_changes(raw_block, last_values)
+            changes["packet"] += start
+            inp_records.append(changes)
+        if verbose:
+            print("Converted {:.1f} of {:.1f} seconds".format(
+                sample_end / info["sample_rate"],
+                total_samples / info["sample_rate"]))
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for start in range(0, len(packets), block_packets):
+                pending.append(pool.submit(
+                    _decode_block, packets, decode_channels, info,
+                    start, start + block_packets))
+                if len(pending) >= 2 * workers:
+                    write_block(*pending.popleft().result())
+            while pending:
+                write_block(*pending.popleft().result())
+    finally:
+        for handle in handles.values():
+            if isinstance(handle, np.memmap):
+                handle.flush()
+            elif handle is not None:
+                handle.close()
+
+    written = {key: output["path"] for key, output in outputs.items()}
+    if do_inp:
+        written["inp"] = base_name + ".inp"
+        write_inp(
+            written["inp"],
+            np.concatenate(inp_records) if inp_records else
+            get_inp_changes(packets[:0], last_values))
+    if verbose:
+        print("Converted {} in {:.2f} seconds".format(
+            bin_location, time() - start_time))
+    return written
+
+
+if __name__ == "__main__":
+    set_location = r"G:\Ham\A10_CAR-SA2\CAR-SA2_20200109_PreBox\CAR-SA2_2020-01-09_PreBox.set"
+    convert_axona_binary(set_location, chans_per_tetrode=3)
@@ -20,60 +20,146 @@ def parse_header(file):
     return out_dict
 
 
+def get_inp_dtype():
+    """The numpy dtype of one 7 byte record in an Axona .inp file."""
+    return np.dtype([
+        ("timestamp", ">u4"),
+        ("type", "S1"),
+        ("status", "u1", (2,))])
+
+
 def info_from_chunk(chunk, timebase):
     """Extract the info from a 7 byte chunk."""
-    time_val = (
-        16777216 * chunk[0] +
-        65536 * chunk[1] +
-        256 * chunk[2] +
-        chunk[3]) / timebase
+    record = np.frombuffer(chunk, dtype=get_inp_dtype(), count=1)[0]
+    time_val = float(record["timestamp"]) / timebase
+    input_type = record["type"].decode("latin-1")
+    channels = record["status"].copy()
+    return time_val, input_type, channels
 
-    input_type = chr(chunk[4])
 
-    channels = np.zeros(2, np.uint8)
-    channels[0] = chunk[5]
-    channels[1] = chunk[6]
-    return time_val, input_type, channels
+def get_channel_bits(inp):
+    """
+    Unpack the status bytes of every record at once.
+
+    Parameters
+    ----------
+    inp : np.ndarray
+        The uint8 status bytes, 2 per record, as from read_axona_inp.
+
+    Returns
+    -------
+    np.ndarray
+        (records x 16) uint8 array, column i is channel i + 1.
+
+    """
+    return np.unpackbits(inp.reshape(-1, 2), axis=1)[:, ::-1]
 
 
 def info_to_file(time, char, inp, out_loc, inp_types=["I", "O"]):
     """Output the input file information to csv."""
+    header = "Time,Type"
+    for i in range(16):
+        header = "{},Ch{}".format(header, i + 1)
+    keep = np.isin(char, inp_types)
+    bits = get_channel_bits(inp)[keep]
+
+    # Each row of bits becomes the 32 characters ",b,b,...,b"
+    bit_chars = np.full((len(bits), 32), ord(","), np.uint8)
+    bit_chars[:, 1::2] = bits + ord("0")
+    bit_strs = bit_chars.view("S32").ravel().astype("U32")
+    rows = np.char.add(
+        np.char.add(np.char.mod("%2f,", time[keep]), char[keep]),
+        bit_strs)
     with open(out_loc, "w") as file:
-        header = "Time,Type"
-        for i in range(16):
-            header = "{},Ch{}".format(header, i + 1)
         file.write(header + "\n")
-        for (i, (t, c)) in enumerate(zip(time, char)):
-            if c in inp_types:
-                out_str = "{:2f},{}".format(t, c)
-                b_a = np.unpackbits(inp[2 * i:2 * i + 2])[::-1]
-                for bit in b_a:
-                    out_str = "{},{}".format(out_str, bit)
-                file.write(out_str + "\n")
+        if len(rows):
+            file.write("\n".join(rows) + "\n")
+
+
+def info_to_npz(time, char, inp, out_loc, inp_types=["I", "O"]):
+    """Output the input file information to a compressed npz."""
+    keep = np.isin(char, inp_types)
+    np.savez_compressed(
+        out_loc, time=time[keep], type=char[keep],
+        channels=get_channel_bits(inp)[keep])
+
+
+def get_channel_edges(time, char, inp, inp_type="I", initial=0):
+    """
+    Get the times each channel of one input type switched on or off.
+
+    Parameters
+    ----------
+    time, char, inp : np.ndarray
+        The output of read_axona_inp.
+    inp_type : str, optional. Defaults to "I".
+        The record type to use, "I" for inputs and "O" for outputs.
+    initial : int or None, optional. Defaults to 0.
+        The state of every channel before the first record.
+        If None, the first record only sets the state.
+
+    Returns
+    -------
+    dict
+        channel number (1 to 16) to a tuple of the
+        (rising, falling) edge times in seconds.
+
+    """
+    keep = char == inp_type
+    times = time[keep]
+    bits = get_channel_bits(inp)[keep].astype(bool)
+    if initial is not None and len(bits):
+        first = np.full((1, bits.shape[1]), bool(initial))
+        bits = np.concatenate((first, bits))
+    else:
+        times = times[1:]
+    changed = bits[1:] ^ bits[:-1]
+    rising = changed & bits[1:]
+    falling = changed & bits[:-1]
+
+    num_channels = bits.shape[1]
+    edges = {}
+    for name, mask in (("rising", rising), ("falling", falling)):
+        # Transpose so the nonzero entries come out channel by channel
+        chans, rows = np.nonzero(mask.T)
+        counts = np.bincount(chans, minlength=num_channels)
+        edges[name] = np.split(times[rows], np.cumsum(counts)[:-1])
+    return {
+        i + 1: (edges["rising"][i], edges["falling"][i])
+        for i in range(num_channels)}
+
+
+def edges_to_npz(edges, out_loc):
+    """
+    Save edges to a compressed npz.
+
+    edges maps record type to get_channel_edges output, and is saved
+    with keys like I_ch1_rising and I_ch1_falling.
+    """
+    arrays = {}
+    for inp_type, type_edges in edges.items():
+        for channel, (rising, falling) in type_edges.items():
+            arrays["{}_ch{}_rising".format(inp_type, channel)] = rising
+            arrays["{}_ch{}_falling".format(inp_type, channel)] = falling
+    np.savez_compressed(out_loc, **arrays)
 
 
 def read_axona_inp(in_location):
     """Extract certain channel information from the axona bin file"""
-    counter = 0
+    inp_dtype = get_inp_dtype()
     with open(in_location, 'rb') as file:
         header = parse_header(file)
-
-        time_arr = np.zeros(header["samples"], np.float32)
-        char_arr = np.zeros(header["samples"], str)
-        inp_arr = np.zeros(header["samples"] * 2, np.uint8)
-
-        chunk = file.read(header["sample_bytes"])
-        while counter != header["samples"]:
-            info = info_from_chunk(chunk, header["timebase"])
-            time_arr[counter] = info[0]
-            char_arr[counter] = info[1]
-            inp_arr[2 * counter:2 * counter + 2] = info[2]
-            counter = counter + 1
-
-            chunk = file.read(header["sample_bytes"])
-            # For debugging
-            # value = 256 * info[2][0] + info[2][1]
-            # value_b = np.unpackbits(info[2])[::-1]
+        if header["sample_bytes"] != inp_dtype.itemsize:
+            raise ValueError(
+                "Expected {} bytes per sample in {}, got {}".format(
+                    inp_dtype.itemsize, in_location,
+                    header["sample_bytes"]))
+        buffer = file.read(header["samples"] * inp_dtype.itemsize)
+
+    records = np.frombuffer(buffer, dtype=inp_dtype, count=header["samples"])
+    time_arr = (records["timestamp"] / header["timebase"]).astype(np.float32)
+    char_arr = records["type"].astype(str)
+    inp_arr = records["status"].ravel()
 
     return time_arr, char_arr, inp_arr
 
@@ -100,21 +186,33 @@ def log_exception(ex, more_info=""):
     print(message)
 
 
-def main(in_location, out_location=None):
+def main(in_location, out_location=None, out_format="csv"):
     if out_location is None:
-        out_location = in_location[:-3] + "csv"
+        out_location = in_location[:-3] + out_format
     ta, ca, ia = read_axona_inp(in_location)
-    info_to_file(ta, ca, ia, out_location)
+    if out_format == "npz":
+        info_to_npz(ta, ca, ia, out_location)
+    elif out_format == "edges":
+        out_location = os.path.splitext(out_location)[0] + "_edges.npz"
+        edges = {
+            inp_type: get_channel_edges(ta, ca, ia, inp_type)
+            for inp_type in ("I", "O")}
+        edges_to_npz(edges, out_location)
+    else:
+        info_to_file(ta, ca, ia, out_location)
 
 
 def main_cmd():
     parser = argparse.ArgumentParser(description="Parse a program location")
     parser.add_argument("--loc", "-l", type=str, help="inp file location")
+    parser.add_argument(
+        "--format", "-f", type=str, default="csv", choices=["csv", "npz", "edges"],
+        help="output format")
     parsed = parser.parse_args()
     if parsed.loc == None:
         print("Please enter a location through cmd with -l LOCATION")
         exit(-1)
-    main(parsed.loc)
+    main(parsed.loc, out_format=parsed.format)
 
 
 def main_py():
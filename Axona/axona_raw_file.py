@@ -0,0 +1,243 @@
+"""Time window access to Axona raw .bin and _shuff.bin files."""
+import os
+
+import numpy as np
+
+from raw_axona_loading import (
+    init_info, memmap_packets, decode_packets, get_file_size)
+
+
+class AxonaRawFile(object):
+    """
+    Read time windows of raw Axona data without loading the whole file.
+
+    Channels are 0-indexed, so tetrode t (1-indexed) is channels
+    4 * (t - 1) to 4 * (t - 1) + 3, as in the _shuff.bin files.
+
+    Parameters
+    ----------
+    location : str
+        The path to a raw .bin or a _shuff.bin file.
+    layout : str, optional. Defaults to None.
+        "bin" for the interleaved packets recorded by Axona,
+        "shuff" for (channels x samples) _shuff.bin files,
+        "shuff_transposed" for (samples x channels) _shuff.bin files.
+        None guesses "shuff" from a _shuff.bin name and "bin" otherwise.
+    offset : int, optional. Defaults to None.
+        The header bytes of a _shuff.bin file. None uses 16 if the file
+        starts with the old "bax" header and 0 otherwise.
+    use_index : bool, optional. Defaults to False.
+        For the "bin" layout, zero pad dropped packets using the
+        sidecar index from raw_axona_index (built if missing).
+
+    """
+
+    def __init__(
+            self, location, layout=None, offset=None, use_index=False):
+        self.location = location
+        self.info = init_info()
+        self.sample_rate = self.info["sample_rate"]
+        self.num_channels = self.info["num_channels"]
+        if layout is None:
+            layout = "shuff" if location.endswith("_shuff.bin") else "bin"
+        if layout not in ("bin", "shuff", "shuff_transposed"):
+            raise ValueError("Unsupported layout {}".format(layout))
+        self.layout = layout
+        self.segments = None
+
+        if layout == "bin":
+            self.data = memmap_packets(location, self.info)
+            if use_index:
+                from raw_axona_index import load_packet_index
+                self.segments = load_packet_index(location)["segments"]
+            self.num_samples = (
+                self.info["samples_per_chunk"] * self._num_packets())
+            return
+
+        if offset is None:
+            with open(location, "rb") as f:
+                offset = 16 if f.read(3) == b"bax" else 0
+        self.offset = offset
+        self.num_samples = (
+            (get_file_size(location) - offset) //
+            (self.info["sample_bytes"] * self.num_channels))
+        if layout == "shuff":
+            shape = (self.num_channels, self.num_samples)
+        else:
+            shape = (self.num_samples, self.num_channels)
+        self.data = np.memmap(
+            location, dtype=np.int16, mode="r", offset=offset, shape=shape)
+
+    def extract_snippets(
+            self, times, channels, pre_samples=10, post_samples=40):
+        """
+        Gather the window around every spike time in one operation.
+
+        Windows running off either end of the recording, or into dropped
+        packets when using the index, are zero padded.
+
+        Parameters
+        ----------
+        times : array like
+            The spike times in seconds.
+        channels : list of int
+            The 0-indexed channels to extract, such as a tetrode.
+        pre_samples : int, optional. Defaults to 10.
+            The samples to take before each spike sample.
+        post_samples : int, optional. Defaults to 40.
+            The samples to take from each spike sample onwards.
+
+        Returns
+        -------
+        np.ndarray
+            int16 snippets of shape (spikes, channels, samples).
+
+        """
+        starts = (
+            np.asarray(times, dtype=np.float64) * self.sample_rate
+        ).astype(np.int64) - pre_samples
+        idx = starts[:, None] + np.arange(pre_samples + post_samples)
+        outside = (idx < 0) | (idx >= self.num_samples)
+        idx = np.clip(idx, 0, max(self.num_samples - 1, 0))
+        chans = np.asarray(channels, dtype=np.int64)[None, :, None]
+        idx = idx[:, None, :]
+
+        if self.layout == "shuff":
+            snippets = self.data[chans, idx]
+        elif self.layout == "shuff_transposed":
+            snippets = self.data[idx, chans]
+        else:
+            samples_per_chunk = self.info["samples_per_chunk"]
+            packets = idx // samples_per_chunk
+            if self.segments is not None:
+                from raw_axona_index import lookup_file_packets
+                packets = lookup_file_packets(self.segments, packets)
+                outside = outside | (packets[:, 0, :] < 0)
+                packets = np.clip(packets, 0, None)
+            places = np.asarray(self.info["remap"])[chans]
+            snippets = self.data["samples"][
+                packets, idx % samples_per_chunk, places]
+        snippets[np.broadcast_to(outside[:, None, :], snippets.shape)] = 0
+        return snippets
+
+    def iter_snippets(
+            self, times, channels, pre_samples=10, post_samples=40,
+            chunk_spikes=10000):
+        """
+        Yield extract_snippets in chunks of at most chunk_spikes.
+
+        Memory use is bounded by the chunk size however many spikes
+        there are. Yields the index of the first spike in the chunk
+        and the (spikes, channels, samples) snippets.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        for start in range(0, len(times), chunk_spikes):
+            yield start, self.extract_snippets(
+                times[start:start + chunk_spikes], channels,
+                pre_samples, post_samples)
+
+    def _num_packets(self):
+        if self.segments is None or len(self.segments) == 0:
+            return len(self.data)
+        last = self.segments[-1]
+        return int(
+            last["packet_num"] + last["length"] -
+            self.segments[0]["packet_num"])
+
+    def get_duration(self):
+        """Return the duration of the recording in seconds."""
+        return self.num_samples / self.sample_rate
+
+    def time_to_sample(self, t):
+        """Convert a time in seconds to a sample index."""
+        return int(t * self.sample_rate)
+
+    def read(self, t_start, t_stop, channels=None):
+        """
+        Read the samples between t_start and t_stop seconds.
+
+        See read_samples for the channels and the returned array.
+        """
+        return self.read_samples(
+            self.time_to_sample(t_start), self.time_to_sample(t_stop),
+            channels)
+
+    def read_samples(self, start, stop=None, channels=None):
+        """
+        Read samples [start, stop) as a (channels x samples) array.
+
+        Like a numpy slice, the window is clipped to the recording.
+        For the _shuff.bin layouts the result is a view of the memory
+        map when channels is None or a slice, and a copy otherwise.
+        The "bin" layout always decodes into a new array.
+
+        Parameters
+        ----------
+        start : int
+            The first sample.
+        stop : int, optional. Defaults to None.
+            One past the last sample, None for the end of the file.
+        channels : list of int, slice or None, optional. Defaults to None.
+            The 0-indexed channels to read, None for all of them.
+
+        Returns
+        -------
+        np.ndarray
+            int16 samples with shape (channels, samples).
+
+        """
+        if channels is None:
+            channels = slice(None)
+        if stop is None:
+            stop = self.num_samples
+        start = min(max(start, 0), self.num_samples)
+        stop = min(max(stop, start), self.num_samples)
+        if self.layout == "shuff":
+            return self.data[channels, start:stop]
+        if self.layout == "shuff_transposed":
+            return self.data[start:stop, channels].T
+        return self._read_bin(start, stop, channels)
+
+    def _read_bin(self, start, stop, channels):
+        chans = np.arange(self.num_channels)[channels]
+        chans = np.atleast_1d(chans) + 1
+        samples_per_chunk = self.info["samples_per_chunk"]
+        first_packet = start // samples_per_chunk
+        last_packet = -(-stop // samples_per_chunk)
+        if self.segments is None:
+            packets = self.data[first_packet:last_packet]
+            block = decode_packets(packets, chans, self.info)
+        else:
+            from raw_axona_index import get_file_packets
+            file_packets = get_file_packets(
+                self.segments, first_packet, last_packet)
+            block = np.zeros(
+                (len(chans), samples_per_chunk * len(file_packets)),
+                np.int16)
+            good = file_packets >= 0
+            if good.any():
+                decoded = decode_packets(
+                    self.data[file_packets[good]], chans, self.info)
+                block.reshape(len(chans), -1, samples_per_chunk)[
+                    :, good] = decoded.reshape(
+                        len(chans), -1, samples_per_chunk)
+        skip = start - first_packet * samples_per_chunk
+        block = block[:, skip:skip + stop - start]
+        if np.ndim(np.arange(self.num_channels)[channels]) == 0:
+            return block[0]
+        return block
+
+
+def tetrode_channels(tetrode, chans_per_tetrode=4):
+    """Get the 0-indexed channels of a 1-indexed tetrode."""
+    start = 4 * (tetrode - 1)
+    return [start + i for i in range(chans_per_tetrode)]
+
+
+if __name__ == "__main__":
+    location = r"C:\Users\smartin5\Recordings\Raw\2min\CS1_18_02_open_2_bin_shuff.bin"
+    raw_file = AxonaRawFile(location)
+    print("{} has {} samples over {:.2f} seconds".format(
+        os.path.basename(location), raw_file.num_samples,
+        raw_file.get_duration()))
+    print(raw_file.read(1.0, 1.001, tetrode_channels(1)))
@@ -1,139 +1,375 @@
 import os
-from functools import partial
+import mmap
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copyfile
 
+import numpy as np
 
-def merge_2eegs(
-        eeg1_location, eeg2_location,
-        output_location=None, test_difference=False):
+copy_buffer_size = 16 * 1024 * 1024
+
+
+def parse_lfp_header(location):
+    """
+    Parse the header of an Axona .eeg or .egf file.
+
+    The data offsets are found by searching the memory mapped file
+    and the data length comes from the sample count in the header.
+
+    Parameters
+    ----------
+    location : str
+        The path to the .eeg/.egf file.
+
+    Returns
+    -------
+    dict
+        header - the raw header bytes before data_start,
+        samples_key - num_EEG_samples or num_EGF_samples,
+        num_samples, bytes_per_sample, duration (or None),
+        data_start and data_end - the byte offsets of the samples.
+
+    """
+    with open(location, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header_end = mm.find(b"data_start")
+        if header_end == -1:
+            raise ValueError("No data_start found in {}".format(location))
+        header = mm[:header_end]
+        file_size = len(mm)
+        data_end_marker = mm.rfind(b"\r\ndata_end")
+
+    out_dict = {
+        "header": header, "samples_key": None, "num_samples": None,
+        "bytes_per_sample": 1, "duration": None}
+    for line in header.decode("latin-1").splitlines():
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        if parts[0] in ("num_EEG_samples", "num_EGF_samples"):
+            out_dict["samples_key"] = parts[0]
+            out_dict["num_samples"] = int("".join(parts[1:]))
+        elif parts[0] == "bytes_per_sample":
+            out_dict["bytes_per_sample"] = int(parts[1])
+        elif parts[0] == "duration":
+            out_dict["duration"] = float(parts[1])
+    if out_dict["samples_key"] is None:
+        raise ValueError("No sample count found in {}".format(location))
+
+    data_start = header_end + len(b"data_start")
+    data_end = data_start + (
+        out_dict["num_samples"] * out_dict["bytes_per_sample"])
+    if data_end > file_size:
+        if data_end_marker < data_start:
+            raise ValueError("Truncated data in {}".format(location))
+        data_end = data_end_marker
+    out_dict["data_start"] = data_start
+    out_dict["data_end"] = data_end
+    out_dict["file_size"] = file_size
+    return out_dict
+
+
+def make_merged_header(headers):
+    """Rewrite the first header with the total samples and duration."""
+    total_samples = sum(h["num_samples"] for h in headers)
+    durations = [h["duration"] for h in headers]
+    samples_key = headers[0]["samples_key"]
+    lines = headers[0]["header"].split(b"\n")
+    for i, line in enumerate(lines):
+        text = line.decode("latin-1")
+        end = "\r" if text.endswith("\r") else ""
+        if text.startswith(samples_key):
+            text = "{} {}{}".format(samples_key, total_samples, end)
+        elif text.startswith("duration") and None not in durations:
+            text = "duration {:g}{}".format(sum(durations), end)
+        else:
+            continue
+        lines[i] = text.encode("latin-1")
+    return b"\n".join(lines)
+
+
+def copy_range(src, dst, offset, count):
+    """
+    Copy count bytes from offset in src to the end of dst.
+
+    Uses os.copy_file_range or os.sendfile where the OS supports them
+    so the data never passes through python, otherwise large buffers.
+    Both files must be unbuffered or flushed.
+    """
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    copied = 0
+    try:
+        if hasattr(os, "copy_file_range"):
+            while copied < count:
+                n = os.copy_file_range(
+                    src_fd, dst_fd, count - copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        elif hasattr(os, "sendfile") and os.name != "nt":
+            while copied < count:
+                n = os.sendfile(
+                    dst_fd, src_fd, offset + copied, count - copied)
+                if n == 0:
+                    break
+                copied += n
+    except OSError:
+        # Fall back to copying through python, e.g. on some filesystems
+        pass
+    if copied < count:
+        src.seek(offset + copied)
+        remaining = count - copied
+        while remaining:
+            buff = src.read(min(copy_buffer_size, remaining))
+            if not buff:
+                break
+            view = memoryview(buff)
+            while view:
+                # Unbuffered writes may be partial
+                view = view[dst.write(view):]
+            remaining -= len(buff)
+        copied = count - remaining
+    if copied != count:
+        raise IOError("Only copied {} of {} bytes".format(copied, count))
+
+
+def get_merge_name(locations):
+    """The default name, first_MERGE_second_MERGE_third.ext"""
+    stems = [os.path.basename(l).split(".")[0] for l in locations[1:]]
+    ext = os.path.basename(locations[0]).split(".")[1]
+    return (
+        locations[0].split(".")[0] +
+        "".join("_MERGE_" + stem for stem in stems) + "." + ext)
+
+
+def merge_lfps(locations, output_location=None, verbose=True):
+    """
+    Concatenate any number of .eeg or .egf recordings.
+
+    Parameters
+    ----------
+    locations : list of str
+        The files to merge, in time order.
+    output_location : str, optional. Defaults to None.
+        Where to save the result, None uses get_merge_name.
+    verbose : bool, optional. Defaults to True.
+        Whether to print the output location.
+
+    Returns
+    -------
+    str
+        The output location.
+
+    """
     if output_location is None:
-        base1 = os.path.basename(eeg1_location)
-        base2 = os.path.basename(eeg2_location)
-        output_location = (
-            eeg1_location.split(".")[0] + "_MERGE_" +
-            base2.split(".")[0] + "." + base1.split(".")[1])
+        output_location = get_merge_name(locations)
+    if verbose:
         print("Saving to " + output_location)
+    headers = [parse_lfp_header(location) for location in locations]
+    keys = set(h["samples_key"] for h in headers)
+    sample_bytes = set(h["bytes_per_sample"] for h in headers)
+    if len(keys) != 1 or len(sample_bytes) != 1:
+        raise ValueError(
+            "Can't merge files of different types: {}".format(locations))
 
-    with open(eeg1_location, 'rb') as f1, \
-            open(eeg2_location, 'rb') as f2, \
-            open(output_location, 'wb') as target_f:
+    with open(output_location, "wb", buffering=0) as target_f:
+        target_f.write(make_merged_header(headers) + b"data_start")
+        for location, header in zip(locations, headers):
+            with open(location, "rb", buffering=0) as f:
+                copy_range(
+                    f, target_f, header["data_start"],
+                    header["data_end"] - header["data_start"])
+        # Keep the trailer (data_end) of the last file
+        last = headers[-1]
+        with open(locations[-1], "rb", buffering=0) as f:
+            copy_range(
+                f, target_f, last["data_end"],
+                last["file_size"] - last["data_end"])
 
-        while True:
-            line = f2.readline()
-            try:
-                line = line.decode('UTF-8')
-            except:
-                break
+    return output_location
 
-            if line == '':
-                break
-            if line.startswith('num_EEG_samples'):
-                f2_samples = (int(''.join(line.split()[1:])))
-                break
 
-        f2.seek(0, 0)
-        while True:
-            line = f1.readline()
-            try:
-                line = line.decode('UTF-8')
-            except:
+def hash_region(location, start, end, block_size=copy_buffer_size):
+    """Stream a blake2b hash of bytes [start, end) of a file."""
+    digest = hashlib.blake2b()
+    with open(location, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining:
+            buff = f.read(min(block_size, remaining))
+            if not buff:
                 break
+            digest.update(buff)
+            remaining -= len(buff)
+    return digest.hexdigest()
 
-            if line == '':
-                break
-            if line.startswith('num_EEG_samples'):
-                f1_samples = (int(''.join(line.split()[1:])))
-                line = ('num_EEG_samples ' + str(f1_samples + f2_samples) +
-                        "    \r\n")
-            target_f.write(line.encode('UTF-8'))
-
-        f1.seek(0, 0)
-        while True:
-            try:
-                buff = f1.read(10).decode('UTF-8')
-            except:
-                break
-            if buff == 'data_start':
-                # header_offset = f1.tell()
-                target_f.write(buff.encode('UTF-8'))
-                break
-            else:
-                f1.seek(-9, 1)
-
-        for _bytes in iter(partial(f1.read, 1024), b''):
-            test = _bytes[-12:]
-            try:
-                val = test.decode('UTF-8')
-                if val.startswith("\r\ndata_end"):
-                    target_f.write(_bytes[:-12])
-                else:
-                    target_f.write(_bytes)
-            except:
-                target_f.write(_bytes)
-
-        while True:
-            try:
-                buff = f2.read(10).decode('UTF-8')
-            except:
-                break
-            if buff == 'data_start':
-                # header_offset = f2.tell()
+
+def _first_mismatch(in_map, in_start, out_map, out_start, count, block_size):
+    """Compare two memory mapped regions block-wise with numpy."""
+    for offset in range(0, count, block_size):
+        n = min(block_size, count - offset)
+        a = np.frombuffer(in_map, np.uint8, n, in_start + offset)
+        b = np.frombuffer(out_map, np.uint8, n, out_start + offset)
+        if not np.array_equal(a, b):
+            return offset + int(np.flatnonzero(a != b)[0])
+    return None
+
+
+def verify_merge(
+        locations, output_location, method="compare",
+        block_size=copy_buffer_size):
+    """
+    Check that a merged file holds exactly the data of its inputs.
+
+    Parameters
+    ----------
+    locations : list of str
+        The files that were merged, in order.
+    output_location : str
+        The merged file.
+    method : str, optional. Defaults to "compare".
+        "compare" memory maps the files and compares blocks with numpy.
+        "hash" compares a streamed hash of each data region first and
+        only compares the blocks of regions whose hashes differ.
+    block_size : int, optional. Defaults to 16MB.
+        The bytes to compare or hash at a time.
+
+    Returns
+    -------
+    dict
+        ok, the expected and merged sample counts and, on a mismatch,
+        the input file and the byte offset and sample index in the
+        merged data where they first differ.
+
+    """
+    headers = [parse_lfp_header(location) for location in locations]
+    out_header = parse_lfp_header(output_location)
+    bytes_per_sample = out_header["bytes_per_sample"]
+    result = {
+        "ok": True,
+        "expected_samples": sum(h["num_samples"] for h in headers),
+        "merged_samples": out_header["num_samples"],
+        "mismatch_file": None,
+        "mismatch_offset": None,
+        "mismatch_sample": None}
+    out_data_bytes = out_header["data_end"] - out_header["data_start"]
+    in_data_bytes = sum(h["data_end"] - h["data_start"] for h in headers)
+    if (result["expected_samples"] != result["merged_samples"] or
+            in_data_bytes != out_data_bytes):
+        result["ok"] = False
+
+    out_pos = out_header["data_start"]
+    with open(output_location, "rb") as out_f, mmap.mmap(
+            out_f.fileno(), 0, access=mmap.ACCESS_READ) as out_map:
+        for location, header in zip(locations, headers):
+            count = header["data_end"] - header["data_start"]
+            count = min(count, out_header["data_end"] - out_pos)
+            if method == "hash":
+                in_hash = hash_region(
+                    location, header["data_start"],
+                    header["data_start"] + count, block_size)
+                out_hash = hash_region(
+                    output_location, out_pos, out_pos + count, block_size)
+                if in_hash == out_hash:
+                    out_pos += count
+                    continue
+            with open(location, "rb") as in_f, mmap.mmap(
+                    in_f.fileno(), 0, access=mmap.ACCESS_READ) as in_map:
+                mismatch = _first_mismatch(
+                    in_map, header["data_start"], out_map, out_pos,
+                    count, block_size)
+            if mismatch is not None:
+                data_offset = out_pos - out_header["data_start"] + mismatch
+                result["ok"] = False
+                result["mismatch_file"] = location
+                result["mismatch_offset"] = out_pos + mismatch
+                result["mismatch_sample"] = data_offset // bytes_per_sample
                 break
-            else:
-                f2.seek(-9, 1)
+            out_pos += count
+    return result
 
-        for _bytes in iter(partial(f2.read, 1024), b''):
-            target_f.write(_bytes)
 
-    if test_difference:
-        with open(eeg1_location, 'rb') as f1, \
-                open(eeg2_location, 'rb') as f2, \
-                open(output_location, 'rb') as f3:
-            byte1 = f1.read(1)
-            byte3 = f3.read(1)
-            i = 0
-            while byte1:
-                if byte1 != byte3:
-                    print(i, byte1, byte3)
-                    if i < 1000:
-                        i = i + 1
-                        byte3 = f3.read(1)
-                    byte1 = f1.read(1)
-                else:
-                    i = i + 1
-                    byte1 = f1.read(1)
-                    byte3 = f3.read(1)
-
-            while True:
-                try:
-                    buff = f2.read(10).decode('UTF-8')
-                except:
-                    break
-                if buff == 'data_start':
-                    # header_offset = f2.tell()
-                    break
-                else:
-                    f2.seek(-9, 1)
+def print_verification(result):
+    """Print the output of verify_merge."""
+    if result["ok"]:
+        print("Merge verified, {} samples".format(result["merged_samples"]))
+        return
+    print("Merge failed verification, expected {} samples, got {}".format(
+        result["expected_samples"], result["merged_samples"]))
+    if result["mismatch_offset"] is not None:
+        print("First difference from {} at byte {} (sample {})".format(
+            result["mismatch_file"], result["mismatch_offset"],
+            result["mismatch_sample"]))
 
-            byte2 = f2.read(1)
 
-            while byte2:
-                if byte2 != byte3:
-                    print(i, byte2, byte3)
-                i = i + 1
-                byte3 = f3.read(1)
-                byte2 = f2.read(1)
+def merge_2eegs(
+        eeg1_location, eeg2_location,
+        output_location=None, test_difference=False):
+    output_location = merge_lfps(
+        [eeg1_location, eeg2_location], output_location)
+
+    if test_difference:
+        result = verify_merge([eeg1_location, eeg2_location], output_location)
+        print_verification(result)
 
     return output_location
 
 
+def get_channel_location(location, channel):
+    """Get the file for a 1-indexed channel, e.g. a.eeg, a.eeg2, a.eeg3."""
+    if channel == 1:
+        return location
+    return location + str(channel)
+
+
+def merge_all_channels(locations, num_channels=32, workers=8, verify=False):
+    """
+    Merge every channel file of several recordings in a thread pool.
+
+    Parameters
+    ----------
+    locations : list of str
+        The first channel file (.eeg or .egf) of each recording.
+    num_channels : int, optional. Defaults to 32.
+        The channel files to look for, missing ones are skipped.
+    workers : int, optional. Defaults to 8.
+        The number of channels to merge at once.
+    verify : bool, optional. Defaults to False.
+        Whether to check each merged file with verify_merge.
+
+    Returns
+    -------
+    list of str
+        The merged files, in channel order.
+
+    """
+    jobs = []
+    for channel in range(1, num_channels + 1):
+        channel_locations = [
+            get_channel_location(l, channel) for l in locations]
+        missing = [l for l in channel_locations if not os.path.isfile(l)]
+        if missing:
+            print("Skipping channel {}, missing {}".format(channel, missing))
+            continue
+        jobs.append(channel_locations)
+
+    def merge_job(channel_locations):
+        output_location = merge_lfps(channel_locations)
+        if verify:
+            result = verify_merge(channel_locations, output_location)
+            if not result["ok"]:
+                print_verification(result)
+                raise IOError("Failed to merge {}".format(output_location))
+        return output_location
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(merge_job, jobs))
+
+
 def main(args):
-    for i in range(32):
-        a_val = ""
-        if i is not 0:
-            a_val = str(i + 1)
-        output_location = merge_2eegs(
-            args["eeg1_location"] + a_val, args["eeg2_location"] + a_val)
+    locations = [args["eeg1_location"], args["eeg2_location"]]
+    output_locations = merge_all_channels(locations, verify=True)
+    output_location = output_locations[-1]
 
     src = args["eeg1_location"].split(".")[0] + ".set"
     dst = output_location.split(".")[0] + ".set"
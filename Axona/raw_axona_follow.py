@@ -0,0 +1,181 @@
+"""Follow an Axona raw .bin file while it is still being recorded."""
+import os
+from time import sleep, time
+
+import numpy as np
+import h5py
+
+from raw_axona_loading import (
+    init_info, get_packet_dtype, parse_channels, decode_packets)
+
+
+class RingBuffer(object):
+    """
+    A fixed size (channels x samples) int16 buffer of the latest samples.
+
+    Memory use is fixed at creation, older samples are overwritten.
+    """
+
+    def __init__(self, num_channels, capacity):
+        self.data = np.zeros((num_channels, capacity), np.int16)
+        self.capacity = capacity
+        self.total_samples = 0
+
+    def append(self, block):
+        """Append a (channels x samples) block."""
+        n = block.shape[1]
+        if n >= self.capacity:
+            block = block[:, n - self.capacity:]
+            start = (self.total_samples + n - self.capacity) % self.capacity
+        else:
+            start = self.total_samples % self.capacity
+        stored = block.shape[1]
+        first = min(stored, self.capacity - start)
+        self.data[:, start:start + first] = block[:, :first]
+        self.data[:, :stored - first] = block[:, first:]
+        self.total_samples += n
+
+    def latest(self, num_samples=None):
+        """Return a copy of the latest num_samples in time order."""
+        available = min(self.total_samples, self.capacity)
+        if num_samples is None or num_samples > available:
+            num_samples = available
+        end = self.total_samples % self.capacity
+        idx = np.arange(end - num_samples, end) % self.capacity
+        return self.data[:, idx]
+
+    def close(self):
+        pass
+
+
+class HDF5Sink(object):
+    """
+    Append samples to per channel SWMR HDF5 datasets.
+
+    Uses the same channels/<channel> layout as read_axona_raw, so
+    readers can open the file with swmr=True and refresh the datasets.
+    The total_samples attribute is updated after each append, but a
+    refreshed dataset's length is the most up to date count.
+    """
+
+    def __init__(self, out_location, channels, chunk_samples=48000):
+        self.channels = channels
+        self.hdf5_file = h5py.File(out_location, mode="w", libver="latest")
+        channel_data = self.hdf5_file.create_group("channels")
+        channel_data.attrs["channel_list"] = channels
+        channel_data.attrs["total_samples"] = 0
+        for channel in channels:
+            channel_data.create_dataset(
+                str(channel), (0,), np.int16, maxshape=(None,),
+                chunks=(chunk_samples,))
+        self.channel_data = channel_data
+        self.hdf5_file.swmr_mode = True
+        self.total_samples = 0
+
+    def append(self, block):
+        """Append a (channels x samples) block and flush it to readers."""
+        end = self.total_samples + block.shape[1]
+        for i, channel in enumerate(self.channels):
+            dset = self.channel_data[str(channel)]
+            dset.resize((end,))
+            dset[self.total_samples:end] = block[i]
+            dset.flush()
+        self.total_samples = end
+        self.channel_data.attrs["total_samples"] = end
+        self.hdf5_file.flush()
+
+    def close(self):
+        self.hdf5_file.close()
+
+
+class AxonaRawFollower(object):
+    """
+    Decode the new whole packets of a growing Axona raw .bin file.
+
+    Each poll reads at most max_packets packets and hands the decoded
+    block to the sink before reading more, so memory stays bounded by
+    the block size however far behind the recording the reader is.
+
+    Parameters
+    ----------
+    in_location : str
+        The path to the .bin file being recorded.
+    sink : RingBuffer or HDF5Sink
+        Any object with append(block) and close() methods.
+    channels : list of int or "all", optional. Defaults to "all".
+        The 1-indexed channels to decode.
+    max_packets : int, optional. Defaults to 16000.
+        The most packets to decode per poll, 16000 packets is 1 second.
+
+    """
+
+    def __init__(self, in_location, sink, channels="all", max_packets=16000):
+        self.info = init_info()
+        self.in_location = in_location
+        self.sink = sink
+        self.channels = parse_channels(channels, self.info)
+        self.max_packets = max_packets
+        self.dtype = get_packet_dtype(self.info)
+        self.position = 0
+
+    def poll(self):
+        """Decode up to max_packets new packets, return how many."""
+        try:
+            size = os.path.getsize(self.in_location)
+        except OSError:
+            return 0
+        chunksize = self.info["chunksize"]
+        if size < self.position:
+            raise IOError(
+                "{} shrank from {} to {} bytes while following".format(
+                    self.in_location, self.position, size))
+        num_packets = min(
+            (size - self.position) // chunksize, self.max_packets)
+        if num_packets == 0:
+            return 0
+        with open(self.in_location, "rb") as f:
+            f.seek(self.position)
+            buffer = f.read(num_packets * chunksize)
+        # The writer may not have flushed everything reported by the size
+        num_packets = len(buffer) // chunksize
+        packets = np.frombuffer(
+            buffer, dtype=self.dtype, count=num_packets)
+        self.sink.append(decode_packets(packets, self.channels, self.info))
+        self.position += num_packets * chunksize
+        return num_packets
+
+    def follow(self, poll_interval=0.5, idle_timeout=None, verbose=False):
+        """
+        Poll until no new data arrives for idle_timeout seconds.
+
+        Sleeps poll_interval only when caught up with the file.
+        If idle_timeout is None, follows until interrupted.
+        """
+        last_data = time()
+        try:
+            while True:
+                num_packets = self.poll()
+                if num_packets:
+                    last_data = time()
+                    if verbose:
+                        print("Read {} packets, now at {} bytes".format(
+                            num_packets, self.position))
+                    continue
+                if (idle_timeout is not None and
+                        time() - last_data > idle_timeout):
+                    break
+                sleep(poll_interval)
+        except KeyboardInterrupt:
+            print("Stopped following {}".format(self.in_location))
+        finally:
+            self.sink.close()
+        return self.position // self.info["chunksize"]
+
+
+if __name__ == "__main__":
+    in_location = r"C:\Users\smartin5\Recordings\Raw\live_raw.bin"
+    out_location = r"C:\Users\smartin5\Recordings\Raw\live_raw.h5"
+    channels = [1, 2, 3, 4]
+    sink = HDF5Sink(out_location, channels)
+    follower = AxonaRawFollower(in_location, sink, channels=channels)
+    follower.follow(idle_timeout=60, verbose=True)
@@ -0,0 +1,240 @@
+"""Index the packet headers of an Axona raw .bin file."""
+import os
+from time import time
+
+import numpy as np
+
+from raw_axona_loading import init_info, memmap_packets, get_file_size
+
+segment_dtype = np.dtype([
+    ("file_packet", "<i8"),
+    ("packet_num", "<i8"),
+    ("length", "<i8")])
+
+
+def get_index_location(in_location):
+    """Get the sidecar index filename for a .bin file."""
+    return in_location + ".idx.npz"
+
+
+def unwrap_packet_nums(packet_nums):
+    """Convert uint32 packet numbers to int64, undoing any wraparound."""
+    nums = packet_nums.astype(np.int64)
+    if len(nums) < 2:
+        return nums
+    wraps = np.diff(nums) < -(2 ** 31)
+    if wraps.any():
+        nums[1:] += (2 ** 32) * np.cumsum(wraps)
+    return nums
+
+
+def build_packet_index(in_location):
+    """
+    Read every packet header once and index the contiguous runs.
+
+    Packets with a corrupt id, or a packet number not greater than
+    every earlier packet (duplicates and out of order packets) are
+    left out of the runs. Each run is a stretch of packets that are
+    contiguous both in the file and in packet number.
+
+    Parameters
+    ----------
+    in_location : str
+        The path to the .bin file.
+
+    Returns
+    -------
+    dict
+        segments - the runs as an array of segment_dtype,
+        and the counts of packets, corrupt, duplicates, out of order
+        packets and missing packet numbers.
+
+    """
+    info = init_info()
+    packets = memmap_packets(in_location, info)
+    ids = packets["id"]
+    nums = unwrap_packet_nums(packets["packet_num"])
+
+    keep = np.char.startswith(ids, b"ADU")
+    num_corrupt = int(len(keep) - np.count_nonzero(keep))
+    file_pos = np.flatnonzero(keep)
+    kept_nums = nums[keep]
+    num_duplicates = num_out_of_order = 0
+    if len(kept_nums) > 1:
+        previous_max = np.maximum.accumulate(kept_nums)[:-1]
+        later = kept_nums[1:]
+        num_duplicates = int(np.count_nonzero(later == previous_max))
+        num_out_of_order = int(np.count_nonzero(later < previous_max))
+        increasing = np.concatenate(([True], later > previous_max))
+        file_pos = file_pos[increasing]
+        kept_nums = kept_nums[increasing]
+
+    if len(kept_nums) == 0:
+        segments = np.zeros(0, segment_dtype)
+        num_missing = 0
+    else:
+        breaks = np.flatnonzero(
+            (np.diff(kept_nums) != 1) | (np.diff(file_pos) != 1)) + 1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [len(kept_nums)]))
+        segments = np.zeros(len(starts), segment_dtype)
+        segments["file_packet"] = file_pos[starts]
+        segments["packet_num"] = kept_nums[starts]
+        segments["length"] = ends - starts
+        num_missing = int(
+            kept_nums[-1] - kept_nums[0] + 1 - len(kept_nums))
+
+    return {
+        "segments": segments,
+        "num_packets": len(packets),
+        "num_corrupt": num_corrupt,
+        "num_duplicates": num_duplicates,
+        "num_out_of_order": num_out_of_order,
+        "num_missing": num_missing}
+
+
+def get_gaps(segments):
+    """
+    Get the dropped packets between runs.
+
+    Returns
+    -------
+    np.ndarray
+        (N x 2) array of the first missing packet number and how many
+        packet numbers are missing at that point.
+
+    """
+    if len(segments) < 2:
+        return np.zeros((0, 2), np.int64)
+    ends = segments["packet_num"][:-1] + segments["length"][:-1]
+    missing = segments["packet_num"][1:] - ends
+    gap = missing > 0
+    return np.column_stack((ends[gap], missing[gap]))
+
+
+def save_packet_index(in_location, index, out_location=None):
+    """Save the index next to the .bin file, keyed by its size and mtime."""
+    if out_location is None:
+        out_location = get_index_location(in_location)
+    counts = {k: v for k, v in index.items() if k != "segments"}
+    np.savez(
+        out_location, segments=index["segments"],
+        file_size=get_file_size(in_location),
+        file_mtime=os.path.getmtime(in_location),
+        **counts)
+    return out_location
+
+
+def load_packet_index(in_location, rebuild=True, verbose=False):
+    """
+    Load the sidecar index of a .bin file.
+
+    If the sidecar is missing or the .bin changed since it was saved,
+    the index is rebuilt and saved when rebuild is True.
+    Otherwise None is returned.
+    """
+    index_location = get_index_location(in_location)
+    if os.path.isfile(index_location):
+        with np.load(index_location) as data:
+            fresh = (
+                int(data["file_size"]) == get_file_size(in_location) and
+                float(data["file_mtime"]) == os.path.getmtime(in_location))
+            if fresh:
+                return {
+                    k: (data[k] if k == "segments" else int(data[k]))
+                    for k in data.files
+                    if k not in ("file_size", "file_mtime")}
+    if not rebuild:
+        return None
+    start_time = time()
+    index = build_packet_index(in_location)
+    save_packet_index(in_location, index)
+    if verbose:
+        print("Indexed {} packets of {} in {:.2f} seconds".format(
+            index["num_packets"], in_location, time() - start_time))
+    return index
+
+
+def get_file_packets(segments, first, last):
+    """
+    Map packet numbers relative to the first packet onto file packets.
+
+    Parameters
+    ----------
+    segments : np.ndarray
+        The runs from build_packet_index.
+    first : int
+        The first packet to get, 0 is the first recorded packet.
+    last : int
+        One past the last packet to get.
+
+    Returns
+    -------
+    np.ndarray
+        The file packet of each packet in [first, last),
+        -1 where that packet was dropped.
+
+    """
+    out = np.full(max(last - first, 0), -1, np.int64)
+    if len(segments) == 0 or len(out) == 0:
+        return out
+    origin = segments["packet_num"][0]
+    seg_starts = segments["packet_num"] - origin
+    seg_ends = seg_starts + segments["length"]
+    lo = np.searchsorted(seg_ends, first, side="right")
+    hi = np.searchsorted(seg_starts, last, side="left")
+    for seg in range(lo, hi):
+        start = max(seg_starts[seg], first)
+        end = min(seg_ends[seg], last)
+        file_start = segments["file_packet"][seg] + start - seg_starts[seg]
+        out[start - first:end - first] = np.arange(
+            file_start, file_start + end - start)
+    return out
+
+
+def lookup_file_packets(segments, packets):
+    """
+    Vectorised get_file_packets for any array of relative packets.
+
+    Returns an array of the same shape, -1 where a packet was dropped.
+    """
+    packets = np.asarray(packets, np.int64)
+    out = np.full(packets.shape, -1, np.int64)
+    if len(segments) == 0:
+        return out
+    seg_starts = segments["packet_num"] - segments["packet_num"][0]
+    seg = np.searchsorted(seg_starts, packets, side="right") - 1
+    seg = np.clip(seg, 0, None)
+    offset = packets - seg_starts[seg]
+    found = (offset >= 0) & (offset < segments["length"][seg])
+    out[found] = segments["file_packet"][seg[found]] + offset[found]
+    return out
+
+
+def time_to_file_packet(segments, t, info=None):
+    """Get the file packet recorded at t seconds, or -1 if dropped."""
+    if info is None:
+        info = init_info()
+    packet_rate = info["sample_rate"] // info["samples_per_chunk"]
+    first = int(t * packet_rate)
+    return int(get_file_packets(segments, first, first + 1)[0])
+
+
+def summarise_index(index):
+    """Print the integrity of an indexed .bin file."""
+    segments = index["segments"]
+    gaps = get_gaps(segments)
+    print("{} packets in {} contiguous runs".format(
+        index["num_packets"], len(segments)))
+    print("Corrupt {}, duplicate {}, out of order {}, missing {}".format(
+        index["num_corrupt"], index["num_duplicates"],
+        index["num_out_of_order"], index["num_missing"]))
+    for first_missing, num_missing in gaps:
+        print("Dropped {} packets from packet number {}".format(
+            num_missing, first_missing))
+
+
+if __name__ == "__main__":
+    in_location = r"C:\Users\smartin5\Recordings\Raw\Raw_1min\190619_LCA4_1m_raw.bin"
+    index = load_packet_index(in_location, verbose=True)
+    summarise_index(index)
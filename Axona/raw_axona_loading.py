@@ -1,4 +1,8 @@
 import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from time import time
 
 import numpy as np
@@ -36,75 +40,415 @@ def init_info():
         "sample_bytes": 2,
         "channel_bytes": 128,
         "header_bytes": 32,
+        "trailer_bytes": 16,
+        "samples_per_chunk": 3,
+        "num_channels": 64,
+        "sample_rate": 48000,
         "chunksize": 432}
     return info
 
 
+def get_packet_dtype(info):
+    """
+    Get the numpy structured dtype of one raw Axona packet.
+
+    Each packet is a 32 byte header, 3 samples of 64 little endian
+    int16 channels stored in hardware order, and a 16 byte trailer.
+
+    Parameters
+    ----------
+    info : dict
+        The binary layout information from init_info.
+
+    Returns
+    -------
+    np.dtype
+        A dtype whose itemsize is info["chunksize"].
+
+    """
+    header_rest = info["header_bytes"] - 12
+    trailer_rest = info["trailer_bytes"] - 2
+    return np.dtype([
+        ("id", "S4"),
+        ("packet_num", "<u4"),
+        ("digital_in", "<u2"),
+        ("sync_in", "<u2"),
+        ("header_rest", "V{}".format(header_rest)),
+        ("samples", "<i2",
+         (info["samples_per_chunk"], info["num_channels"])),
+        ("digital_out", "<u2"),
+        ("trailer_rest", "V{}".format(trailer_rest))])
+
+
+def memmap_packets(in_location, info=None):
+    """
+    Memory map an Axona raw .bin file as an array of packets.
+
+    Any trailing partial packet is ignored.
+
+    Parameters
+    ----------
+    in_location : str
+        The path to the .bin file.
+    info : dict, optional. Defaults to None.
+        The binary layout information, init_info() if None.
+
+    Returns
+    -------
+    np.memmap
+        A read-only 1D array with dtype get_packet_dtype(info).
+
+    """
+    if info is None:
+        info = init_info()
+    dtype = get_packet_dtype(info)
+    num_packets = get_file_size(in_location) // info["chunksize"]
+    if num_packets == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(
+        in_location, dtype=dtype, mode="r", shape=(num_packets,))
+
+
+def parse_channels(channels, info):
+    """Convert "all" or a list of 1-indexed channels to a list."""
+    if isinstance(channels, str) and channels == "all":
+        return [i for i in range(1, info["num_channels"] + 1)]
+    return list(channels)
+
+
+def decode_packets(packets, channels, info):
+    """
+    Decode raw packets into a (channels x samples) int16 array.
+
+    The remap table is applied with a single fancy index, so the
+    samples are copied out of the packets exactly once.
+
+    Parameters
+    ----------
+    packets : np.ndarray
+        An array with dtype get_packet_dtype(info).
+    channels : list of int
+        The 1-indexed channels to decode, in output order.
+    info : dict
+        The binary layout information from init_info.
+
+    Returns
+    -------
+    np.ndarray
+        C-contiguous int16 array of shape (len(channels), 3 * len(packets)).
+
+    """
+    places = np.asarray(info["remap"])[np.asarray(channels, dtype=int) - 1]
+    samples = packets["samples"].transpose(2, 0, 1)[places]
+    return samples.reshape(len(places), -1)
+
+
+def iter_axona_raw(
+        in_location, channels="all", block_packets=100000, info=None):
+    """
+    Decode an Axona raw .bin file in blocks of packets.
+
+    Parameters
+    ----------
+    in_location : str
+        The path to the .bin file.
+    channels : list of int or "all", optional. Defaults to "all".
+        The 1-indexed channels to decode.
+    block_packets : int, optional. Defaults to 100000.
+        The number of packets to decode at a time, memory use is
+        roughly 6 * len(channels) * block_packets bytes.
+    info : dict, optional. Defaults to None.
+        The binary layout information, init_info() if None.
+
+    Yields
+    ------
+    (int, np.ndarray)
+        The index of the first sample in the block and the
+        (channels x samples) block itself.
+
+    """
+    if info is None:
+        info = init_info()
+    channels = parse_channels(channels, info)
+    packets = memmap_packets(in_location, info)
+    samples_per_chunk = info["samples_per_chunk"]
+    for start in range(0, len(packets), block_packets):
+        block = packets[start:start + block_packets]
+        yield (
+            samples_per_chunk * start,
+            decode_packets(block, channels, info))
+
+
+def decode_axona_raw(
+        in_location, channels="all", start_packet=0, stop_packet=None):
+    """
+    Decode (part of) an Axona raw .bin file into memory.
+
+    Parameters
+    ----------
+    in_location : str
+        The path to the .bin file.
+    channels : list of int or "all", optional. Defaults to "all".
+        The 1-indexed channels to decode.
+    start_packet : int, optional. Defaults to 0.
+        The first packet to decode.
+    stop_packet : int, optional. Defaults to None.
+        One past the last packet to decode, None for the end of file.
+
+    Returns
+    -------
+    np.ndarray
+        int16 array of shape (len(channels), samples).
+
+    """
+    info = init_info()
+    channels = parse_channels(channels, info)
+    packets = memmap_packets(in_location, info)[start_packet:stop_packet]
+    return decode_packets(packets, channels, info)
+
+
 def extract_channel(chunk, channel, info):
-    """ Gets all three samples from a 432 byte chunk"""
-    place = info["remap"][channel - 1]
-    offset = info["header_bytes"] + (place * info["sample_bytes"])
-    samples = np.empty(3, dtype=np.int16)
-    for i in range(3):
-        start_idx = i * info["channel_bytes"] + offset
-        # Later use np.int16 to use two's complement
-        samples[i] = chunk[start_idx + 1] * 256 + chunk[start_idx]
-    return samples
+    """Gets all three samples from a 432 byte chunk"""
+    packet = np.frombuffer(
+        bytes(chunk[:info["chunksize"]]), dtype=get_packet_dtype(info),
+        count=1)
+    return decode_packets(packet, [channel], info)[0]
 
 
 def read_axona_raw(in_location, out_location, channels="all"):
     """Extract certain channel information from the axona bin file"""
     info = init_info()
     size = get_file_size(in_location)
-    counter = 0
-    if channels == "all":
-        channels = [i for i in range(1, 65)]
+    channels = parse_channels(channels, info)
 
     write_rate = 100000
     start_time = time()
-    total_samples = 3 * size // info["chunksize"]
+    num_packets = size // info["chunksize"]
     with h5py.File(out_location, mode="w", libver="latest") as hdf5_file:
         hdf5_file.swmr_mode = True
         create_hdf_storage(hdf5_file, info, size, channels)
         write_set = hdf5_file["channels"]
-        temp = np.empty((len(channels), write_rate * 3), np.int16)
-        with open(in_location, 'rb') as file:
-            try:
-                start_write = time()
-                chunk = file.read(info["chunksize"])
-                while chunk:
-                    for i, channel in enumerate(channels):
-                        sample = extract_channel(chunk, channel, info)
-                        t_counter = counter % write_rate
-                        temp[i, 3 * t_counter: 3 * (t_counter + 1)] = sample
-                    chunk = file.read(info["chunksize"])
-                    counter += 1
-                    if counter % write_rate == 0:
-                        for i, channel in enumerate(channels):
-                            wr = write_set[str(channel)]
-                            wr[3 * counter - 3 * write_rate:3 * counter] = (
-                                temp[i, :])
-                        print(
-                            "Currently on {} out of {} took {:2f}".format(
-                                counter,
-                                size // info["chunksize"],
-                                time() - start_write) +
-                            " seconds to write last chunk")
-                        start_write = time()
-
+        counter = 0
+        try:
+            start_write = time()
+            for start, block in iter_axona_raw(
+                    in_location, channels, write_rate, info):
+                end = start + block.shape[1]
                 for i, channel in enumerate(channels):
-                    wr = write_set[str(channel)]
-                    left = total_samples % (3 * write_rate)
-                    start = total_samples - left
-                    wr[start:] = temp[i, :left]
+                    write_set[str(channel)][start:end] = block[i]
+                counter = end // info["samples_per_chunk"]
+                print(
+                    "Currently on {} out of {} took {:2f}".format(
+                        counter, num_packets, time() - start_write) +
+                    " seconds to write last chunk")
+                start_write = time()
 
-            except Exception as e:
-                log_exception(e, "on run {}".format(counter))
+        except Exception as e:
+            log_exception(e, "on run {}".format(counter))
     print(
         "Finished writing to HDF5 at {} in {:2f} seconds".format(
             out_location, time() - start_time))
 
 
+def get_compression(compressor="gzip", level=4):
+    """
+    Get the HDF5 filter settings and matching in-python compressor.
+
+    Parameters
+    ----------
+    compressor : str or None, optional. Defaults to "gzip".
+        One of None/"none", "lzf", "gzip" or "blosc".
+        blosc needs the blosc and hdf5plugin packages, and readers
+        must import hdf5plugin to decompress the result.
+    level : int, optional. Defaults to 4.
+        The compression level for gzip and blosc.
+
+    Returns
+    -------
+    (dict, function or None)
+        Keyword arguments for create_dataset, and a function taking
+        chunk bytes and returning the stored chunk bytes.
+        The function is None when only HDF5 can apply the filter (lzf),
+        in which case chunks are compressed by h5py in the writer.
+
+    """
+    if compressor is None or compressor == "none":
+        return {}, bytes
+    if compressor == "gzip":
+        return (
+            {"compression": "gzip", "compression_opts": level},
+            partial(zlib.compress, level=level))
+    if compressor == "lzf":
+        return {"compression": "lzf"}, None
+    if compressor == "blosc":
+        try:
+            import blosc
+            import hdf5plugin
+        except ImportError:
+            raise ValueError(
+                "blosc compression needs the blosc and hdf5plugin packages")
+        kwargs = dict(hdf5plugin.Blosc(
+            cname="lz4", clevel=level, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        compress = partial(
+            blosc.compress, typesize=2, clevel=level,
+            shuffle=blosc.SHUFFLE, cname="lz4")
+        return kwargs, compress
+    raise ValueError("Unsupported compressor {}".format(compressor))
+
+
+def _prepare_block(
+        packets, channels, info, start, stop, layout, chunk_shape, compress):
+    """
+    Decode samples [start, stop) and split them into HDF5 chunks.
+
+    Runs in the worker pool, returns a list of (offset, data) where
+    data is compressed bytes for write_direct_chunk, or the decoded
+    block itself as [(start, block)] if compress is None.
+    """
+    samples_per_chunk = info["samples_per_chunk"]
+    first_packet = start // samples_per_chunk
+    last_packet = -(-stop // samples_per_chunk)
+    block = decode_packets(
+        packets[first_packet:last_packet], channels, info)
+    skip = start - first_packet * samples_per_chunk
+    block = block[:, skip:skip + stop - start]
+    if layout == "time":
+        block = block.T
+    if compress is None:
+        return [(start, block)]
+
+    time_axis = 0 if layout == "time" else 1
+    chan_axis = 1 - time_axis
+    out = []
+    for c in range(0, block.shape[chan_axis], chunk_shape[chan_axis]):
+        index = [None, None]
+        index[chan_axis] = slice(c, c + chunk_shape[chan_axis])
+        index[time_axis] = slice(None)
+        chunk = block[tuple(index)]
+        if chunk.shape != tuple(chunk_shape):
+            # HDF5 stores edge chunks at full size
+            padded = np.zeros(chunk_shape, np.int16)
+            padded[:chunk.shape[0], :chunk.shape[1]] = chunk
+            chunk = padded
+        offset = [0, 0]
+        offset[chan_axis] = c
+        offset[time_axis] = start
+        out.append(
+            (tuple(offset), compress(np.ascontiguousarray(chunk).tobytes())))
+    return out
+
+
+def _write_prepared(dset, prepared, time_axis):
+    """Write the output of _prepare_block to dset."""
+    for offset, data in prepared:
+        if isinstance(data, np.ndarray):
+            index = [slice(None), slice(None)]
+            index[time_axis] = slice(offset, offset + data.shape[time_axis])
+            dset[tuple(index)] = data
+        else:
+            dset.id.write_direct_chunk(offset, data)
+
+
+def export_axona_raw(
+        in_location, out_location, channels="all", layout="channel",
+        chunk_shape=None, compressor="gzip", level=4, workers=None,
+        verbose=True):
+    """
+    Export an Axona raw .bin file to one chunked HDF5 dataset.
+
+    Blocks of chunks are decoded and compressed in a thread pool while
+    the calling thread writes the finished chunks to HDF5 in order.
+
+    Parameters
+    ----------
+    in_location : str
+        The path to the .bin file.
+    out_location : str
+        The path to the output HDF5 file.
+    channels : list of int or "all", optional. Defaults to "all".
+        The 1-indexed channels to export.
+    layout : str, optional. Defaults to "channel".
+        "channel" stores samples as (channels x samples),
+        "time" stores samples as (samples x channels).
+    chunk_shape : tuple of int, optional. Defaults to None.
+        The HDF5 chunk shape in dataset axis order.
+        None uses (1, 65536) for "channel" and (16384, channels) for "time".
+    compressor : str or None, optional. Defaults to "gzip".
+        See get_compression.
+    level : int, optional. Defaults to 4.
+        See get_compression.
+    workers : int, optional. Defaults to None.
+        The number of pool threads, None for the CPU count.
+    verbose : bool, optional. Defaults to True.
+        Whether to print the throughput.
+
+    Returns
+    -------
+    dict
+        The bytes exported, the time taken and MB/s.
+
+    """
+    if layout not in ("channel", "time"):
+        raise ValueError("Unsupported layout {}".format(layout))
+    info = init_info()
+    channels = parse_channels(channels, info)
+    packets = memmap_packets(in_location, info)
+    total_samples = info["samples_per_chunk"] * len(packets)
+    if layout == "channel":
+        shape = (len(channels), total_samples)
+        default_chunks = (1, 65536)
+        time_axis = 1
+    else:
+        shape = (total_samples, len(channels))
+        default_chunks = (16384, len(channels))
+        time_axis = 0
+    if chunk_shape is None:
+        chunk_shape = default_chunks
+    chunk_shape = tuple(
+        max(1, min(c, s)) for c, s in zip(chunk_shape, shape))
+    filter_kwargs, compress = get_compression(compressor, level)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    block_samples = chunk_shape[time_axis]
+    if compress is None:
+        # h5py compresses in the writer, so hand it bigger blocks
+        block_samples *= max(1, 1048576 // block_samples)
+
+    start_time = time()
+    with h5py.File(out_location, mode="w", libver="latest") as hdf5_file:
+        dset = hdf5_file.create_dataset(
+            "samples", shape, np.int16, chunks=chunk_shape,
+            **filter_kwargs)
+        dset.attrs["channel_list"] = channels
+        dset.attrs["layout"] = layout
+        dset.attrs["total_samples"] = total_samples
+        work = partial(
+            _prepare_block, packets, channels, info, layout=layout,
+            chunk_shape=chunk_shape, compress=compress)
+        starts = range(0, total_samples, block_samples)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Bound the blocks in flight to keep memory use fixed
+            pending = deque()
+            for start in starts:
+                stop = min(start + block_samples, total_samples)
+                pending.append(pool.submit(work, start, stop))
+                if len(pending) >= 2 * workers:
+                    _write_prepared(
+                        dset, pending.popleft().result(), time_axis)
+            while pending:
+                _write_prepared(dset, pending.popleft().result(), time_axis)
+
+    elapsed = time() - start_time
+    total_bytes = 2 * total_samples * len(channels)
+    rate = total_bytes / (1024 * 1024 * max(elapsed, 1e-9))
+    if verbose:
+        print(
+            "Exported {:.2f}MB to {} in {:.2f} seconds at {:.2f}MB/s".format(
+                total_bytes / (1024 * 1024), out_location, elapsed, rate))
+    return {"bytes": total_bytes, "seconds": elapsed, "MB/s": rate}
+
+
 def log_exception(ex, more_info=""):
     """
     Log an expection and additional info
@@ -1,13 +1,10 @@
-import numpy as np
+from axona_raw_file import AxonaRawFile
 
 
 def read_shuff_bin(location, channel=0):
-    data = np.memmap(location, dtype="int16", offset=16, mode="r")
-    num_chans = 64
-    one_channel_len = int(data.size / num_chans)
-    start_idx = channel * one_channel_len
-    end_idx = start_idx + one_channel_len
-    one_channel = data[start_idx:end_idx]
+    raw_file = AxonaRawFile(location)
+    one_channel = raw_file.read_samples(0, None, channel)
+    one_channel_len = one_channel.size
     print(one_channel[:16])
     with open(location[:-4] + "_" + str(channel + 1) + ".txt", "w") as f:
         for i in range(one_channel_len):
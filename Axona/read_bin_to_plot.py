@@ -3,6 +3,8 @@ import matplotlib.pyplot as plt
 import math
 import os
 
+from axona_raw_file import AxonaRawFile
+
 
 def int16toint8(value):
     """Converts int16 data to int8"""
@@ -13,25 +15,12 @@ def int16toint8(value):
     return value
 
 def read_shuff_bin(location, channels=[0], times=[1], fname="fig.png"):
-    bytes_size = os.path.getsize(location)
-    one_channel_len = int((bytes_size - 16) / 128)
-    num_chans = 64
-    data = np.memmap(
-        location, dtype="int16", offset=16, mode="r", 
-        shape=(num_chans, one_channel_len))
+    raw_file = AxonaRawFile(location)
     ts = np.arange(0, 1, 0.02)
-    out_data = np.zeros(
-        shape=(len(channels), len(times), len(ts)), dtype=np.int16)
     s_back = 10
-    s_forward = 40
-
-    for i, channel in enumerate(channels):
-        for j, time in enumerate(times):
-            s_mid = int(time * 48000)
-            start_idx = s_mid - s_back
-            end_idx = start_idx + len(ts)
-            one_channel = data[channel, start_idx:end_idx]
-            out_data[i][j] = one_channel
+    s_forward = len(ts) - s_back
+    out_data = raw_file.extract_snippets(
+        times, channels, s_back, s_forward).transpose(1, 0, 2)
     fig, axes = plt.subplots(len(channels), figsize=(5, 10))
     for row, ax in zip(out_data, axes):
         # row = np.average(row, axis=0)
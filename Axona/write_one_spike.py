@@ -1,8 +1,9 @@
 import numpy as np
 import os
-import struct
 import matplotlib.pyplot as plt
 
+from axona_raw_file import AxonaRawFile, tetrode_channels
+
 
 def int16toint8(value):
     """Converts int16 data to int8"""
@@ -13,28 +14,16 @@ def int16toint8(value):
     return value
 
 
-def read_shuff_bin(location, tetrode=0):
-    data = np.memmap(location, dtype="int16", offset=16, mode="r")
-    num_chans = 64
-    one_channel_len = int(data.size / num_chans)
-    out_data = np.zeros(shape=(4, one_channel_len))
-    for i in range(4):
-        channel = (tetrode - 1) * 4 + i
-        start_idx = channel * one_channel_len
-        end_idx = start_idx + one_channel_len
-        out_data[i] = data[start_idx:end_idx]
-    return out_data
-
-
-def get_one_spike(data, time, plot=True):
+def get_one_spike(raw_file, tetrode, time, plot=True):
     pre_spike_samps = 10
     post_spike_samps = 40
     print("Saving a spike at {}s".format(time))
-    sample_idx = int(time * 48000)
+    sample_idx = raw_file.time_to_sample(time)
     print("Recalculated spike time is:")
-    print((data.size / (4 * 48000)) * (sample_idx / (data.size / 4)))
-    s_data = data[:, sample_idx -
-                  pre_spike_samps:sample_idx + post_spike_samps]
+    print(sample_idx / raw_file.sample_rate)
+    s_data = raw_file.extract_snippets(
+        [time], tetrode_channels(tetrode),
+        pre_spike_samps, post_spike_samps)[0]
     if plot:
         fig, axes = plt.subplots(4, figsize=(5, 10))
         ts = np.arange(0, 1, 0.02)
@@ -60,90 +49,148 @@ def get_set_header(set_filename):
     return header
 
 
-def write_tetrode(filepath, data, Fs):
-
-    session_path, session_filename = os.path.split(filepath)
-    tint_basename = os.path.splitext(session_filename)[0]
-    set_filename = os.path.join(session_path, '%s.set' % tint_basename)
+def get_spike_dtype(samples_per_spike=50):
+    """The dtype of one channel of one spike in an Axona tetrode file."""
+    return np.dtype([
+        ("timestamp", ">i4"),
+        ("waveform", "i1", (samples_per_spike,))])
 
-    n = len(data)
 
+def make_tetrode_header(
+        set_filename, num_spikes, Fs, timebase=96000,
+        samples_per_spike=50, num_chans=4):
+    """Build the text header of a tetrode file from the set file."""
     header = get_set_header(set_filename)
-
-    with open(filepath, 'w') as f:
-        num_chans = 'num_chans 4'
-        timebase_head = '\ntimebase %d hz' % (96000)
-        bp_timestamp = '\nbytes_per_timestamp %d' % (4)
-        # samps_per_spike = '\nsamples_per_spike %d' % (int(Fs*1e-3))
-        samps_per_spike = '\nsamples_per_spike %d' % (50)
-        sample_rate = '\nsample_rate %d hz' % (Fs)
-        b_p_sample = '\nbytes_per_sample %d' % (1)
-        # b_p_sample = '\nbytes_per_sample %d' % (4)
-        spike_form = '\nspike_format t,ch1,t,ch2,t,ch3,t,ch4'
-        num_spikes = '\nnum_spikes %d' % (n)
-        start = '\ndata_start'
-
-        write_order = [header, num_chans, timebase_head,
-                       bp_timestamp,
-                       samps_per_spike, sample_rate, b_p_sample, spike_form, num_spikes, start]
-
-        f.writelines(write_order)
-
-    # rearranging the data to have a flat array of t1, waveform1, t2, waveform2, t3, waveform3, etc....
-    spike_times = np.asarray(sorted(data.keys())) * 96000
-
-    # the spike times are repeated for each channel so lets tile this
-    spike_times = np.tile(spike_times, (4, 1))
-    spike_times = spike_times.flatten(order='F')
-    print(spike_times)
-
-    spike_values = np.asarray([value for (key, value) in sorted(data.items())])
-
-    # create the 4nx50 channel data matrix
-    spike_values = spike_values.reshape((n * 4, 50))
-
-    # make the first column the time values
-    spike_array = np.hstack(
-        (spike_times.reshape(len(spike_times), 1), spike_values))
-    print(spike_array)
-
-    data = None
-    spike_times = None
-    spike_values = None
-
-    spike_n = spike_array.shape[0]
-
-    t_packed = struct.pack('>%di' % spike_n, *spike_array[:, 0].astype(int))
-    # removing time data from this matrix to save memory
-    spike_array = spike_array[:, 1:]
-
-    spike_data_pack = struct.pack(
-        '<%db' % (spike_n * 50), *spike_array.astype(int).flatten())
-
-    spike_array = None
-
-    # now we need to combine the lists by alternating
-
-    comb_list = [None] * (2 * spike_n)
-    comb_list[::2] = [t_packed[i:i + 4]
-                      for i in range(0, len(t_packed), 4)]  # breaks up t_packed into a list,
-    # each timestamp is one 4 byte integer
-    comb_list[1::2] = [spike_data_pack[i:i + 50]
-                       for i in range(0, len(spike_data_pack), 50)]  # breaks up spike_data_
-    # pack and puts it into a list, each spike is 50 one byte integers
-
-    t_packed = None
-    spike_data_pack = None
-
-    write_order = []
+    spike_form = ",".join(
+        "t,ch{}".format(i + 1) for i in range(num_chans))
+    lines = [
+        "num_chans %d" % (num_chans),
+        "timebase %d hz" % (timebase),
+        "bytes_per_timestamp %d" % (4),
+        "samples_per_spike %d" % (samples_per_spike),
+        "sample_rate %d hz" % (Fs),
+        "bytes_per_sample %d" % (1),
+        "spike_format %s" % (spike_form),
+        "num_spikes %d" % (num_spikes),
+        "data_start"]
+    header = header.replace("\r\n", "\n").replace("\n", "\r\n")
+    return header + "\r\n".join(lines)
+
+
+def write_tetrode_spikes(
+        filepath, times, waveforms, Fs, timebase=96000, set_filename=None):
+    """
+    Write many spikes to an Axona tetrode file in one go.
+
+    Parameters
+    ----------
+    filepath : str
+        The tetrode file to write, such as session.3
+    times : array like
+        The spike times in seconds, shape (spikes,).
+    waveforms : array like
+        The int8 range waveforms, shape (spikes, channels, samples).
+    Fs : int
+        The sampling rate of the waveforms.
+    timebase : int, optional. Defaults to 96000.
+        The timestamp clock rate.
+    set_filename : str, optional. Defaults to None.
+        The set file to copy the header from,
+        None uses the set file next to filepath.
+
+    Returns
+    -------
+    None
+
+    """
+    if set_filename is None:
+        set_filename = os.path.splitext(filepath)[0] + ".set"
+    times = np.asarray(times, dtype=np.float64)
+    waveforms = np.asarray(waveforms)
+    num_spikes, num_chans, samples_per_spike = waveforms.shape
+    order = np.argsort(times, kind="stable")
+
+    spikes = np.empty(
+        (num_spikes, num_chans), dtype=get_spike_dtype(samples_per_spike))
+    spikes["timestamp"] = (times[order] * timebase).astype(np.int64)[:, None]
+    spikes["waveform"] = np.clip(waveforms[order], -128, 127)
+
+    header = make_tetrode_header(
+        set_filename, num_spikes, Fs, timebase, samples_per_spike, num_chans)
     print("Writing tetrode data to {}".format(filepath))
-    with open(filepath, 'rb+') as f:
+    with open(filepath, "wb") as f:
+        f.write(header.encode("latin-1"))
+        spikes.tofile(f)
+        f.write(bytes("\r\ndata_end\r\n", "utf-8"))
+
+
+def merge_units(units):
+    """
+    Combine per unit spikes into one time ordered set of spikes.
+
+    Parameters
+    ----------
+    units : dict
+        unit number to a tuple of (times, waveforms).
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray)
+        The times, waveforms and unit number of every spike.
+
+    """
+    unit_nums = list(units.keys())
+    times = np.concatenate([np.asarray(units[u][0]) for u in unit_nums])
+    waveforms = np.concatenate([np.asarray(units[u][1]) for u in unit_nums])
+    labels = np.repeat(
+        unit_nums, [len(units[u][0]) for u in unit_nums])
+    order = np.argsort(times, kind="stable")
+    return times[order], waveforms[order], labels[order]
+
+
+def write_all_tetrodes(base_location, tetrode_data, Fs, timebase=96000):
+    """
+    Write the .1 to .16 tetrode files of a session.
+
+    Parameters
+    ----------
+    base_location : str
+        The session path without an extension, the set file is
+        base_location + ".set"
+    tetrode_data : dict
+        tetrode number to either a tuple of (times, waveforms) or to
+        a dict of unit number to (times, waveforms).
+    Fs : int
+        The sampling rate of the waveforms.
+    timebase : int, optional. Defaults to 96000.
+        The timestamp clock rate.
+
+    Returns
+    -------
+    dict
+        tetrode number to the unit number of each spike in file order,
+        only for tetrodes given per unit.
+
+    """
+    set_filename = base_location + ".set"
+    unit_labels = {}
+    for tetrode, data in tetrode_data.items():
+        if isinstance(data, dict):
+            times, waveforms, labels = merge_units(data)
+            unit_labels[tetrode] = labels
+        else:
+            times, waveforms = data
+        write_tetrode_spikes(
+            "{}.{}".format(base_location, tetrode), times, waveforms,
+            Fs, timebase, set_filename)
+    return unit_labels
 
-        write_order.extend(comb_list)
-        write_order.append(bytes('\r\ndata_end\r\n', 'utf-8'))
 
-        f.seek(0, 2)
-        f.writelines(write_order)
+def write_tetrode(filepath, data, Fs):
+    """Write a dictionary of spike time to waveform to a tetrode file."""
+    times = sorted(data.keys())
+    waveforms = np.asarray([data[t] for t in times])
+    write_tetrode_spikes(filepath, times, waveforms, Fs)
 
 
 def plot_one_spike(spike_data, fname="tet.png"):
@@ -160,9 +207,9 @@ def plot_one_spike(spike_data, fname="tet.png"):
     plt.savefig(fname, dpi=200)
 
 
-def main(location, tetrode=0, time=1):
-    data = read_shuff_bin(location, tetrode)
-    spike_data = get_one_spike(data, time)
+def main(location, tetrode=1, time=1):
+    raw_file = AxonaRawFile(location)
+    spike_data = get_one_spike(raw_file, tetrode, time)
     out_loc = location[:-4] + "." + str(tetrode)
     write_tetrode(out_loc, spike_data, 48000)
     plot_one_spike(spike_data)
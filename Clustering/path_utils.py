@@ -1,6 +1,11 @@
 """Path related utility functions."""
 import os
-import re
+import sys
+
+# The file index is shared with the Generic and OSF scripts
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Generic"))
+from file_index import get_all_files_in_dir, FileIndex
 
 
 def make_path_if_not_exists(fname):
@@ -40,85 +45,3 @@ def has_ext(filename, ext, case_sensitive_ext=False):
         return filename[-len(ext):] == ext
     else:
         return filename[-len(ext):].lower() == ext.lower()
-
-
-def get_all_files_in_dir(
-        in_dir, ext=None, return_absolute=True,
-        recursive=False, verbose=False, re_filter=None,
-        case_sensitive_ext=False):
-    """
-    Get all files in the directory with the given extensions.
-
-    Parameters
-    ----------
-    in_dir : str
-        The absolute path to the directory
-    ext : str, optional. Defaults to None.
-        The extension of files to get.
-    return_absolute : bool, optional. Defaults to True.
-        Whether to return the absolute filename or not.
-    recursive: bool, optional. Defaults to False.
-        Whether to recurse through directories.
-    verbose: bool, optional. Defaults to False.
-        Whether to print the files found.
-    re_filter: str, optional. Defaults to None
-        a regular expression used to filter the results
-    case_sensitive_ext: bool, optional. Defaults to False,
-        Whether to match the case of the file extension
-
-    Returns
-    -------
-    List
-        A list of filenames with the given parameters.
-
-    """
-    if not os.path.isdir(in_dir):
-        print("Non existant directory " + str(in_dir))
-        return []
-
-    def match_filter(f):
-        if re_filter is None:
-            return True
-        search_res = re.search(re_filter, f)
-        return search_res is not None
-
-    def ok_file(root_dir, f):
-        return (
-            has_ext(f, ext, case_sensitive_ext=case_sensitive_ext) and
-            os.path.isfile(os.path.join(root_dir, f)) and match_filter(f))
-
-    def convert_to_path(root_dir, f):
-        return os.path.join(root_dir, f) if return_absolute else f
-
-    if verbose:
-        print("Adding following files from {}".format(in_dir))
-
-    if recursive:
-        onlyfiles = []
-        for root, _, filenames in os.walk(in_dir):
-            start_root = root[:len(in_dir)]
-
-            if len(root) == len(start_root):
-                end_root = ""
-            else:
-                end_root = root[len(in_dir + os.sep):]
-            for filename in filenames:
-                filename = os.path.join(end_root, filename)
-                if ok_file(start_root, filename):
-                    to_add = convert_to_path(start_root, filename)
-                    if verbose:
-                        print(to_add)
-                    onlyfiles.append(to_add)
-
-    else:
-        onlyfiles = [
-            convert_to_path(in_dir, f) for f in sorted(os.listdir(in_dir))
-            if ok_file(in_dir, f)
-        ]
-        if verbose:
-            for f in onlyfiles:
-                print(f)
-
-    if verbose:
-        print()
-    return onlyfiles
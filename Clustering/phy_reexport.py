@@ -0,0 +1,242 @@
+"""
+Re-curate a phy export without sorting or exporting again.
+
+The first time a phy folder is re-curated, the arrays of the full
+export are copied to phy_folder/export_cache. Every curation after that
+filters the cached arrays down to the kept units, so a unit removed by
+one curation can come back in a later, looser one, and nothing is
+recomputed. Cluster ids are unchanged, templates are renumbered.
+
+This replaces the arrays phy reads, so run it before manual curation.
+"""
+import os
+import json
+import shutil
+
+import numpy as np
+
+# Arrays with one row per spike
+SPIKE_ARRAYS = (
+    "spike_times", "spike_clusters", "spike_templates", "amplitudes",
+    "pc_features")
+
+# Arrays with one row per template, similar_templates also has a column
+TEMPLATE_ARRAYS = (
+    "templates", "template_ind", "pc_feature_ind", "similar_templates")
+
+
+def get_cache_dir(phy_dir):
+    """The folder the full export is kept in."""
+    return os.path.join(phy_dir, "export_cache")
+
+
+def clear_phy_cache(phy_dir):
+    """Remove the cached full export, needed before a new export."""
+    cache_dir = get_cache_dir(phy_dir)
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+
+def _cached_files(phy_dir):
+    names = [name + ".npy" for name in SPIKE_ARRAYS + TEMPLATE_ARRAYS]
+    names += [
+        name for name in os.listdir(phy_dir)
+        if name.startswith("cluster_") and name.endswith(".tsv")]
+    return [
+        name for name in names
+        if os.path.isfile(os.path.join(phy_dir, name))]
+
+
+def cache_phy_export(phy_dir):
+    """
+    Copy the full export to the cache if it is not there yet.
+
+    The folder is renamed into place once complete, so a partial
+    copy is never mistaken for the full export.
+    """
+    cache_dir = get_cache_dir(phy_dir)
+    if os.path.isdir(cache_dir):
+        return cache_dir
+    temp_dir = cache_dir + "_tmp"
+    os.makedirs(temp_dir, exist_ok=True)
+    for name in _cached_files(phy_dir):
+        shutil.copy2(os.path.join(phy_dir, name), temp_dir)
+    os.replace(temp_dir, cache_dir)
+    return cache_dir
+
+
+def read_phy_params(phy_dir):
+    """Read the variables in phy_dir/params.py, as phy does."""
+    params = {}
+    with open(os.path.join(phy_dir, "params.py"), "r") as f:
+        exec(f.read(), {}, params)
+    return params
+
+
+def _read_tsv_column(in_loc, column):
+    """Map the cluster_id of each row of a phy tsv to column."""
+    with open(in_loc, "r") as f:
+        rows = [line.split("\t") for line in f.read().splitlines() if line]
+    if not rows or column not in rows[0]:
+        return None
+    idx = rows[0].index(column)
+    return {int(row[0]): row[idx] for row in rows[1:]}
+
+
+def get_cluster_groups(phy_dir, clusters, spike_templates):
+    """
+    Get the channel group (tetrode) of each cluster in an export.
+
+    Read from cluster_channel_group.tsv, which export_to_phy writes
+    when the sorting had groups. Otherwise the group is that of the
+    first channel of each cluster's most common template.
+    Returns None if neither is available.
+    """
+    cache_dir = get_cache_dir(phy_dir)
+    tsv_loc = os.path.join(cache_dir, "cluster_channel_group.tsv")
+    if os.path.isfile(tsv_loc):
+        groups = _read_tsv_column(tsv_loc, "ch_group")
+        if groups is not None:
+            return {c: int(g) for c, g in groups.items()}
+
+    template_loc = os.path.join(cache_dir, "template_ind.npy")
+    channel_groups_loc = os.path.join(phy_dir, "channel_groups.npy")
+    if not (os.path.isfile(template_loc) and
+            os.path.isfile(channel_groups_loc)):
+        return None
+    template_ind = np.load(template_loc)
+    channel_groups = np.load(channel_groups_loc).ravel()
+    groups = {}
+    for cluster in np.unique(clusters):
+        templates = spike_templates[clusters == cluster]
+        template = np.bincount(templates).argmax()
+        groups[int(cluster)] = int(channel_groups[template_ind[template, 0]])
+    return groups
+
+
+def load_cached_sorting(phy_dir, sampling_frequency=None):
+    """
+    Load the full sorting of a phy export as a NumpySortingExtractor.
+
+    Unit ids are the phy cluster ids, and each unit has the "group"
+    property where it can be found, see get_cluster_groups.
+    The sampling frequency defaults to sample_rate in params.py.
+    """
+    import spikeinterface.extractors as se
+    cache_dir = cache_phy_export(phy_dir)
+    if sampling_frequency is None:
+        sampling_frequency = float(read_phy_params(phy_dir)["sample_rate"])
+    times = np.load(os.path.join(cache_dir, "spike_times.npy")).ravel()
+    clusters = np.load(os.path.join(cache_dir, "spike_clusters.npy")).ravel()
+    spike_templates = np.load(
+        os.path.join(cache_dir, "spike_templates.npy")).ravel()
+    sorting = se.NumpySortingExtractor()
+    sorting.set_times_labels(times, clusters)
+    sorting.set_sampling_frequency(sampling_frequency)
+    groups = get_cluster_groups(phy_dir, clusters, spike_templates)
+    if groups is not None:
+        for unit in sorting.get_unit_ids():
+            sorting.set_unit_property(unit, "group", groups[int(unit)])
+    return sorting
+
+
+def _save(out_loc, array):
+    """Save array without phy ever reading a half written file."""
+    temp_loc = out_loc + ".tmp"
+    with open(temp_loc, "wb") as f:
+        np.save(f, array)
+    os.replace(temp_loc, out_loc)
+
+
+def _filter_tsv(in_loc, out_loc, kept):
+    with open(in_loc, "r") as f:
+        lines = f.read().splitlines()
+    rows = [lines[0]] + [
+        line for line in lines[1:]
+        if line and int(line.split("\t")[0]) in kept]
+    with open(out_loc + ".tmp", "w") as f:
+        f.write("\n".join(rows) + "\n")
+    os.replace(out_loc + ".tmp", out_loc)
+
+
+def reexport_phy(phy_dir, unit_ids, verbose=True):
+    """
+    Rewrite a phy folder to only show unit_ids from the full export.
+
+    Parameters
+    ----------
+    phy_dir : str
+        The folder written by export_to_phy.
+    unit_ids : list of int
+        The phy cluster ids to keep.
+    verbose : bool, optional. Defaults to True.
+        Whether to print what was rewritten.
+
+    Returns
+    -------
+    dict
+        The number of units, spikes and templates kept and whether
+        anything was rewritten.
+
+    """
+    cache_dir = cache_phy_export(phy_dir)
+    kept = sorted(int(u) for u in unit_ids)
+    curation_loc = os.path.join(cache_dir, "curation.json")
+    if os.path.isfile(curation_loc):
+        with open(curation_loc, "r") as f:
+            previous = json.load(f)
+        if previous["unit_ids"] == kept:
+            if verbose:
+                print("Curation of {} is unchanged".format(phy_dir))
+            previous["rewritten"] = False
+            return previous
+
+    clusters = np.load(os.path.join(cache_dir, "spike_clusters.npy"))
+    spike_mask = np.isin(clusters.ravel(), kept)
+    spike_templates = np.load(
+        os.path.join(cache_dir, "spike_templates.npy")).ravel()
+    kept_templates = np.unique(spike_templates[spike_mask])
+    num_templates = np.load(
+        os.path.join(cache_dir, "templates.npy"), mmap_mode="r").shape[0]
+    remap = np.full(num_templates, -1, dtype=spike_templates.dtype)
+    remap[kept_templates] = np.arange(len(kept_templates))
+
+    for name in SPIKE_ARRAYS:
+        in_loc = os.path.join(cache_dir, name + ".npy")
+        if not os.path.isfile(in_loc):
+            continue
+        array = np.load(in_loc, mmap_mode="r")
+        array = np.asarray(array[spike_mask])
+        if name == "spike_templates":
+            array = remap[array]
+        _save(os.path.join(phy_dir, name + ".npy"), array)
+
+    for name in TEMPLATE_ARRAYS:
+        in_loc = os.path.join(cache_dir, name + ".npy")
+        if not os.path.isfile(in_loc):
+            continue
+        array = np.load(in_loc, mmap_mode="r")
+        if name == "similar_templates":
+            array = array[np.ix_(kept_templates, kept_templates)]
+        else:
+            array = array[kept_templates]
+        _save(os.path.join(phy_dir, name + ".npy"), np.asarray(array))
+
+    kept_set = set(kept)
+    for name in os.listdir(cache_dir):
+        if name.startswith("cluster_") and name.endswith(".tsv"):
+            _filter_tsv(
+                os.path.join(cache_dir, name),
+                os.path.join(phy_dir, name), kept_set)
+
+    result = {
+        "unit_ids": kept,
+        "num_spikes": int(spike_mask.sum()),
+        "num_templates": int(len(kept_templates))}
+    with open(curation_loc, "w") as f:
+        json.dump(result, f)
+    if verbose:
+        print("Rewrote {} with {} units and {} spikes".format(
+            phy_dir, len(kept), result["num_spikes"]))
+    result["rewritten"] = True
+    return result
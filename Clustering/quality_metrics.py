@@ -0,0 +1,321 @@
+"""
+Quality metrics of sorted units from one shared waveform extraction.
+
+The waveforms of every unit are extracted once, and the SNR, ISI
+violation ratio, firing rate, amplitude cutoff and isolation distance
+are all computed from them with numpy. The results are saved to a csv
+table, which can be curated by threshold without loading the recording.
+The table is keyed by a hash of the spike trains, so a new sort into
+the same folder never reuses the metrics of the last one.
+"""
+import os
+import csv
+import json
+import hashlib
+
+import numpy as np
+
+METRIC_NAMES = (
+    "num_spikes", "firing_rate", "snr", "isi_violation",
+    "amplitude_cutoff", "isolation_distance")
+
+
+def estimate_noise_levels(recording, num_chunks=20, chunk_size=10000,
+                          seed=0):
+    """
+    Estimate the noise of each channel from random chunks of traces.
+
+    Uses the median absolute deviation / 0.6745, which is robust to
+    the spikes in the chunks.
+    """
+    num_frames = recording.get_num_frames()
+    chunk_size = min(chunk_size, num_frames)
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(
+        0, max(num_frames - chunk_size, 0) + 1, size=num_chunks)
+    traces = np.concatenate([
+        np.asarray(recording.get_traces(
+            start_frame=int(s), end_frame=int(s) + chunk_size))
+        for s in starts], axis=1).astype(np.float64)
+    median = np.median(traces, axis=1, keepdims=True)
+    return np.median(np.abs(traces - median), axis=1) / 0.6745
+
+
+def isi_violation(spike_train, duration, sampling_frequency,
+                  isi_threshold=0.0015, min_isi=0.0):
+    """
+    The rate of refractory period violations relative to chance.
+
+    As in Hill et al. (2011), values above 1 mean the unit is very
+    likely contaminated.
+    """
+    num_spikes = len(spike_train)
+    if num_spikes < 2:
+        return np.nan
+    isis = np.diff(np.sort(spike_train)) / sampling_frequency
+    num_violations = np.count_nonzero(isis < isi_threshold)
+    violation_time = 2 * num_spikes * (isi_threshold - min_isi)
+    total_rate = num_spikes / duration
+    return (num_violations / violation_time) / total_rate
+
+
+def amplitude_cutoff(amplitudes, num_bins=100, smooth_bins=3):
+    """
+    The fraction of spikes estimated to be missing below threshold.
+
+    Assumes the amplitude distribution is symmetric about its peak,
+    capped at 0.5 as the estimate is unreliable beyond that.
+    """
+    if len(amplitudes) < 2 * smooth_bins:
+        return np.nan
+    pdf, edges = np.histogram(amplitudes, num_bins, density=True)
+    x = np.arange(-3 * smooth_bins, 3 * smooth_bins + 1)
+    kernel = np.exp(-0.5 * (x / smooth_bins) ** 2)
+    pdf = np.convolve(
+        np.pad(pdf, len(x) // 2, mode="reflect"), kernel / kernel.sum(),
+        mode="valid")
+    bin_size = edges[1] - edges[0]
+    peak = np.argmax(pdf)
+    cutoff = np.argmin(np.abs(pdf[peak:] - pdf[0])) + peak
+    return min(np.sum(pdf[cutoff:]) * bin_size, 0.5)
+
+
+def isolation_distances(features, labels):
+    """
+    The isolation distance of each label in the feature space.
+
+    The squared Mahalanobis distance, from the unit's cluster, of the
+    nth closest spike of the other units, where n is the number of
+    spikes in the unit. NaN if there are fewer other spikes than that.
+    """
+    distances = {}
+    for label in np.unique(labels):
+        inside = labels == label
+        n = np.count_nonzero(inside)
+        if n <= features.shape[1] or np.count_nonzero(~inside) < n:
+            distances[label] = np.nan
+            continue
+        unit = features[inside]
+        inv_cov = np.linalg.pinv(np.cov(unit, rowvar=False))
+        diff = features[~inside] - unit.mean(axis=0)
+        mahal = np.einsum("ij,jk,ik->i", diff, inv_cov, diff)
+        distances[label] = np.partition(mahal, n - 1)[n - 1]
+    return distances
+
+
+def pca_features(waveforms, num_components=3):
+    """Project (spikes, channels, samples) onto the top PCs per channel."""
+    features = []
+    for i in range(waveforms.shape[1]):
+        data = waveforms[:, i, :] - waveforms[:, i, :].mean(axis=0)
+        _, _, vt = np.linalg.svd(data, full_matrices=False)
+        features.append(data @ vt[:num_components].T)
+    return np.concatenate(features, axis=1)
+
+
+def get_unit_groups(sorting, unit_ids):
+    """The group property of each unit, which every unit must have."""
+    groups = []
+    for unit in unit_ids:
+        try:
+            groups.append(sorting.get_unit_property(unit, "group"))
+        except Exception:
+            raise ValueError(
+                "Unit {} has no group property, needed to measure "
+                "isolation on its tetrode".format(unit))
+    return groups
+
+
+def compute_quality_metrics(
+        recording, sorting, ms_before=0.2, ms_after=0.8,
+        max_spikes_per_unit=500, isi_threshold=0.0015, verbose=True):
+    """
+    Compute the quality metrics of every unit.
+
+    Parameters
+    ----------
+    recording : RecordingExtractor
+        The filtered recording the units were sorted from, with the
+        probe loaded so each channel has its group.
+    sorting : SortingExtractor
+        The units, each with the "group" property of its tetrode.
+    ms_before : float, optional. Defaults to 0.2.
+        The waveform window before each spike.
+    ms_after : float, optional. Defaults to 0.8.
+        The waveform window after each spike.
+    max_spikes_per_unit : int, optional. Defaults to 500.
+        The waveforms extracted per unit, shared by every metric.
+    isi_threshold : float, optional. Defaults to 0.0015.
+        The refractory period in seconds.
+    verbose : bool, optional. Defaults to True.
+        Whether to print the progress.
+
+    Returns
+    -------
+    dict
+        "unit_id" and each of METRIC_NAMES mapped to a list per unit.
+
+    """
+    import spikeinterface.toolkit as st
+    unit_ids = list(sorting.get_unit_ids())
+    fs = recording.get_sampling_frequency()
+    duration = recording.get_num_frames() / fs
+    noise = estimate_noise_levels(recording)
+    channel_index = {
+        c: i for i, c in enumerate(recording.get_channel_ids())}
+    if verbose:
+        print("Extracting waveforms of {} units for metrics".format(
+            len(unit_ids)))
+    waveforms = st.postprocessing.get_unit_waveforms(
+        recording, sorting, unit_ids=unit_ids, ms_before=ms_before,
+        ms_after=ms_after, max_spikes_per_unit=max_spikes_per_unit,
+        save_as_features=False, verbose=False)
+    groups = get_unit_groups(sorting, unit_ids)
+
+    table = {name: [] for name in ("unit_id",) + METRIC_NAMES}
+    features, labels = {}, {}
+    for unit, wf, group in zip(unit_ids, waveforms, groups):
+        wf = np.asarray(wf, dtype=np.float64)
+        train = np.asarray(sorting.get_unit_spike_train(unit_id=unit))
+        # Each unit is measured on the channel of its largest peak
+        template = wf.mean(axis=0)
+        best = np.argmax(np.max(np.abs(template), axis=1))
+        peak = np.argmax(np.abs(template[best]))
+        amplitudes = np.abs(wf[:, best, peak])
+        best_channel = recording.get_channel_ids()[best]
+
+        table["unit_id"].append(unit)
+        table["num_spikes"].append(len(train))
+        table["firing_rate"].append(len(train) / duration)
+        table["snr"].append(
+            np.abs(template[best, peak]) / noise[channel_index[best_channel]])
+        table["isi_violation"].append(
+            isi_violation(train, duration, fs, isi_threshold))
+        table["amplitude_cutoff"].append(amplitude_cutoff(amplitudes))
+        features.setdefault(group, []).append(wf)
+        labels.setdefault(group, []).append(np.full(len(wf), unit))
+
+    # Isolation is measured against the other units on the same tetrode
+    isolation = {}
+    channel_groups = np.asarray(recording.get_channel_groups())
+    for group in features:
+        group_wf = np.concatenate(features[group])
+        on_group = channel_groups == group
+        if not on_group.any():
+            raise ValueError(
+                "No channels in group {}, the recording needs the probe "
+                "loaded to measure isolation per tetrode".format(group))
+        group_wf = group_wf[:, on_group]
+        isolation.update(isolation_distances(
+            pca_features(group_wf), np.concatenate(labels[group])))
+    table["isolation_distance"] = [isolation[u] for u in unit_ids]
+    return table
+
+
+def get_sorting_key(sorting):
+    """A hash of the unit ids and spike trains of a sorting."""
+    digest = hashlib.blake2b()
+    for unit in sorting.get_unit_ids():
+        train = np.asarray(
+            sorting.get_unit_spike_train(unit_id=unit), dtype=np.int64)
+        digest.update(np.int64(unit).tobytes())
+        digest.update(np.int64(len(train)).tobytes())
+        digest.update(train.tobytes())
+    return digest.hexdigest()
+
+
+def get_key_loc(metrics_loc):
+    """The json next to a metrics table keeping its sorting key."""
+    return os.path.splitext(metrics_loc)[0] + "_key.json"
+
+
+def save_metrics(table, out_loc, sorting_key=None):
+    """Save a metrics table to csv, and the key of its sorting."""
+    names = list(table.keys())
+    with open(out_loc, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        writer.writerows(zip(*[table[name] for name in names]))
+    if sorting_key is not None:
+        with open(get_key_loc(out_loc), "w") as f:
+            json.dump({"sorting_key": sorting_key}, f)
+
+
+def metrics_match(metrics_loc, sorting):
+    """Whether the table at metrics_loc was computed for sorting."""
+    key_loc = get_key_loc(metrics_loc)
+    if not (os.path.isfile(metrics_loc) and os.path.isfile(key_loc)):
+        return False
+    with open(key_loc, "r") as f:
+        saved_key = json.load(f).get("sorting_key")
+    return saved_key == get_sorting_key(sorting)
+
+
+def load_metrics(in_loc):
+    """Load a metrics table saved by save_metrics."""
+    with open(in_loc, "r", newline="") as f:
+        reader = csv.reader(f)
+        names = next(reader)
+        columns = list(zip(*reader)) or [[] for _ in names]
+    table = {}
+    for name, column in zip(names, columns):
+        converted = [float(v) for v in column]
+        if name in ("unit_id", "num_spikes"):
+            converted = [int(v) for v in converted]
+        table[name] = converted
+    return table
+
+
+def curate_by_metrics(table, thresholds):
+    """
+    Get the units passing every threshold in a metrics table.
+
+    Parameters
+    ----------
+    table : dict
+        From compute_quality_metrics or load_metrics.
+    thresholds : dict
+        Metric name to ("min" or "max", value). For example
+        {"snr": ("min", 5), "isi_violation": ("max", 0.5)}.
+        Units with a NaN metric pass that threshold.
+
+    Returns
+    -------
+    list
+        The unit ids to keep.
+
+    """
+    keep = np.ones(len(table["unit_id"]), dtype=bool)
+    for name, (kind, value) in thresholds.items():
+        metric = np.asarray(table[name], dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            if kind == "min":
+                failed = metric < value
+            elif kind == "max":
+                failed = metric > value
+            else:
+                raise ValueError("Unsupported threshold {}".format(kind))
+        keep &= ~failed
+    return [u for u, k in zip(table["unit_id"], keep) if k]
+
+
+def get_metrics(recording, sorting, metrics_loc=None, verbose=True,
+                **kwargs):
+    """
+    Load the metrics table at metrics_loc if it matches the sorting.
+
+    Otherwise compute it, and save it to metrics_loc if given.
+    A saved table matches if it was computed from the same spike
+    trains, see get_sorting_key.
+    """
+    if metrics_loc is not None and metrics_match(metrics_loc, sorting):
+        if verbose:
+            print("Loaded quality metrics from {}".format(metrics_loc))
+        return load_metrics(metrics_loc)
+    table = compute_quality_metrics(
+        recording, sorting, verbose=verbose, **kwargs)
+    if metrics_loc is not None:
+        save_metrics(table, metrics_loc, get_sorting_key(sorting))
+        if verbose:
+            print("Saved quality metrics to {}".format(metrics_loc))
+    return table
@@ -0,0 +1,195 @@
+"""Build the recordings used by the sorting pipeline."""
+import os
+import json
+import hashlib
+
+import spikeinterface.extractors as se
+import spikeinterface.toolkit as st
+import numpy as np
+
+
+def make_recording_spec(
+        location, probe_loc, transposed=False, remove_last_chan=False,
+        freq_min=300, freq_max=6000, cache_dir=None, cache_dtype="float32"):
+    """
+    Describe how to build the preprocessed recording.
+
+    The spec is a plain dict, so it can be sent to worker processes,
+    which rebuild the same lazy recording with build_recording.
+    If cache_dir is not None, the preprocessed recording is written
+    there once as cache_dtype binary and memory mapped afterwards.
+    """
+    return {
+        "location": location,
+        "probe_loc": probe_loc,
+        "transposed": transposed,
+        "remove_last_chan": remove_last_chan,
+        "freq_min": freq_min,
+        "freq_max": freq_max,
+        "cache_dir": cache_dir,
+        "cache_dtype": cache_dtype}
+
+
+def load_recording(spec):
+    """Load the _shuff.bin recording of spec with its probe file."""
+    time_axis = 0 if spec["transposed"] else 1
+    recording = se.BinDatRecordingExtractor(
+        file_path=spec["location"], offset=0, dtype=np.int16,
+        sampling_frequency=48000, numchan=64, time_axis=time_axis)
+    return recording, recording.load_probe_file(spec["probe_loc"])
+
+
+def get_bad_channels(recording):
+    """The last channel of every tetrode, often used for EEG."""
+    return [
+        i for i in range(3, 64, 4)
+        if i in recording.get_channel_ids()]
+
+
+def preprocess_recording(recording_prb, spec, verbose=False):
+    """
+    Bandpass filter the recording and remove the EEG channels.
+
+    Returns
+    -------
+    (RecordingExtractor, int)
+        The preprocessed recording and the channels per tetrode.
+
+    """
+    preproc_recording = st.preprocessing.bandpass_filter(
+        recording_prb, freq_min=spec["freq_min"], freq_max=spec["freq_max"])
+    if not spec["remove_last_chan"]:
+        return preproc_recording, 4
+
+    bad_chans = get_bad_channels(preproc_recording)
+    if verbose:
+        print("Removing {}".format(bad_chans))
+    preproc_recording = st.preprocessing.remove_bad_channels(
+        preproc_recording, bad_channel_ids=bad_chans)
+    if verbose:
+        print('Channel ids after preprocess:',
+              preproc_recording.get_channel_ids())
+        print('Channel groups after preprocess:',
+              preproc_recording.get_channel_groups())
+    return preproc_recording, 3
+
+
+def hash_input(location, sample_bytes=1048576):
+    """
+    Hash the identity of a large input file without reading all of it.
+
+    Uses the size, the modification time and the first and last
+    sample_bytes of the file.
+    """
+    stat = os.stat(location)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update("{} {}".format(stat.st_size, stat.st_mtime_ns).encode())
+    with open(location, "rb") as f:
+        digest.update(f.read(sample_bytes))
+        f.seek(max(stat.st_size - sample_bytes, 0))
+        digest.update(f.read(sample_bytes))
+    return digest.hexdigest()
+
+
+def get_cache_key(spec):
+    """The cache key of the recording from the input and filter params."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(hash_input(spec["location"]).encode())
+    with open(spec["probe_loc"], "rb") as f:
+        digest.update(f.read())
+    params = {
+        k: spec[k] for k in (
+            "transposed", "remove_last_chan", "freq_min", "freq_max",
+            "cache_dtype")}
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def get_cache_locations(spec):
+    """Get the cached binary and its json description for spec."""
+    base = os.path.join(spec["cache_dir"], get_cache_key(spec))
+    return base + ".dat", base + ".json"
+
+
+def write_cached_recording(recording, spec, verbose=True):
+    """
+    Write the preprocessed recording to the cache of spec.
+
+    The json description, with the channel ids and groups, is written
+    last so an interrupted write is never loaded.
+    """
+    dat_loc, json_loc = get_cache_locations(spec)
+    os.makedirs(spec["cache_dir"], exist_ok=True)
+    temp_loc = dat_loc + ".tmp"
+    if verbose:
+        print("Caching the preprocessed recording to {}".format(dat_loc))
+    se.BinDatRecordingExtractor.write_recording(
+        recording, save_path=temp_loc, time_axis=0,
+        dtype=spec["cache_dtype"])
+    os.replace(temp_loc, dat_loc)
+    channel_ids = [int(c) for c in recording.get_channel_ids()]
+    description = {
+        "source": spec["location"],
+        "channel_ids": channel_ids,
+        "groups": [int(g) for g in recording.get_channel_groups()],
+        "locations": [
+            [float(x) for x in loc]
+            for loc in recording.get_channel_locations()],
+        "sampling_frequency": recording.get_sampling_frequency(),
+        "num_frames": int(recording.get_num_frames()),
+        "dtype": spec["cache_dtype"]}
+    with open(json_loc, "w") as f:
+        json.dump(description, f, indent=2)
+
+
+def load_cached_recording(spec):
+    """
+    Memory map the cached recording of spec.
+
+    Returns
+    -------
+    RecordingExtractor or None
+        The recording with the original channel ids and groups,
+        None if it has not been cached.
+
+    """
+    dat_loc, json_loc = get_cache_locations(spec)
+    if not (os.path.isfile(json_loc) and os.path.isfile(dat_loc)):
+        return None
+    with open(json_loc, "r") as f:
+        description = json.load(f)
+    cached = se.BinDatRecordingExtractor(
+        file_path=dat_loc, offset=0, dtype=description["dtype"],
+        sampling_frequency=description["sampling_frequency"],
+        numchan=len(description["channel_ids"]), time_axis=0)
+    recording = se.SubRecordingExtractor(
+        cached, channel_ids=cached.get_channel_ids(),
+        renamed_channel_ids=description["channel_ids"])
+    recording.set_channel_groups(description["groups"])
+    recording.set_channel_locations(description["locations"])
+    return recording
+
+
+def cache_recording(recording, spec, verbose=True):
+    """Load the cached recording of spec, writing it first if missing."""
+    cached = load_cached_recording(spec)
+    if cached is None:
+        write_cached_recording(recording, spec, verbose=verbose)
+        cached = load_cached_recording(spec)
+    elif verbose:
+        print("Using the cached preprocessed recording {}".format(
+            get_cache_locations(spec)[0]))
+    return cached
+
+
+def build_recording(spec):
+    """Build the preprocessed recording described by spec."""
+    if spec.get("cache_dir") is not None:
+        cached = load_cached_recording(spec)
+        if cached is not None:
+            return cached
+    _, recording_prb = load_recording(spec)
+    recording = preprocess_recording(recording_prb, spec)[0]
+    if spec.get("cache_dir") is not None:
+        return cache_recording(recording, spec, verbose=False)
+    return recording
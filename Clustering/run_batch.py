@@ -1,42 +1,188 @@
-import os 
+import os
+import json
+import traceback
 from configparser import ConfigParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from time import time
 
 from run_spike_interface import main_cfg
 from path_utils import get_all_files_in_dir
 
+
+ALREADY_CLUSTERED = "already clustered"
+
+
+def get_out_folders(out_dir, sort_method):
+    """Get the sorting and phy folder names, as in main_cfg."""
+    if out_dir == "default":
+        return "results_" + sort_method, "phy_" + sort_method
+    return out_dir, out_dir + "_phy"
+
+
+def load_ledger(ledger_loc):
+    """Load the batch ledger, a dict of set file to session record."""
+    if not os.path.isfile(ledger_loc):
+        return {}
+    with open(ledger_loc, "r") as f:
+        return json.load(f)
+
+
+def save_ledger(ledger, ledger_loc):
+    """Save the ledger, replacing the old one only once fully written."""
+    temp_loc = ledger_loc + ".tmp"
+    with open(temp_loc, "w") as f:
+        json.dump(ledger, f, indent=2, sort_keys=True)
+    os.replace(temp_loc, ledger_loc)
+
+
+def update_ledger(ledger, ledger_loc, set_file, **record):
+    """Update the record of set_file and save the ledger."""
+    entry = ledger.setdefault(set_file, {})
+    entry.update(record)
+    entry["updated"] = datetime.now().isoformat(timespec="seconds")
+    save_ledger(ledger, ledger_loc)
+
+
+def build_work_list(set_files, ledger, out_folder, phy_out_folder,
+                    overwrite_batch=False):
+    """
+    Decide which sessions to cluster.
+
+    Unless overwrite_batch is True, the ledger decides: a session it
+    marks done is skipped and any other status (failed, pending or
+    skipped) is run again. Sessions not in the ledger, clustered before
+    it existed, are skipped if their sorting and phy folders both exist.
+    Sessions without a .bin file are skipped.
+
+    Returns
+    -------
+    (list, dict)
+        The set files to cluster and the reason each other one is skipped.
+
+    """
+    to_run, skipped = [], {}
+    for set_file in set_files:
+        set_dir = os.path.dirname(set_file)
+        ac_out_folder = os.path.join(set_dir, out_folder)
+        ac_phy_folder = os.path.join(set_dir, phy_out_folder)
+        status = ledger.get(set_file, {}).get("status")
+        if status is None:
+            done = (
+                os.path.isdir(ac_out_folder) and
+                os.path.isdir(ac_phy_folder))
+        else:
+            done = status == "done"
+        if (not overwrite_batch) and done:
+            skipped[set_file] = ALREADY_CLUSTERED
+        elif not os.path.isfile(set_file[:-4] + ".bin"):
+            skipped[set_file] = "no binary file available"
+        else:
+            to_run.append(set_file)
+    return to_run, skipped
+
+
+def config_to_dict(config):
+    """Convert a ConfigParser to a dict that can be sent to a process."""
+    return {section: dict(config[section]) for section in config.sections()}
+
+
+def cluster_session(set_file, config_dict):
+    """
+    Run main_cfg on one session in a worker process.
+
+    Errors are returned rather than raised so one failed session
+    does not stop the batch.
+
+    Returns
+    -------
+    dict
+        The status, wall time and any error of the session.
+
+    """
+    config = ConfigParser()
+    config.read_dict(config_dict)
+    config.set("path", "in_dir", os.path.dirname(set_file))
+    config.set("path", "set_fname", os.path.basename(set_file))
+    start_time = time()
+    try:
+        main_cfg(config)
+        status, error = "done", None
+    except (Exception, SystemExit):
+        status, error = "failed", traceback.format_exc()
+    return {
+        "status": status, "error": error,
+        "seconds": round(time() - start_time, 2), "pid": os.getpid()}
+
+
 def main(location, default_config):
     out_dir = default_config.get("path", "out_foldername")
     sort_method = default_config.get("sorting", "sort_method")
-    overwrite_batch = default_config.get("batch", "overwrite_batch")
+    overwrite_batch = default_config.getboolean("batch", "overwrite_batch")
     regex_filter = default_config.get("batch", "regex_filter")
+    max_workers = default_config.getint("batch", "max_workers", fallback=1)
     if regex_filter == "":
         regex_filter = None
+    out_folder, phy_out_folder = get_out_folders(out_dir, sort_method)
 
-    if out_dir == "default":
-        out_folder = "results_" + sort_method
-        phy_out_folder = "phy_" + sort_method
-
+    ledger_loc = os.path.join(location, "batch_ledger.json")
+    ledger = load_ledger(ledger_loc)
+    # Only folders changed since the last batch are listed again
     set_files = get_all_files_in_dir(
         location, recursive=True, ext=".set", case_sensitive_ext=True,
-        re_filter=regex_filter)
-    with open(os.path.join(location, "output_log_batchclust.txt"), "w") as f:
-        for set_file in set_files:
-            set_dir = os.path.dirname(set_file)
-            ac_out_folder = os.path.join(set_dir, out_folder)
-            ac_phy_folder = os.path.join(set_dir, out_folder)
-            if (
-                (not overwrite_batch) and 
-                os.path.isdir(ac_out_folder) and 
-                os.path.isdir(ac_phy_folder)):
-                f.write("Skipping {} as already clustered\n".format(set_file))
-            elif not os.path.isfile(set_file[:-4] + ".bin"):
-                f.write("Skipping {} as no binary file available\n")
+        re_filter=regex_filter, workers=8,
+        cache_loc=os.path.join(location, "file_index.json"))
+    to_run, skipped = build_work_list(
+        set_files, ledger, out_folder, phy_out_folder, overwrite_batch)
+
+    log_loc = os.path.join(location, "output_log_batchclust.txt")
+    with open(log_loc, "w") as f:
+        for set_file, reason in skipped.items():
+            f.write("Skipping {} as {}\n".format(set_file, reason))
+            if ledger.get(set_file, {}).get("status") == "done":
+                continue
+            # Sessions clustered before the ledger are recorded as done
+            if reason == ALREADY_CLUSTERED:
+                update_ledger(
+                    ledger, ledger_loc, set_file, status="done", error=None)
             else:
+                update_ledger(
+                    ledger, ledger_loc, set_file, status="skipped",
+                    error=reason)
+        for set_file in to_run:
+            update_ledger(
+                ledger, ledger_loc, set_file, status="pending", error=None)
+        print("Clustering {} sessions, {} at a time, skipped {}".format(
+            len(to_run), max_workers, len(skipped)))
+
+        config_dict = config_to_dict(default_config)
+        start_time = time()
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+            for set_file in to_run:
                 f.write("Clustering {}\n".format(set_file))
-                default_config.set("path", "in_dir", set_dir)
-                default_config.set(
-                    "path", "set_fname", os.path.basename(set_file))
-                main_cfg(default_config)
+                futures[pool.submit(
+                    cluster_session, set_file, config_dict)] = set_file
+            for future in as_completed(futures):
+                set_file = futures[future]
+                try:
+                    record = future.result()
+                except Exception:
+                    record = {
+                        "status": "failed", "error": traceback.format_exc()}
+                update_ledger(ledger, ledger_loc, set_file, **record)
+                f.write("Finished {} with status {}\n".format(
+                    set_file, record["status"]))
+                f.flush()
+                print("{} {} in {:.2f}mins".format(
+                    record["status"].capitalize(), set_file,
+                    record.get("seconds", 0) / 60.0))
+
+    statuses = [ledger[set_file]["status"] for set_file in to_run]
+    print("Batch took {:.2f}mins, {} done, {} failed, see {}".format(
+        (time() - start_time) / 60.0, statuses.count("done"),
+        statuses.count("failed"), ledger_loc))
+
 
 if __name__ == "__main__":
     here = os.path.dirname(os.path.abspath(__file__))
@@ -44,4 +190,4 @@ if __name__ == "__main__":
     default_config = ConfigParser()
     default_config.read(config_loc)
     location = default_config.get("batch", "batch_start_dir")
-    main(location, default_config)
\ No newline at end of file
+    main(location, default_config)
@@ -1,7 +1,7 @@
 import os
+import sys
 import subprocess
 import json
-from time import time
 from configparser import ConfigParser
 
 import spikeinterface.extractors as se
@@ -14,6 +14,19 @@ import numpy as np
 
 from channel_map import write_prb_file
 from path_utils import get_all_files_in_dir
+from recording_utils import (
+    make_recording_spec, load_recording, preprocess_recording,
+    cache_recording, build_recording)
+from sort_scheduler import run_sorter_by_group
+from waveform_figures import render_unit_forms
+from stage_timer import StageTimer
+from phy_reexport import clear_phy_cache, load_cached_sorting, reexport_phy
+from quality_metrics import get_metrics, curate_by_metrics, metrics_match
+
+# The raw Axona conversion lives with the other Axona code
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Axona"))
+from axona_binary import convert_axona_binary
 
 
 def list_sorters():
@@ -120,12 +133,22 @@ def get_sort_info(sorting, recording, out_loc):
     fig.savefig(o_loc, dpi=200)
 
 
-def plot_all_forms(sorting, recording, out_loc, channels_per_group=4):
+def plot_all_forms(sorting, recording, out_loc, channels_per_group=4,
+                   style="bands", output="png", workers=None):
+    """
+    Save a summary of the waveforms of every unit.
+
+    The waveforms are extracted once and drawn headless, by default
+    as the mean and 5-95 percentile band of each channel with one
+    png per unit rendered in a process pool.
+    See waveform_figures.render_unit_forms for the style and output.
+    """
     wf_by_group = st.postprocessing.get_unit_waveforms(
         recording, sorting, ms_before=0.2, ms_after=0.8,
         save_as_features=False, verbose=False, grouping_property="group",
         compute_property_from_recording=True, max_spikes_per_unit=100)
     unit_ids = sorting.get_unit_ids()
+    units = []
     for i, wf in enumerate(wf_by_group):
         try:
             tetrode = sorting.get_unit_property(unit_ids[i], "group")
@@ -137,21 +160,11 @@ def plot_all_forms(sorting, recording, out_loc, channels_per_group=4):
                 print("Unable to find cluster group or group in units")
                 print(sorting.get_shared_unit_property_names())
                 return
+        units.append(("tet{}_unit{}".format(tetrode, i), wf))
 
-        fig, axes = plt.subplots(channels_per_group)
-        for j in range(channels_per_group):
-            try:
-                wave = wf[:, j, :]
-            except Exception:
-                wave = wf[j, :]
-            axes[j].plot(wave.T, color="k", lw=0.3)
-        o_loc = os.path.join(
-            out_loc, "tet{}_unit{}_forms.png".format(
-                tetrode, i))
-        print("Saving waveform {} on tetrode {} to {}".format(
-            i, tetrode, o_loc))
-        fig.savefig(o_loc, dpi=200)
-        plt.close("all")
+    return render_unit_forms(
+        units, out_loc, channels_per_group=channels_per_group,
+        style=style, output=output, workers=workers)
 
 
 def get_info(recording, prb_fname="channel_map.prb"):
@@ -189,37 +202,34 @@ def compare_sorters(sort1, sort2):
     w_multi = sw.plot_multicomp_graph(comp_multi)
     plt.show()
 
-def validation_fn(recording, sorting, **kwargs):
+def validation_fn(recording, sorting, metrics_loc=None, thresholds=None,
+                  **kwargs):
+    """
+    Curate the sorting by the quality metrics of each unit.
+
+    The metrics are computed from one waveform extraction, saved to
+    metrics_loc if given, and loaded from there while the units match.
+    thresholds defaults to removing units with an SNR below 5,
+    see quality_metrics.curate_by_metrics for the format.
+    """
+    if thresholds is None:
+        thresholds = {"snr": ("min", 5)}
     start_unit_ids = sorting.get_unit_ids()
-    filt_params = {
-        "apply_filter" : False,
-        "freq_min": 300,
-        "freq_max": 6000}
-    sorting_curated_snr = st.curation.threshold_snrs(
-        sorting, recording, threshold=5, threshold_sign='less',
-        recording_params=filt_params)
-    end_unit_ids = sorting_curated_snr.get_unit_ids()
-    print("Removed {} units by SNR threshold at 5".format(
-        len(start_unit_ids) - len(end_unit_ids)))
-    validated_sorting = sorting_curated_snr
-
-    # Extra stats that can be printed but takes time
-    # snrs = st.validation.compute_snrs(sorted_s, preproc_recording)
-    # isi_violations = st.validation.compute_isi_violations(sorted_s)
-    # isolations = st.validation.compute_isolation_distances(
-    #     sorted_s, preproc_recording)
-
-    # print('SNR', snrs)
-    # print('ISI violation ratios', isi_violations)
-    # print('Isolation distances', isolations)
-
-    # Do automatic curation based on the snr
-    # snrs_above = st.validation.compute_snrs(
-    #     sorting_curated_snr, preproc_recording)
-    # print('Curated SNR', snrs_above)
+    metrics = get_metrics(recording, sorting, metrics_loc=metrics_loc)
+    kept_unit_ids = curate_by_metrics(metrics, thresholds)
+    validated_sorting = se.SubSortingExtractor(
+        sorting, unit_ids=kept_unit_ids)
+    print("Removed {} units by thresholds {}".format(
+        len(start_unit_ids) - len(kept_unit_ids), thresholds))
+
+    for name in ("snr", "isi_violation", "isolation_distance"):
+        values = np.asarray(metrics[name], dtype=np.float64)
+        if np.any(np.isfinite(values)):
+            print("Median {} {:.2f}".format(name, np.nanmedian(values)))
 
     return validated_sorting
 
+
 def plot_trace(recording, o_dir, t_len=10):
     # Plot a trace of the raw data
     o_loc = os.path.join(o_dir, "trace_" + str(t_len) + "s.png")
@@ -233,108 +243,128 @@ def run(location, sorter="klusta", output_folder="result",
         verbose=False, view=False, phy_out_folder="phy",
         remove_last_chan=False, do_validate=False,
         do_parallel=False, do_plot_waveforms=True, transposed=False,
+        cores_per_tetrode=1, total_cores=None, cache_filtered=False,
+        cache_dtype="float32", waveform_style="bands",
+        waveform_output="png", profile_stages=False, thresholds=None,
         **sorting_kwargs):
     """
     Run spike interface on a _shuff.bin file.
 
     if verbose is True prints more information.
+    if do_parallel is True each tetrode is sorted in its own process,
+    running total_cores // cores_per_tetrode tetrodes at a time.
+    if cache_filtered is True the filtered recording is written once to
+    a filtered_cache folder next to the file, and sorting, validation,
+    phy export and waveform plots all memory map it.
+    waveform_style and waveform_output are passed to plot_all_forms.
+    Every unit is exported to phy, and if do_validate is True the phy
+    folder is then curated by thresholds, see curate_phy. The curation
+    can be redone later with other thresholds by recurate_phy.
+    The time and resources of each stage are saved to
+    pipeline_report.json in the output folder, and if profile_stages
+    is True each stage is also profiled with cProfile.
 
     """
     # Do setup
-    o_start = time()
     print("Starting the sorting pipeline from bin data on {}".format(
         os.path.basename(location)))
     in_dir = os.path.dirname(location)
     o_dir = os.path.join(in_dir, output_folder)
     print("Writing result to {}".format(o_dir))
     probe_loc = os.path.join(o_dir, "channel_map.prb")
+    timer = StageTimer(o_dir, profile=profile_stages)
+    # Saved with the report, including if a stage fails
+    report_info = timer.info
+    report_info.update({"location": location, "sorter": sorter})
 
     # Load the recording data
-    start_time = time()
-    if transposed:
-        time_axis = 0
-    else:
-        time_axis = 1
-    recording = se.BinDatRecordingExtractor(
-        file_path=location, offset=0, dtype=np.int16,
-        sampling_frequency=48000, numchan=64, time_axis=time_axis)
-    recording_prb = recording.load_probe_file(probe_loc)
-    get_info(recording, probe_loc)
-    plot_trace(recording_prb, o_dir)
+    with timer.stage("load"):
+        spec = make_recording_spec(
+            location, probe_loc, transposed=transposed,
+            remove_last_chan=remove_last_chan,
+            cache_dir=os.path.join(in_dir, "filtered_cache")
+            if cache_filtered else None,
+            cache_dtype=cache_dtype)
+        recording, recording_prb = load_recording(spec)
+        get_info(recording, probe_loc)
+        plot_trace(recording_prb, o_dir)
 
     # Do the pre-processing pipeline
     print("Running preprocessing")
-    preproc_recording = st.preprocessing.bandpass_filter(
-        recording_prb, freq_min=300, freq_max=6000)
-    if remove_last_chan:
-        bad_chans = [
-            i for i in range(3, 64, 4)
-            if i in preproc_recording.get_channel_ids()]
-        print("Removing {}".format(bad_chans))
-        preproc_recording = st.preprocessing.remove_bad_channels(
-            preproc_recording, bad_channel_ids=bad_chans)
-        print('Channel ids after preprocess:',
-            preproc_recording.get_channel_ids())
-        print('Channel groups after preprocess:',
-            preproc_recording.get_channel_groups())
-        chans_per_tet = 3
-    else:
-        chans_per_tet = 4
+    with timer.stage("preprocess"):
+        preproc_recording, chans_per_tet = preprocess_recording(
+            recording_prb, spec, verbose=True)
+        if cache_filtered:
+            preproc_recording = cache_recording(preproc_recording, spec)
+            recording = recording_prb = preproc_recording
 
     # Get sorting params and run the sorting
     params = custom_default_params_list(sorter, check=False)
     for k, v in sorting_kwargs.items():
         params[k] = v
-    print("Loaded and preprocessed data in {:.2f}s".format(
-        time() - start_time))
-    start_time = time()
     print("Running {} with parameters {}".format(
         sorter, params))
-    sorted_s = ss.run_sorter(
-        sorter, preproc_recording,
-        grouping_property="group", output_folder=o_dir,
-        parallel=do_parallel, verbose=verbose, **params)
-    print("Sorted in {:.2f}mins".format((time() - start_time) / 60.0))
+    with timer.stage("sort"):
+        if do_parallel:
+            sorted_s, timings = run_sorter_by_group(
+                sorter, spec, o_dir, params,
+                cores_per_job=cores_per_tetrode,
+                total_cores=total_cores, verbose=verbose)
+            for group, wall_time in sorted(timings.items()):
+                print("Group {} sorted in {:.2f}mins".format(
+                    group, wall_time / 60.0))
+            report_info["group_sort_seconds"] = {
+                str(group): round(wall_time, 3)
+                for group, wall_time in timings.items()}
+        else:
+            sorted_s = ss.run_sorter(
+                sorter, preproc_recording,
+                grouping_property="group", output_folder=o_dir,
+                parallel=False, verbose=verbose, **params)
+
+    # Export every unit to phy, so the curation can be loosened later
+    unit_ids = sorted_s.get_unit_ids()
+    report_info["num_sorted_units"] = len(unit_ids)
+    if (len(unit_ids) == 0):
+        print("Found no units in sorting, quitting now")
+        timer.save()
+        return
+
+    phy_out = os.path.join(in_dir, phy_out_folder)
+    print("Exporting to phy")
+    with timer.stage("export_phy"):
+        clear_phy_cache(phy_out)
+        st.postprocessing.export_to_phy(
+            recording, sorted_s,
+            output_folder=phy_out, grouping_property='group',
+            verbose=verbose, ms_before=0.2, ms_after=0.8, dtype=None,
+            max_channels_per_template=8, max_spikes_for_pca=5000)
 
     # Some validation statistics
     if do_validate:
         print("Spike sorting completed, running validation")
-        start_time = time()
-        sorting_curated_snr = validation_fn(recording, sorted_s)
-        print("Validated in {:.2f}mins".format((time() - start_time) / 60.0))
+        with timer.stage("validate"):
+            # The same filtered, probe mapped recording recurate_phy builds
+            sorting_curated_snr = curate_phy(
+                phy_out, preproc_recording,
+                metrics_loc=os.path.join(o_dir, "quality_metrics.csv"),
+                thresholds=thresholds)
     else:
         sorting_curated_snr = sorted_s
-
-    # Export the result to phy for manual curation
-    if (len(sorting_curated_snr.get_unit_ids()) == 0):
-        print("Found no units in sorting, quitting now")
-        return
-
-    start_time = time()
-    phy_out = os.path.join(in_dir, phy_out_folder)
-    print("Exporting to phy")
-    st.postprocessing.export_to_phy(
-        recording, sorting_curated_snr,
-        output_folder=phy_out, grouping_property='group',
-        verbose=verbose, ms_before=0.2, ms_after=0.8, dtype=None,
-        max_channels_per_template=8, max_spikes_for_pca=5000)
-    print("Exported in {:.2f}s".format(time() - start_time))
-    pipeline_time = (time() - o_start) / 60.0
-    print("Whole pipeline took {:.2f}mins".format(pipeline_time))
-
-    do_plot = False
-    print("Showing some extra information")
-    start_time = time()
     unit_ids = sorting_curated_snr.get_unit_ids()
+    report_info["num_units"] = len(unit_ids)
+
     print("Found", len(unit_ids), 'units')
-    if do_plot_waveforms:
+    if do_plot_waveforms and len(unit_ids) > 0:
         print("Plotting waveforms (can set this off in config)")
-        plot_all_forms(
-            sorting_curated_snr, recording_prb, o_dir,
-            channels_per_group=chans_per_tet)
-        print(
-            "Summarised recording in {:.2f}mins".format((
-                time() - start_time) / 60.0))
+        with timer.stage("plot_waveforms"):
+            plot_all_forms(
+                sorting_curated_snr, recording_prb, o_dir,
+                channels_per_group=chans_per_tet, style=waveform_style,
+                output=waveform_output, workers=total_cores)
+    timer.save()
+    print("Whole pipeline took {:.2f}mins".format(
+        timer.get_report()["total_seconds"] / 60.0))
 
     phy_final = os.path.join(phy_out, "params.py")
     if view:
@@ -344,10 +374,68 @@ def run(location, sorter="klusta", output_folder="result",
             "To view the data in phy, run: phy template-gui {}".format(
                 phy_final))
 
+
+def curate_phy(phy_out, recording, metrics_loc=None, thresholds=None,
+               sorting=None):
+    """
+    Curate the full phy export by the quality metrics of each unit.
+
+    The units are loaded from the cached export in phy_out, so their
+    ids are the phy cluster ids, then validation_fn is applied and the
+    phy folder is rewritten with the kept units by reexport_phy.
+    recording is the preprocessed recording with the probe loaded,
+    only used if the metrics at metrics_loc are stale.
+    """
+    if sorting is None:
+        sorting = load_cached_sorting(phy_out)
+    print("Curating {} units from {}".format(
+        len(sorting.get_unit_ids()), phy_out))
+    curated = validation_fn(
+        recording, sorting, metrics_loc=metrics_loc, thresholds=thresholds)
+    reexport_phy(phy_out, curated.get_unit_ids())
+    return curated
+
+
+def recurate_phy(
+        location, output_folder="result", phy_out_folder="phy",
+        remove_last_chan=False, transposed=False, cache_filtered=False,
+        cache_dtype="float32", thresholds=None):
+    """
+    Curate an earlier sort again by thresholds and rewrite the phy folder.
+
+    Uses the cached full export in the phy folder and the cached
+    filtered recording, so nothing is sorted or exported again, and
+    once the quality metrics are saved the recording is not loaded.
+    See phy_reexport for how the phy arrays are filtered.
+    """
+    in_dir = os.path.dirname(location)
+    phy_out = os.path.join(in_dir, phy_out_folder)
+    # The same metrics table as run() saves
+    metrics_loc = os.path.join(in_dir, output_folder, "quality_metrics.csv")
+    sorting = load_cached_sorting(phy_out)
+
+    # The recording is only needed if the metrics are not saved yet
+    recording = None
+    if not metrics_match(metrics_loc, sorting):
+        spec = make_recording_spec(
+            location, os.path.join(in_dir, output_folder, "channel_map.prb"),
+            transposed=transposed, remove_last_chan=remove_last_chan,
+            cache_dir=os.path.join(in_dir, "filtered_cache")
+            if cache_filtered else None,
+            cache_dtype=cache_dtype)
+        recording = build_recording(spec)
+    return curate_phy(
+        phy_out, recording, metrics_loc=metrics_loc, thresholds=thresholds,
+        sorting=sorting)
+
+
 def start_control(
         location, sort_method, out_folder, tetrodes_to_use,
         remove_last_chan, phy_out_folder, do_validate, do_parallel,
-        do_plot_waveforms, transposed, view):
+        do_plot_waveforms, transposed, view, cores_per_tetrode=1,
+        total_cores=None, cache_filtered=False, cache_dtype="float32",
+        waveform_style="bands", waveform_output="png",
+        profile_stages=False, thresholds=None):
     print("Starting to run spike interface!")
     in_dir = os.path.dirname(location)
     out_loc = os.path.join(in_dir, out_folder, "channel_map.prb")
@@ -357,7 +445,11 @@ def start_control(
     run(location, sort_method, output_folder=out_folder, verbose=False,
         remove_last_chan=remove_last_chan, phy_out_folder=phy_out_folder,
         view=view, do_validate=do_validate, do_parallel=do_parallel,
-        do_plot_waveforms=do_plot_waveforms, transposed=transposed)
+        do_plot_waveforms=do_plot_waveforms, transposed=transposed,
+        cores_per_tetrode=cores_per_tetrode, total_cores=total_cores,
+        cache_filtered=cache_filtered, cache_dtype=cache_dtype,
+        waveform_style=waveform_style, waveform_output=waveform_output,
+        profile_stages=profile_stages, thresholds=thresholds)
 
 
 def main_cfg(config):
@@ -373,6 +465,24 @@ def main_cfg(config):
     remove_last_chan = config.getboolean("sorting", "last_chan_is_eeg")
     do_validate = config.getboolean("sorting", "do_validation")
     do_plot_waveforms = config.getboolean("sorting", "do_plot_waveforms")
+    cores_per_tetrode = config.getint(
+        "sorting", "cores_per_tetrode", fallback=1)
+    total_cores = config.getint("sorting", "total_cores", fallback=0)
+    if total_cores <= 0:
+        total_cores = None
+    cache_filtered = config.getboolean(
+        "sorting", "cache_filtered", fallback=False)
+    cache_dtype = config.get("sorting", "cache_dtype", fallback="float32")
+    waveform_style = config.get(
+        "sorting", "waveform_style", fallback="bands")
+    waveform_output = config.get(
+        "sorting", "waveform_output", fallback="png")
+    profile_stages = config.getboolean(
+        "setup", "profile_stages", fallback=False)
+    reexport_only = config.getboolean(
+        "setup", "reexport_phy", fallback=False)
+    thresholds = json.loads(config.get(
+        "sorting", "curation_thresholds", fallback='{"snr": ["min", 5]}'))
 
     if out_dir == "default":
         out_folder = "results_" + sort_method
@@ -381,16 +491,17 @@ def main_cfg(config):
         out_folder = out_dir
         phy_out_folder = out_folder + "_phy"
 
-    # Note in AxonaBinary the format is
-    # AxonaBinary loc tranpose_full transpose_split
+    # Both sorters read a (samples x channels) _shuff.bin and split files
     chans_per_tet = 3 if remove_last_chan else 4
+    transposed = True
+    do_split = True
     if sort_method == "klusta":
         do_parallel = True
         # TODO test if this works well or write another
-        end_params = [str(chans_per_tet), "T", "T", "T", out_folder]
+        split_transpose = True
     elif sort_method == "spykingcircus":
-        do_parallel = False
-        end_params = [str(chans_per_tet), "T", "T", "F", out_folder]
+        do_parallel = True
+        split_transpose = False
     else:
         raise ValueError(
             "Currently unsupported method {}".format(sort_method))
@@ -408,9 +519,11 @@ def main_cfg(config):
         set_fullname = os.path.join(in_dir, fname)
 
     missing = False
-    if end_params[2] == "T":
+    if do_split:
         made_dirs = make_folder_structure(in_dir, out_folder)
-        for dirname in made_dirs:
+        for i, dirname in enumerate(made_dirs):
+            if tetrodes_to_use and (i + 1) not in tetrodes_to_use:
+                continue
             if not os.path.isfile(os.path.join(dirname, "recording.dat")):
                 missing = True
                 break
@@ -419,8 +532,11 @@ def main_cfg(config):
     bin_fullname = os.path.join(in_dir, bin_fname)
     if (not os.path.exists(bin_fullname)) or overwrite_bin or missing:
         print("Writing binary info to {}".format(bin_fullname))
-        run_params = ["AxonaBinary", set_fullname, *end_params]
-        subprocess.run(run_params)
+        convert_axona_binary(
+            set_fullname, chans_per_tetrode=chans_per_tet,
+            transpose=transposed, do_split=do_split,
+            split_transpose=split_transpose, out_split_dir=out_folder,
+            tetrodes=tetrodes_to_use)
     else:
         print("Reading binary info from {}".format(bin_fullname))
 
@@ -429,6 +545,14 @@ def main_cfg(config):
         print("Only checking parameters")
         print(custom_default_params_list(sort_method, check=False))
         exit(-1)
+    if reexport_only:
+        recurate_phy(
+            bin_fullname, output_folder=out_folder,
+            phy_out_folder=phy_out_folder,
+            remove_last_chan=remove_last_chan, transposed=transposed,
+            cache_filtered=cache_filtered, cache_dtype=cache_dtype,
+            thresholds=thresholds)
+        return
     if load_sort:
         location = os.path.join(in_dir, phy_out_folder)
         print("loading sorting information from {}".format(location))
@@ -447,17 +571,21 @@ def main_cfg(config):
         #     verbose=True, ms_before=0.2, ms_after=0.8, dtype=None,
         #     max_channels_per_template=12, max_spikes_for_pca=5000)
         plot_all_forms(sorting, recording_prb,
-                       os.path.join(in_dir, out_folder))
+                       os.path.join(in_dir, out_folder),
+                       style=waveform_style, output=waveform_output)
         # spike_train = sorting.get_unit_spike_train(unit_id=35)
         # print(len(spike_train))
         # print(spike_train[:20] / 48000)
         exit(-1)
 
-    transposed = (end_params[1] == "T")
     start_control(
         bin_fullname, sort_method, out_folder, tetrodes_to_use,
         remove_last_chan, phy_out_folder, do_validate, do_parallel,
-        do_plot_waveforms, transposed=transposed, view=view_phy_on_complete)
+        do_plot_waveforms, transposed=transposed, view=view_phy_on_complete,
+        cores_per_tetrode=cores_per_tetrode, total_cores=total_cores,
+        cache_filtered=cache_filtered, cache_dtype=cache_dtype,
+        waveform_style=waveform_style, waveform_output=waveform_output,
+        profile_stages=profile_stages, thresholds=thresholds)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,194 @@
+"""Sort each tetrode of a recording in its own process."""
+import os
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+
+import spikeinterface.extractors as se
+import spikeinterface.sorters as ss
+import numpy as np
+
+from recording_utils import build_recording
+
+
+THREAD_VARS = (
+    "OMP_NUM_THREADS", "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+@contextmanager
+def _thread_env(num_threads):
+    """
+    Set the thread variables while the worker processes start.
+
+    Numerical libraries read these when first imported, so they must
+    be set in the parent for spawned workers to inherit them.
+    """
+    old_env = {var: os.environ.get(var) for var in THREAD_VARS}
+    os.environ.update({var: str(num_threads) for var in THREAD_VARS})
+    try:
+        yield
+    finally:
+        for var, value in old_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _limit_threads(num_threads):
+    """
+    Stop numerical libraries in a worker using more than its cores.
+
+    Forked workers inherit thread pools that are already running, so
+    these are limited with threadpoolctl if it is installed.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=num_threads)
+
+
+def _sort_group(sorter, spec, group, output_folder, params, verbose):
+    """
+    Sort one group of the recording described by spec.
+
+    Runs in a worker process, so returns plain arrays instead of
+    a sorting extractor.
+    """
+    start_time = time()
+    recording = build_recording(spec)
+    sub_recordings, groups = recording.get_sub_extractors_by_property(
+        "group", return_property_list=True)
+    sub_recording = sub_recordings[list(groups).index(group)]
+    sorting = ss.run_sorter(
+        sorter, sub_recording, output_folder=output_folder,
+        verbose=verbose, **params)
+    spike_trains = {
+        unit: np.asarray(sorting.get_unit_spike_train(unit_id=unit))
+        for unit in sorting.get_unit_ids()}
+    return group, spike_trains, time() - start_time
+
+
+def get_groups(recording):
+    """Get the sorted unique channel groups of a recording."""
+    return sorted(set(recording.get_channel_groups()))
+
+
+def combine_group_sortings(group_trains, sampling_frequency):
+    """
+    Combine per group spike trains into one sorting.
+
+    Parameters
+    ----------
+    group_trains : dict
+        group to a dict of unit id to spike train in samples.
+    sampling_frequency : float
+        The sampling rate of the recording.
+
+    Returns
+    -------
+    MultiSortingExtractor
+        With the "group" unit property set on every unit.
+
+    """
+    sortings = []
+    for group in sorted(group_trains.keys()):
+        spike_trains = group_trains[group]
+        sorting = se.NumpySortingExtractor()
+        if spike_trains:
+            times = np.concatenate(list(spike_trains.values()))
+            labels = np.concatenate([
+                np.full(len(train), unit)
+                for unit, train in spike_trains.items()])
+            sorting.set_times_labels(times, labels)
+        sorting.set_sampling_frequency(sampling_frequency)
+        for unit in sorting.get_unit_ids():
+            sorting.set_unit_property(unit, "group", group)
+        sortings.append(sorting)
+    return se.MultiSortingExtractor(sortings)
+
+
+def run_sorter_by_group(
+        sorter, spec, output_folder, params, cores_per_job=1,
+        total_cores=None, verbose=False):
+    """
+    Sort every channel group (tetrode) in a process pool.
+
+    Each job sorts one tetrode into output_folder/group, the folder
+    the split recording.dat files are written to. At most
+    total_cores // cores_per_job jobs run at once, and each job's
+    sorter and numerical libraries are limited to cores_per_job.
+    If any group fails, a RuntimeError naming every failed group is
+    raised once the other groups have finished.
+
+    Parameters
+    ----------
+    sorter : str
+        The spikeinterface sorter name.
+    spec : dict
+        The recording to sort, from make_recording_spec.
+    output_folder : str
+        The base folder for the sorter output.
+    params : dict
+        The sorter parameters, num_workers is set to cores_per_job
+        if the sorter has that parameter.
+    cores_per_job : int, optional. Defaults to 1.
+        The cores given to each tetrode.
+    total_cores : int, optional. Defaults to None.
+        The cores to share out, None for the CPU count.
+    verbose : bool, optional. Defaults to False.
+        Passed to the sorter.
+
+    Returns
+    -------
+    (MultiSortingExtractor, dict)
+        The combined sorting and the wall time of each group.
+    """
+    if total_cores is None:
+        total_cores = os.cpu_count() or 1
+    params = dict(params)
+    if "num_workers" in params:
+        params["num_workers"] = cores_per_job
+    recording = build_recording(spec)
+    groups = get_groups(recording)
+    max_workers = max(1, min(len(groups), total_cores // cores_per_job))
+    print("Sorting {} groups with {} at a time using {} cores each".format(
+        len(groups), max_workers, cores_per_job))
+
+    group_trains = {}
+    timings = {}
+    failures = {}
+    with _thread_env(cores_per_job), ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_limit_threads,
+            initargs=(cores_per_job,)) as pool:
+        futures = {
+            pool.submit(
+                _sort_group, sorter, spec, group,
+                os.path.join(output_folder, str(group)), params,
+                verbose): group
+            for group in groups}
+        for future in as_completed(futures):
+            group = futures[future]
+            try:
+                group, spike_trains, wall_time = future.result()
+            except Exception as e:
+                print("Sorting group {} failed with {}".format(group, e))
+                failures[group] = e
+                continue
+            group_trains[group] = spike_trains
+            timings[group] = wall_time
+            print("Sorted group {} into {} units in {:.2f}mins".format(
+                group, len(spike_trains), wall_time / 60.0))
+
+    # A missing tetrode would otherwise be exported without any error
+    if failures:
+        raise RuntimeError("Sorting failed for groups {}: {}".format(
+            sorted(failures), "; ".join(
+                "{}: {!r}".format(group, failures[group])
+                for group in sorted(failures))))
+
+    sorting = combine_group_sortings(
+        group_trains, recording.get_sampling_frequency())
+    return sorting, timings
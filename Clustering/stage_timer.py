@@ -0,0 +1,164 @@
+"""Record the time and resources used by each stage of a pipeline."""
+import os
+import sys
+import json
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter, process_time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def get_peak_rss():
+    """The peak resident memory of this process in bytes, or None."""
+    if psutil is not None:
+        mem = psutil.Process().memory_info()
+        # peak_wset on Windows, otherwise fall back to resource
+        if hasattr(mem, "peak_wset"):
+            return int(mem.peak_wset)
+    if resource is not None:
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        peak = int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        return peak if sys.platform == "darwin" else peak * 1024
+    return None
+
+
+def get_io_bytes():
+    """The bytes (read, written) by this process so far, or None."""
+    if psutil is not None:
+        try:
+            io = psutil.Process().io_counters()
+            return io.read_bytes, io.write_bytes
+        except (AttributeError, psutil.Error):
+            pass
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(
+                line.split(": ") for line in f.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def get_cpu_times():
+    """The CPU seconds used by this process and its finished children."""
+    times = os.times()
+    return process_time(), times.children_user + times.children_system
+
+
+class StageTimer(object):
+    """
+    Time the stages of a pipeline and write them to a json report.
+
+    For each stage the wall time, the CPU time of this process and of
+    finished child processes (such as the sorting workers), how much
+    the stage raised the peak resident memory and the bytes read and
+    written are kept. The peak memory of the whole run is reported
+    once, as it is only known for the process. Memory and IO use psutil
+    if installed, and are None where they can not be measured.
+
+    If a stage raises, it is marked as failed and the report is saved
+    before the error is passed on, with the info given to save so far.
+
+    Parameters
+    ----------
+    out_dir : str
+        The folder for the report and any profiles.
+    profile : bool, optional. Defaults to False.
+        Also run each stage under cProfile and save stage_<name>.prof,
+        which can be viewed with snakeviz or pstats.
+    verbose : bool, optional. Defaults to True.
+        Print the wall time of each stage as it finishes.
+
+    """
+
+    def __init__(self, out_dir, profile=False, verbose=True):
+        self.out_dir = out_dir
+        self.profile = profile
+        self.verbose = verbose
+        self.stages = []
+        self.info = {}
+        self.start_time = perf_counter()
+        self.started = datetime.now().isoformat(timespec="seconds")
+
+    @contextmanager
+    def stage(self, name):
+        """Record everything run in the with block as the stage name."""
+        io_start = get_io_bytes()
+        rss_start = get_peak_rss()
+        cpu_start, child_start = get_cpu_times()
+        profiler = cProfile.Profile() if self.profile else None
+        wall_start = perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall = perf_counter() - wall_start
+            cpu_end, child_end = get_cpu_times()
+            io_end = get_io_bytes()
+            rss_end = get_peak_rss()
+            record = {
+                "stage": name,
+                "wall_seconds": round(wall, 3),
+                "cpu_seconds": round(cpu_end - cpu_start, 3),
+                "child_cpu_seconds": round(child_end - child_start, 3),
+                "peak_rss_increase_bytes": None,
+                "read_bytes": None,
+                "written_bytes": None}
+            if rss_start is not None and rss_end is not None:
+                record["peak_rss_increase_bytes"] = rss_end - rss_start
+            if io_start is not None and io_end is not None:
+                record["read_bytes"] = io_end[0] - io_start[0]
+                record["written_bytes"] = io_end[1] - io_start[1]
+            if profiler is not None:
+                os.makedirs(self.out_dir, exist_ok=True)
+                record["profile"] = os.path.join(
+                    self.out_dir, "stage_{}.prof".format(name))
+                profiler.dump_stats(record["profile"])
+            if failed:
+                record["failed"] = True
+            self.stages.append(record)
+            if self.verbose:
+                print("Stage {} took {:.2f}s".format(name, wall))
+            if failed:
+                self.save()
+
+    def get_report(self, **info):
+        """The stage records and the total time, with any extra info."""
+        report = dict(info)
+        report["started"] = self.started
+        report["total_seconds"] = round(perf_counter() - self.start_time, 3)
+        report["peak_rss_bytes"] = get_peak_rss()
+        report["stages"] = self.stages
+        return report
+
+    def save(self, name="pipeline_report.json", **info):
+        """
+        Write the report to out_dir/name and return its location.
+
+        info is kept and also written in any later reports.
+        """
+        self.info.update(info)
+        os.makedirs(self.out_dir, exist_ok=True)
+        out_loc = os.path.join(self.out_dir, name)
+        with open(out_loc, "w") as f:
+            json.dump(self.get_report(**self.info), f, indent=2)
+        if self.verbose:
+            print("Saved the stage timings to {}".format(out_loc))
+        return out_loc
@@ -0,0 +1,208 @@
+"""
+Headless rendering of unit waveform summaries.
+
+Figures are built with matplotlib's object API on the Agg canvas,
+so no display or pyplot state is needed and they can be drawn in
+worker processes.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+
+
+def as_spikes_channels_samples(wf):
+    """
+    Make waveforms (spikes, channels, samples).
+
+    As before, a 2d array is one spike on each channel
+    (channels, samples), and a 1d array is one spike on one channel.
+    """
+    wf = np.asarray(wf)
+    if wf.ndim == 2:
+        wf = wf[None, :, :]
+    elif wf.ndim == 1:
+        wf = wf[None, None, :]
+    return wf
+
+
+def summarise_waveforms(wf, style="bands", percentiles=(5, 95), bins=64):
+    """
+    Reduce the waveforms of one unit to what is drawn.
+
+    Parameters
+    ----------
+    wf : np.ndarray
+        The waveforms of a unit, (spikes, channels, samples).
+    style : str, optional. Defaults to "bands".
+        "bands" for the mean and a percentile band,
+        "density" for a 2d histogram of voltage against sample,
+        "lines" to keep every waveform.
+    percentiles : tuple of float, optional. Defaults to (5, 95).
+        The band drawn around the mean for "bands".
+    bins : int, optional. Defaults to 64.
+        The voltage bins for "density".
+
+    Returns
+    -------
+    dict
+        The arrays needed to draw the unit in draw_summary.
+
+    """
+    wf = as_spikes_channels_samples(wf)
+    summary = {"style": style, "num_spikes": wf.shape[0]}
+    if style == "bands":
+        summary["mean"] = wf.mean(axis=0)
+        summary["low"], summary["high"] = np.percentile(
+            wf, percentiles, axis=0)
+    elif style == "density":
+        low, high = np.min(wf), np.max(wf)
+        if low == high:
+            high = low + 1
+        edges = np.linspace(low, high, bins + 1)
+        num_samples = wf.shape[2]
+        density = np.zeros((wf.shape[1], bins, num_samples))
+        for i in range(wf.shape[1]):
+            idx = np.clip(
+                np.searchsorted(edges, wf[:, i, :], side="right") - 1,
+                0, bins - 1)
+            np.add.at(
+                density[i], (idx, np.broadcast_to(
+                    np.arange(num_samples), idx.shape)), 1)
+        summary["density"] = density
+        summary["extent"] = (0, num_samples - 1, low, high)
+    elif style == "lines":
+        summary["lines"] = wf
+    else:
+        raise ValueError("Unsupported waveform style {}".format(style))
+    return summary
+
+
+def draw_summary(fig, summary, title=None, channels_per_group=None):
+    """Draw a waveform summary on fig, one axis per channel."""
+    if summary["style"] == "lines":
+        num_chans = summary["lines"].shape[1]
+    elif summary["style"] == "bands":
+        num_chans = summary["mean"].shape[0]
+    else:
+        num_chans = summary["density"].shape[0]
+    if channels_per_group is not None:
+        num_chans = min(num_chans, channels_per_group)
+    axes = fig.subplots(num_chans, 1, sharex=True, squeeze=False)[:, 0]
+    for j, ax in enumerate(axes):
+        if summary["style"] == "bands":
+            x = np.arange(summary["mean"].shape[1])
+            ax.fill_between(
+                x, summary["low"][j], summary["high"][j],
+                color="k", alpha=0.25, lw=0)
+            ax.plot(x, summary["mean"][j], color="k", lw=1)
+        elif summary["style"] == "density":
+            ax.imshow(
+                np.log1p(summary["density"][j]), origin="lower",
+                aspect="auto", cmap="Greys",
+                extent=summary["extent"])
+        else:
+            ax.plot(summary["lines"][:, j, :].T, color="k", lw=0.3)
+        ax.tick_params(labelsize=6)
+    if title is not None:
+        axes[0].set_title(
+            "{} ({} spikes)".format(title, summary["num_spikes"]),
+            fontsize=8)
+    return axes
+
+
+def render_summary(summary, title, o_loc, channels_per_group=None,
+                   dpi=100, figsize=(4, 5)):
+    """Draw one unit and save it to o_loc, run in a worker process."""
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    draw_summary(fig, summary, title, channels_per_group)
+    fig.savefig(o_loc, dpi=dpi)
+    return o_loc
+
+
+def draw_contact_sheet(summaries, titles, o_loc, channels_per_group=None,
+                       columns=8, dpi=100):
+    """Draw every unit as a cell of one large image."""
+    rows = -(-len(summaries) // columns)
+    fig = Figure(figsize=(2 * columns, 2.5 * rows))
+    FigureCanvasAgg(fig)
+    cells = fig.subfigures(rows, columns, squeeze=False).flatten()
+    for cell, summary, title in zip(cells, summaries, titles):
+        draw_summary(cell, summary, title, channels_per_group)
+    fig.savefig(o_loc, dpi=dpi)
+    return o_loc
+
+
+def write_pdf(summaries, titles, o_loc, channels_per_group=None):
+    """Write every unit as a page of one pdf."""
+    with PdfPages(o_loc) as pdf:
+        for summary, title in zip(summaries, titles):
+            fig = Figure(figsize=(4, 5))
+            FigureCanvasAgg(fig)
+            draw_summary(fig, summary, title, channels_per_group)
+            pdf.savefig(fig)
+    return o_loc
+
+
+def render_unit_forms(
+        units, out_loc, channels_per_group=None, style="bands",
+        output="png", workers=None, dpi=100, verbose=True):
+    """
+    Render the waveforms of many units.
+
+    Parameters
+    ----------
+    units : list of (str, np.ndarray)
+        The name of each unit and its waveforms (spikes, chans, samples).
+        The name is used as the title and the png file name.
+    out_loc : str
+        The folder to save the figures to.
+    channels_per_group : int, optional. Defaults to None.
+        The channels to draw, None for all of them.
+    style : str, optional. Defaults to "bands".
+        See summarise_waveforms.
+    output : str, optional. Defaults to "png".
+        "png" for one image per unit rendered in a process pool,
+        "pdf" for a single multi page unit_forms.pdf,
+        "sheet" for a single unit_forms.png contact sheet.
+    workers : int, optional. Defaults to None.
+        The processes used for "png", None for the CPU count.
+    dpi : int, optional. Defaults to 100.
+        The resolution of the images.
+    verbose : bool, optional. Defaults to True.
+        Whether to print the files written.
+
+    Returns
+    -------
+    list of str
+        The files written.
+
+    """
+    titles = [name for name, _ in units]
+    summaries = [summarise_waveforms(wf, style) for _, wf in units]
+    if output == "pdf":
+        written = [write_pdf(
+            summaries, titles, os.path.join(out_loc, "unit_forms.pdf"),
+            channels_per_group)]
+    elif output == "sheet":
+        written = [draw_contact_sheet(
+            summaries, titles, os.path.join(out_loc, "unit_forms.png"),
+            channels_per_group, dpi=dpi)]
+    elif output == "png":
+        o_locs = [
+            os.path.join(out_loc, "{}_forms.png".format(title))
+            for title in titles]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            written = list(pool.map(
+                render_summary, summaries, titles, o_locs,
+                [channels_per_group] * len(titles), [dpi] * len(titles)))
+    else:
+        raise ValueError("Unsupported waveform output {}".format(output))
+    if verbose:
+        print("Saved {} waveform figures to {}".format(
+            len(units), out_loc))
+    return written
@@ -1,5 +1,11 @@
 import os
 import shutil
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import time
+
+import numpy as np
 
 # This can be obtained from my github at seankmartin
 from neurochat.nc_spike import NSpike
@@ -11,40 +17,105 @@ def make_dir_if_not_exists(dirname):
     os.makedirs(dirname, exist_ok=True)
 
 
-def my_copy(f, t, only_check=True, verbose=False):
-    if only_check:
-        print("Would copy from {} to {}".format(f, t))
-    else:
-        if verbose:
-            print("Copying from {} to {}".format(f, t))
-        if not os.path.isfile(f):
-            raise ValueError("{} is not a file".format(f))
-        shutil.copy(f, t)
+def hash_file(fname, block_size=16777216):
+    """Hash the contents of a file in blocks."""
+    digest = hashlib.blake2b()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_same_file(f, t, check="size_mtime"):
+    """
+    Check if t is already a copy of f.
+
+    check is "size_mtime" to compare the size and modification time,
+    which copy2 preserves, or "hash" to also compare the contents.
+    """
+    if not os.path.isfile(t):
+        return False
+    f_stat, t_stat = os.stat(f), os.stat(t)
+    if f_stat.st_size != t_stat.st_size:
+        return False
+    if check == "hash":
+        return hash_file(f) == hash_file(t)
+    # Some file systems only keep the time to two seconds
+    return abs(f_stat.st_mtime - t_stat.st_mtime) < 2
 
 
-def get_spike_times(spike_file, unit_num):
+def get_units_spike_times(spike_file, unit_nums):
+    """Load a tetrode file once and get the spike times of each unit."""
     spike = NSpike()
     spike.set_filename(spike_file)
     spike.set_system("Axona")
     spike.load()
-    spike.set_unit_no(unit_num)
-    spike_times = spike.get_unit_stamp()
-    return spike_times
+    times = {}
+    for unit_num in unit_nums:
+        spike.set_unit_no(unit_num)
+        times[unit_num] = spike.get_unit_stamp()
+    return times
+
+
+def write_spike_times(time_name, spike_times, out_format="csv"):
+    """
+    Write the spike times of one unit.
+
+    out_format "csv" writes one line of comma separated times to 4
+    decimal places, as the original files, and "npy" writes a binary
+    .npy file next to where the csv would be.
+    """
+    spike_times = np.asarray(spike_times, dtype=np.float64).ravel()
+    if out_format == "npy":
+        np.save(time_name[:-4] + ".npy", spike_times)
+        return
+    with open(time_name, "w") as f:
+        if len(spike_times) != 0:
+            f.write(" ")
+            np.savetxt(
+                f, spike_times[None], fmt="%.4f", delimiter=", ",
+                newline="")
+
+
+def write_rat_archives(main_dir, times_by_rat):
+    """
+    Write every unit of each rat to main_dir/RAT/RAT_spike_times.npz.
+
+    The keys are UNIT_NUM/RECORDING_UNIT, so all units of a rat load
+    in one read with np.load.
+    """
+    written = []
+    for rat, unit_times in times_by_rat.items():
+        out_loc = os.path.join(main_dir, rat, rat + "_spike_times.npz")
+        make_dir_if_not_exists(os.path.dirname(out_loc))
+        np.savez_compressed(out_loc, **unit_times)
+        written.append(out_loc)
+    return written
 
 
-def write(main_dir, df, only_check=True, verbose=False):
+def plan_write(main_dir, df):
     """
+    Work out every file to copy and every spike time csv to write.
+
     I’ll structure the data we share with you as RAT_NAME/UNIT_NUM/RECORDING_NAME/RAW_DATA unless something else suits you better.
+
+    Returns
+    -------
+    (dict, dict)
+        Each source file mapped to its destinations, and each tetrode
+        file mapped to a list of (unit number, csv file, rat, key),
+        where key names the unit in the rat's archive.
+
     """
+    copies = OrderedDict()
+    spike_jobs = OrderedDict()
     for row in df.itertuples():
-        print(row)
         base_dir = os.path.join(
             main_dir,
             row.RAT.strip(" "),
             row.UNITNUM.replace("#", "UNIT_"),
             row.FileName
         )
-        make_dir_if_not_exists(base_dir)
 
         set_file = row.full_set_file
         pos_file = set_file[:-3] + "pos"
@@ -54,28 +125,144 @@ def write(main_dir, df, only_check=True, verbose=False):
         tetrode_file = row.full_spike_file
         all_files = (
             set_file, pos_file, eeg_file, cut_file, txt_file, tetrode_file)
-        unit_num = int(row.Unit)
 
-        # Files to merely copy
+        # Files to merely copy, each source and destination only once
         for fname in all_files:
             out_name = os.path.join(base_dir, os.path.basename(fname))
-            my_copy(fname, out_name, only_check=only_check, verbose=verbose)
+            destinations = copies.setdefault(fname, [])
+            if out_name not in destinations:
+                destinations.append(out_name)
 
         # Files created
-        spike_times = get_spike_times(tetrode_file, unit_num)
         time_name = os.path.join(
             base_dir, row.FileName + "_" + row.Unit + ".csv")
-        spikes_as_csv = ""
-        for spike_time in spike_times:
-            spikes_as_csv = "{}, {:.4f}".format(spikes_as_csv, spike_time)
-        spikes_as_csv = spikes_as_csv[1:]
-        if only_check:
-            print("Would write spike times to {}".format(time_name))
-        else:
+        unit_dir = row.UNITNUM.replace("#", "UNIT_")
+        key = "{}/{}_{}".format(unit_dir, row.FileName, row.Unit)
+        spike_jobs.setdefault(tetrode_file, []).append(
+            (int(row.Unit), time_name, row.RAT.strip(" "), key))
+    return copies, spike_jobs
+
+
+def copy_to_all(f, destinations, check="size_mtime"):
+    """Copy f to every destination not already holding a copy."""
+    if not os.path.isfile(f):
+        raise ValueError("{} is not a file".format(f))
+    copied, skipped, num_bytes = 0, 0, 0
+    for t in destinations:
+        if is_same_file(f, t, check):
+            skipped += 1
+            continue
+        make_dir_if_not_exists(os.path.dirname(t))
+        shutil.copy2(f, t)
+        copied += 1
+        num_bytes += os.path.getsize(t)
+    return copied, skipped, num_bytes
+
+
+def write_unit_csvs(tetrode_file, jobs, out_format="csv"):
+    """
+    Write the spike times of each unit job of a tetrode.
+
+    Returns the spike times keyed by (rat, key) for the archives.
+    """
+    times = get_units_spike_times(
+        tetrode_file, sorted(set(job[0] for job in jobs)))
+    written = {}
+    for unit, time_name, rat, key in jobs:
+        make_dir_if_not_exists(os.path.dirname(time_name))
+        write_spike_times(time_name, times[unit], out_format)
+        written[(rat, key)] = np.asarray(times[unit], dtype=np.float64)
+    return written
+
+
+def write(main_dir, df, only_check=True, verbose=False, workers=4,
+          check="size_mtime", out_format="csv", archive=True):
+    """
+    Copy the files of each unit in df and write its spike times.
+
+    Every source is copied once per destination, files already at the
+    destination are skipped, and each tetrode file is loaded once
+    however many of its units are listed. The copies and tetrode files
+    are processed in a thread pool.
+
+    Parameters
+    ----------
+    main_dir : str
+        The folder to copy to, see plan_write for the layout.
+    df : pandas.DataFrame
+        The unit information from get_files_from_list.main.
+    only_check : bool, optional. Defaults to True.
+        Only print what would be done.
+    verbose : bool, optional. Defaults to False.
+        Print each file as it is processed.
+    workers : int, optional. Defaults to 4.
+        The copy threads, 1 or 2 suits a spinning disk and more
+        suits SSDs and network drives.
+    check : str, optional. Defaults to "size_mtime".
+        How to tell a file was already copied, see is_same_file.
+    out_format : str, optional. Defaults to "csv".
+        The per unit spike time files, see write_spike_times.
+    archive : bool, optional. Defaults to True.
+        Also write every unit of each rat to one npz file,
+        see write_rat_archives.
+
+    Returns
+    -------
+    dict
+        The number of files copied and skipped, the csv files written,
+        the bytes copied and the seconds taken.
+
+    """
+    copies, spike_jobs = plan_write(main_dir, df)
+    if only_check:
+        for f, destinations in copies.items():
+            for t in destinations:
+                print("Would copy from {} to {}".format(f, t))
+        for tetrode_file, jobs in spike_jobs.items():
+            for job in jobs:
+                print("Would write spike times to {}".format(job[1]))
+        return {}
+
+    start_time = time()
+    summary = {"copied": 0, "skipped": 0, "csv": 0, "bytes": 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        copy_futures = {
+            pool.submit(copy_to_all, f, destinations, check): f
+            for f, destinations in copies.items()}
+        csv_futures = {
+            pool.submit(
+                write_unit_csvs, tetrode_file, jobs, out_format): tetrode_file
+            for tetrode_file, jobs in spike_jobs.items()}
+        for future in as_completed(copy_futures):
+            copied, skipped, num_bytes = future.result()
+            summary["copied"] += copied
+            summary["skipped"] += skipped
+            summary["bytes"] += num_bytes
+            if verbose:
+                print("Copied {} to {} places, {} already there".format(
+                    copy_futures[future], copied, skipped))
+        times_by_rat = OrderedDict()
+        for future in as_completed(csv_futures):
+            unit_times = future.result()
+            summary["csv"] += len(unit_times)
+            for (rat, key), times in unit_times.items():
+                times_by_rat.setdefault(rat, {})[key] = times
             if verbose:
-                print("Writing spike times to {}".format(time_name))
-            with open(time_name, "w") as f:
-                f.write(spikes_as_csv)
+                print("Wrote spike times from {}".format(
+                    csv_futures[future]))
+    if archive:
+        for out_loc in write_rat_archives(main_dir, times_by_rat):
+            if verbose:
+                print("Wrote all spike times of a rat to {}".format(
+                    out_loc))
+    summary["seconds"] = time() - start_time
+
+    print("Copied {} files ({:.1f} MB) in {:.2f}s at {:.1f} MB/s, "
+          "skipped {} already copied, wrote {} spike time files".format(
+              summary["copied"], summary["bytes"] / 1e6, summary["seconds"],
+              summary["bytes"] / 1e6 / max(summary["seconds"], 1e-9),
+              summary["skipped"], summary["csv"]))
+    return summary
 
 
 def main(excel_loc, data_dir):
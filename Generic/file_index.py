@@ -0,0 +1,256 @@
+"""
+An index of the files under a directory, shared by the scripts.
+
+The tree is walked with os.scandir, which gets the file type from the
+directory listing rather than a stat per file. Directories can be
+scanned in parallel threads, and the index can be cached to disk,
+where a directory whose modification time has not changed is not
+listed again on the next refresh. Queries by extension and basename
+are dict lookups.
+"""
+import os
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _scan_dir(path):
+    """List a directory, returning (mtime, files, subdirectories)."""
+    files, subdirs = [], []
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    # As in os.walk, links to directories are not followed
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file():
+                        files.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        return None, [], []
+    return mtime, sorted(files), sorted(subdirs)
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _get_ext_key(filename):
+    """The lower case last extension of a file, such as .set"""
+    return os.path.splitext(filename)[1].lower()
+
+
+class FileIndex(object):
+    """
+    An index of the files in a directory tree.
+
+    Parameters
+    ----------
+    root : str
+        The directory to index.
+    recursive : bool, optional. Defaults to True.
+        Whether to index subdirectories.
+    workers : int, optional. Defaults to 1.
+        The threads listing directories, which helps most on network
+        drives. None uses the ThreadPoolExecutor default.
+    cache_loc : str, optional. Defaults to None.
+        A json file to keep the index in between runs.
+
+    """
+
+    def __init__(self, root, recursive=True, workers=1, cache_loc=None):
+        self.root = os.path.abspath(root)
+        self.recursive = recursive
+        self.workers = workers
+        self.cache_loc = cache_loc
+        self.dirs = {}
+        self.num_listed = 0
+        if cache_loc is not None and os.path.isfile(cache_loc):
+            self.load(cache_loc)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Bring the index up to date with the disk.
+
+        Directories are only listed again if their modification time
+        changed, which happens when a file is added, removed or renamed
+        in them (but not when a file is only modified).
+        """
+        old_dirs = self.dirs
+        self.dirs = {}
+        self.num_listed = 0
+
+        def visit(rel_dir):
+            path = os.path.join(self.root, rel_dir)
+            old = old_dirs.get(rel_dir)
+            if old is not None and old["mtime"] == _get_mtime(path):
+                return rel_dir, old, False
+            mtime, files, subdirs = _scan_dir(path)
+            return rel_dir, {
+                "mtime": mtime, "files": files, "subdirs": subdirs}, True
+
+        # Walk the tree one level at a time, each level in the pool
+        level = [""]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while level:
+                next_level = []
+                for rel_dir, entry, listed in pool.map(visit, level):
+                    self.dirs[rel_dir] = entry
+                    self.num_listed += listed
+                    if self.recursive:
+                        next_level.extend(
+                            os.path.join(rel_dir, d)
+                            for d in entry["subdirs"])
+                level = next_level
+        self._build_lookups()
+        if self.cache_loc is not None:
+            self.save(self.cache_loc)
+        return self
+
+    def _build_lookups(self):
+        self.files = []
+        self.by_ext = {}
+        self.by_name = {}
+        for rel_dir in sorted(self.dirs.keys()):
+            for name in self.dirs[rel_dir]["files"]:
+                rel_path = os.path.join(rel_dir, name)
+                self.files.append(rel_path)
+                self.by_ext.setdefault(_get_ext_key(name), []).append(
+                    rel_path)
+                self.by_name.setdefault(name, []).append(rel_path)
+
+    def save(self, cache_loc):
+        """Save the index to a json file."""
+        temp_loc = cache_loc + ".tmp"
+        with open(temp_loc, "w") as f:
+            json.dump({
+                "root": self.root, "recursive": self.recursive,
+                "dirs": self.dirs}, f)
+        os.replace(temp_loc, cache_loc)
+
+    def load(self, cache_loc):
+        """Load an index saved for the same root and recursion."""
+        try:
+            with open(cache_loc, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (cached.get("root") == self.root and
+                cached.get("recursive") == self.recursive):
+            self.dirs = cached["dirs"]
+
+    def to_path(self, rel_path, return_absolute=True):
+        """Convert a path relative to the root as requested."""
+        return os.path.join(self.root, rel_path) if return_absolute \
+            else rel_path
+
+    def query(self, ext=None, re_filter=None, basename=None,
+              case_sensitive_ext=False, return_absolute=True):
+        """
+        Get the files matching every given condition.
+
+        Parameters
+        ----------
+        ext : str, optional. Defaults to None.
+            The extension of the files, may have a leading dot.
+        re_filter : str, optional. Defaults to None.
+            A regular expression searched for in the path relative
+            to the root.
+        basename : str, optional. Defaults to None.
+            The exact file name, such as "recording.set".
+        case_sensitive_ext : bool, optional. Defaults to False.
+            Whether to match the case of the file extension.
+        return_absolute : bool, optional. Defaults to True.
+            Whether to return the absolute filename or the path
+            relative to the root.
+
+        Returns
+        -------
+        list of str
+            The matching files, sorted by directory.
+
+        """
+        if ext is not None and ext[0] != ".":
+            ext = "." + ext
+        if basename is not None:
+            candidates = self.by_name.get(basename, [])
+        elif ext is not None:
+            key = _get_ext_key(ext)
+            # Extensions like .clu.1 are longer than the lookup key
+            candidates = self.files if key != ext.lower() else \
+                self.by_ext.get(key, [])
+        else:
+            candidates = self.files
+
+        if ext is not None:
+            if case_sensitive_ext:
+                candidates = [f for f in candidates if f.endswith(ext)]
+            else:
+                lower_ext = ext.lower()
+                candidates = [
+                    f for f in candidates if f.lower().endswith(lower_ext)]
+        if re_filter is not None:
+            pattern = re.compile(re_filter)
+            candidates = [f for f in candidates if pattern.search(f)]
+        return [self.to_path(f, return_absolute) for f in candidates]
+
+
+def get_all_files_in_dir(
+        in_dir, ext=None, return_absolute=True,
+        recursive=False, verbose=False, re_filter=None,
+        case_sensitive_ext=False, workers=1, cache_loc=None):
+    """
+    Get all files in the directory with the given extensions.
+
+    Parameters
+    ----------
+    in_dir : str
+        The absolute path to the directory
+    ext : str, optional. Defaults to None.
+        The extension of files to get.
+    return_absolute : bool, optional. Defaults to True.
+        Whether to return the absolute filename or not.
+    recursive: bool, optional. Defaults to False.
+        Whether to recurse through directories.
+    verbose: bool, optional. Defaults to False.
+        Whether to print the files found.
+    re_filter: str, optional. Defaults to None
+        a regular expression used to filter the results
+    case_sensitive_ext: bool, optional. Defaults to False,
+        Whether to match the case of the file extension
+    workers : int, optional. Defaults to 1.
+        The threads listing directories, see FileIndex.
+    cache_loc : str, optional. Defaults to None.
+        A json file to cache the index in, see FileIndex.
+
+    Returns
+    -------
+    List
+        A list of filenames with the given parameters.
+
+    """
+    if not os.path.isdir(in_dir):
+        print("Non existant directory " + str(in_dir))
+        return []
+
+    index = FileIndex(
+        in_dir, recursive=recursive, workers=workers, cache_loc=cache_loc)
+    onlyfiles = [
+        os.path.join(in_dir, f) if return_absolute else f
+        for f in index.query(
+            ext=ext, re_filter=re_filter,
+            case_sensitive_ext=case_sensitive_ext, return_absolute=False)]
+
+    if verbose:
+        print("Adding following files from {}".format(in_dir))
+        for f in onlyfiles:
+            print(f)
+        print()
+    return onlyfiles
@@ -2,112 +2,9 @@ import pandas as pd
 import numpy as np
 
 import os
-import re
+from bisect import bisect_left
 
-
-def has_ext(filename, ext, case_sensitive_ext=False):
-    """
-    Check if the filename ends in the extension.
-    Parameters
-    ----------
-    filename : str
-        The name of the file.
-    ext : str
-        The extension, may have leading dot (e.g txt == .txt).
-    case_sensitive_ext: bool, optional. Defaults to False,
-        Whether to match the case of the file extension.
-    Returns
-    -------
-    bool
-        Indicates if the filename has the extension
-    """
-    if ext is None:
-        return True
-    if ext[0] != ".":
-        ext = "." + ext
-    if case_sensitive_ext:
-        return filename[-len(ext):] == ext
-    else:
-        return filename[-len(ext):].lower() == ext.lower()
-
-
-def get_all_files_in_dir(
-        in_dir, ext=None, return_absolute=True,
-        recursive=False, verbose=False, re_filter=None,
-        case_sensitive_ext=False):
-    """
-    Get all files in the directory with the given extensions.
-    Parameters
-    ----------
-    in_dir : str
-        The absolute path to the directory
-    ext : str, optional. Defaults to None.
-        The extension of files to get.
-    return_absolute : bool, optional. Defaults to True.
-        Whether to return the absolute filename or not.
-    recursive: bool, optional. Defaults to False.
-        Whether to recurse through directories.
-    verbose: bool, optional. Defaults to False.
-        Whether to print the files found.
-    re_filter: str, optional. Defaults to None
-        a regular expression used to filter the results
-    case_sensitive_ext: bool, optional. Defaults to False,
-        Whether to match the case of the file extension
-    Returns
-    -------
-    List
-        A list of filenames with the given parameters.
-    """
-    if not os.path.isdir(in_dir):
-        print("Non existant directory " + str(in_dir))
-        return []
-
-    def match_filter(f):
-        if re_filter is None:
-            return True
-        search_res = re.search(re_filter, f)
-        return search_res is not None
-
-    def ok_file(root_dir, f):
-        return (
-            has_ext(f, ext, case_sensitive_ext=case_sensitive_ext) and
-            os.path.isfile(os.path.join(root_dir, f)) and match_filter(f))
-
-    def convert_to_path(root_dir, f):
-        return os.path.join(root_dir, f) if return_absolute else f
-
-    if verbose:
-        print("Adding following files from {}".format(in_dir))
-
-    if recursive:
-        onlyfiles = []
-        for root, _, filenames in os.walk(in_dir):
-            start_root = root[:len(in_dir)]
-
-            if len(root) == len(start_root):
-                end_root = ""
-            else:
-                end_root = root[len(in_dir + os.sep):]
-            for filename in filenames:
-                filename = os.path.join(end_root, filename)
-                if ok_file(start_root, filename):
-                    to_add = convert_to_path(start_root, filename)
-                    if verbose:
-                        print(to_add)
-                    onlyfiles.append(to_add)
-
-    else:
-        onlyfiles = [
-            convert_to_path(in_dir, f) for f in sorted(os.listdir(in_dir))
-            if ok_file(in_dir, f)
-        ]
-        if verbose:
-            for f in onlyfiles:
-                print(f)
-
-    if verbose:
-        print()
-    return onlyfiles
+from file_index import FileIndex
 
 
 def parse_excel(excel_loc):
@@ -133,9 +30,51 @@ def parse_excel(excel_loc):
     return df
 
 
+def index_set_files(rel_set_files, data_dir):
+    """
+    Map (rat, set name without extension) to the first matching set file.
+
+    The rat is the first folder of the path relative to data_dir.
+    """
+    set_index = {}
+    for rel_path in rel_set_files:
+        rat = rel_path.split(os.sep)[0]
+        stem = os.path.basename(rel_path)[:-4]
+        set_index.setdefault((rat, stem), os.path.join(data_dir, rel_path))
+    return set_index
+
+
+class PrefixIndex(object):
+    """
+    Find the first of a list of strings starting with a prefix.
+
+    The strings are sorted once, so the strings sharing a prefix are
+    a contiguous range found by bisection, and the first of them in
+    the original order is returned.
+    """
+
+    def __init__(self, strings):
+        order = sorted(range(len(strings)), key=lambda i: strings[i])
+        self.sorted_strings = [strings[i] for i in order]
+        self.positions = order
+
+    def first_with_prefix(self, prefix):
+        start = bisect_left(self.sorted_strings, prefix)
+        end = start
+        best = None
+        while (end < len(self.sorted_strings) and
+               self.sorted_strings[end].startswith(prefix)):
+            if best is None or self.positions[end] < self.positions[best]:
+                best = end
+            end += 1
+        return None if best is None else self.sorted_strings[best]
+
+
 def find_files(info, data_dir):
-    files = get_all_files_in_dir(
-        data_dir, ext="set", verbose=False, recursive=True)
+    # One walk of the data drive answers every query below
+    index = FileIndex(data_dir, recursive=True)
+    set_index = index_set_files(
+        index.query(ext="set", return_absolute=False), data_dir)
     good_files = []
     tetrode_list = []
     good_txt_files = []
@@ -143,46 +82,42 @@ def find_files(info, data_dir):
     good_spike_files = []
     units = []
 
-    def ok_file(f, rat):
-        for fname in files:
-            if f == os.path.basename(fname)[:-4]:
-                this_rat = fname[len(data_dir + os.sep):].split(os.sep)[0]
-                if this_rat == rat:
-                    return True, fname
-        return False, None
-
     for i, f in enumerate(info["FileName"]):
         rat = info["RAT"][i].strip()
-        test, fname = ok_file(f, rat)
-        if test:
+        fname = set_index.get((rat, f), None)
+        if fname is not None:
             good_files.append(fname)
             good_basenames.append(os.path.basename(fname)[:-4])
             tetrode_list.append(info["Tetrode"][i])
             units.append(info["Unit"][i])
 
-    txt_files = get_all_files_in_dir(
-        data_dir, ext="txt", verbose=False, recursive=True)
+    txt_index = PrefixIndex([
+        os.path.join(data_dir, f)
+        for f in index.query(ext="txt", return_absolute=False)])
 
     # Find txt files that match
     for filename in good_files:
-        filename = filename[:-4]
-        for fname in txt_files:
-            if fname[:(len(filename) + 1)] == filename + "_":
-                pos_name = fname
-                good_txt_files.append(pos_name)
-                break
-
-    # Find cut files that match
+        pos_name = txt_index.first_with_prefix(filename[:-4] + "_")
+        if pos_name is not None:
+            good_txt_files.append(pos_name)
+
+    # Find cut files that match, ignoring case where the OS does
+    all_files = set(
+        os.path.normcase(os.path.join(data_dir, f)) for f in index.files)
+
+    def exists(fname):
+        return os.path.normcase(fname) in all_files
+
     for fname, tetrode in zip(good_files, tetrode_list):
         filename = fname[:-4]
         spike_name = filename + '.' + str(tetrode)
         cut_name = filename + '_' + str(tetrode) + ".cut"
         clu_name = filename + ".clu." + str(tetrode)
         # print(filename+"\n" + spike_name+"\n" + cut_name+"\n" + clu_name+"\n")
-        if not os.path.isfile(spike_name):
+        if not exists(spike_name):
             continue
             # Don't consider files that have not been clustered
-        if not (os.path.isfile(cut_name) or os.path.isfile(clu_name)):
+        if not (exists(cut_name) or exists(clu_name)):
             print(
                 "Skipping tetrode {} - no cluster file named {} or {}".format(tetrode, cut_name, os.path.basename(clu_name)))
             continue
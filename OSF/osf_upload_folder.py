@@ -8,8 +8,40 @@ import shutil
 import os
 from argparse import ArgumentParser
 import csv
+import json
 
 from utils import get_all_files_in_dir
+from upload_queue import upload_all, CliTransport, LocalTransport
+from sync_manifest import (
+    build_manifest,
+    load_manifest,
+    manifest_from_names,
+    plan_sync,
+    record_uploads,
+)
+
+# Files written by the sync planner
+LOCAL_MANIFEST = "local_manifest.json"
+REMOTE_MANIFEST = "remote_manifest.json"
+SYNC_PLAN = "sync_plan.json"
+
+# Every file and folder this script writes, which are never uploaded
+OWN_FILES = (
+    "all_files.txt",
+    "extra.txt",
+    "output.txt",
+    # Written by earlier versions of --find
+    "uploaded_files.txt",
+    "upload_journal.txt",
+    "copied_osf_files",
+    LOCAL_MANIFEST,
+    LOCAL_MANIFEST + ".tmp",
+    LOCAL_MANIFEST + ".index",
+    LOCAL_MANIFEST + ".index.tmp",
+    REMOTE_MANIFEST,
+    REMOTE_MANIFEST + ".tmp",
+    SYNC_PLAN,
+)
 
 
 def run_osf(args):
@@ -127,39 +159,84 @@ def custom_function(info):
     #         send2trash(eeg_file)
 
 
-def get_files_to_upload(folder, ignore_list, recursive=True):
-    """Upload everything in folder to OSF."""
-    file_list = get_all_files_in_dir(folder, recursive=recursive)
-    remote_list = [fname[len(folder + os.sep) :] for fname in file_list]
-    current_remote = read_files(os.path.join(folder, "all_files.txt"))
-    print(f"Beginning upload process ignoring extensions {ignore_list} and temp files")
+def get_remote_manifest(folder):
+    """
+    The manifest of the files last uploaded from folder.
+
+    OSF only lists file names, so files uploaded before the manifest
+    existed are taken from all_files.txt with no hash.
+    """
+    remote = {}
+    names_loc = os.path.join(folder, "all_files.txt")
+    if os.path.isfile(names_loc):
+        remote = manifest_from_names(read_files(names_loc))
+    remote.update(load_manifest(os.path.join(folder, REMOTE_MANIFEST)))
+    return remote
+
+
+def plan_upload(folder, ignore_list, workers=8):
+    """
+    Plan the files in folder to add to or modify in OSF.
+
+    The local manifest is cached in folder, so only new or changed
+    files are hashed. The full plan, including files deleted locally,
+    is written to sync_plan.json.
+
+    Returns
+    -------
+    tuple of (list, list, dict)
+        The local files, their remote paths and the local manifest.
+
+    """
+    print(f"Planning upload ignoring extensions {ignore_list} and temp files")
+    local = build_manifest(
+        folder,
+        cache_loc=os.path.join(folder, LOCAL_MANIFEST),
+        workers=workers,
+        exclude=OWN_FILES,
+    )
+    plan = plan_sync(local, get_remote_manifest(folder))
 
     locals_, remotes_ = [], []
-    with open(os.path.join(folder, "uploaded_files.txt"), "w") as f:
-        for local, remote in zip(file_list, remote_list):
-            if remote not in current_remote:
-                tf = is_temp_file(local)
-                su = should_use_file(local, ignore_list)
-                if su and (not tf):
-                    s = f"Will upload {local} to {remote}"
-                    locals_.append(local)
-                    remotes_.append(remote)
-                else:
-                    s = f"Not uploading {local} - does not meet upload conditions"
-            else:
-                s = f"Skipped upload of {local} to {remote} - already in OSF"
-            f.write(s + "\n")
+    for remote in plan["add"] + plan["modify"]:
+        local_loc = os.path.join(folder, remote)
+        if should_use_file(local_loc, ignore_list) and not is_temp_file(local_loc):
+            locals_.append(local_loc)
+            remotes_.append(remote)
+    plan["upload"] = remotes_
+
+    with open(os.path.join(folder, SYNC_PLAN), "w") as f:
+        json.dump(plan, f, indent=2)
+    print(
+        f"{len(plan['add'])} new, {len(plan['modify'])} modified, "
+        f"{len(plan['delete'])} deleted and {len(plan['unchanged'])} unchanged "
+        f"files, {len(remotes_)} to upload"
+    )
+    return locals_, remotes_, local
 
-    return locals_, remotes_
 
+def upload_files(
+    locals_, remotes_, verbose=True, transport=None, workers=8, journal_loc=None
+):
+    """
+    Upload the files concurrently, see upload_queue.upload_all.
 
-def upload_files(locals_, remotes_, verbose=True):
+    The transport defaults to the osf command line, and uploads in
+    the journal at journal_loc are skipped.
+    """
     for local, remote in zip(locals_, remotes_):
         info = {"local": local, "remote": remote}
         custom_function(info)
-        if verbose:
-            print(f"Uploading {local} to {remote}")
-        upload_file(local, remote)
+    if transport is None:
+        transport = CliTransport()
+    return upload_all(
+        locals_,
+        remotes_,
+        transport,
+        workers=workers,
+        journal_loc=journal_loc,
+        verbose=verbose,
+    )
 
 
 def copy_files(locals_, out_dir, start_dir, verbose=True):
@@ -280,6 +357,18 @@ if __name__ == "__main__":
         action="store_true",
         help="Upload files to OSF stored in osf_dir/output.txt",
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=8,
+        help="The number of files to upload at once",
+    )
+    parser.add_argument(
+        "--mock_dir",
+        default=None,
+        help="Upload to this local directory instead of OSF, for testing",
+    )
     parser.add_argument(
         "--verify",
         "-v",
@@ -298,12 +387,36 @@ if __name__ == "__main__":
         generate_list_of_files(location)
 
     if parsed.find:
-        locals_, remotes_ = get_files_to_upload(location, ignore_list)
+        locals_, remotes_, _ = plan_upload(location, ignore_list, parsed.workers)
         write_locations(location, locals_, remotes_)
 
     if parsed.upload:
         locals_, remotes_ = read_local_remotes(os.path.join(location, "output.txt"))
-        upload_files(locals_, remotes_)
+        # Modified files replace the old version in OSF
+        transport = CliTransport(force=True)
+        journal_loc = os.path.join(location, "upload_journal.txt")
+        if parsed.mock_dir is not None:
+            # A dry run keeps its own journal, so OSF uploads are not skipped
+            transport = LocalTransport(parsed.mock_dir)
+            journal_loc = os.path.join(parsed.mock_dir, "upload_journal.txt")
+        summary = upload_files(
+            locals_,
+            remotes_,
+            transport=transport,
+            workers=parsed.workers,
+            journal_loc=journal_loc,
+        )
+        # Only uploads to OSF are what is in OSF
+        if parsed.mock_dir is None:
+            local_manifest = load_manifest(os.path.join(location, LOCAL_MANIFEST))
+            uploaded = [
+                remote
+                for local, remote in zip(locals_, remotes_)
+                if local not in summary["errors"] and remote in local_manifest
+            ]
+            record_uploads(
+                os.path.join(location, REMOTE_MANIFEST), local_manifest, uploaded
+            )
 
     if parsed.copy:
         out_dir = os.path.join(location, "copied_osf_files")
@@ -0,0 +1,155 @@
+"""
+Plan which files to add, modify and delete to sync a folder to OSF.
+
+A manifest maps the path of each file relative to the folder to its
+size, modification time and content hash. Hashes are streamed in
+parallel threads and cached, so only new or changed files are read
+again. The local manifest is compared to the manifest of what was last
+uploaded with set and dict operations.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import FileIndex
+
+
+def hash_file(location, block_size=8388608):
+    """Stream the contents of a file through blake2b."""
+    digest = hashlib.blake2b()
+    with open(location, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(location):
+    """Load a manifest saved by save_manifest, empty if there is none."""
+    if location is None or not os.path.isfile(location):
+        return {}
+    with open(location, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, location):
+    """Save a manifest, replacing the old one only once fully written."""
+    temp_loc = location + ".tmp"
+    with open(temp_loc, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temp_loc, location)
+
+
+def build_manifest(folder, cache_loc=None, workers=8, exclude=(), verbose=True):
+    """
+    Build the manifest of every file in folder.
+
+    Parameters
+    ----------
+    folder : str
+        The folder to describe.
+    cache_loc : str, optional. Defaults to None.
+        The json file caching the manifest. A file's hash is reused
+        while its size and modification time are unchanged, and the
+        directory listing is cached next to it, see FileIndex.
+    workers : int, optional. Defaults to 8.
+        The threads hashing files.
+    exclude : iterable of str, optional. Defaults to ().
+        Relative paths of files or folders to leave out of the manifest.
+    verbose : bool, optional. Defaults to True.
+        Whether to print how many files were hashed.
+
+    Returns
+    -------
+    dict
+        Relative path to {"size", "mtime", "hash"}.
+
+    """
+    index_loc = None if cache_loc is None else cache_loc + ".index"
+    index = FileIndex(folder, recursive=True, workers=workers, cache_loc=index_loc)
+    cached = load_manifest(cache_loc)
+
+    # The caches themselves may be in the folder
+    own_files = set(exclude) | {
+        os.path.relpath(os.path.abspath(loc), index.root) + suffix
+        for loc in (cache_loc,)
+        if loc is not None
+        for suffix in ("", ".tmp", ".index", ".index.tmp")
+    }
+    excluded_dirs = tuple(os.path.join(rel_path, "") for rel_path in exclude)
+    manifest, to_hash = {}, []
+    for rel_path in index.files:
+        if rel_path in own_files or rel_path.startswith(excluded_dirs):
+            continue
+        stat = os.stat(os.path.join(folder, rel_path))
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": None}
+        old = cached.get(rel_path)
+        if old is not None and (old["size"], old["mtime"]) == (
+            entry["size"],
+            entry["mtime"],
+        ):
+            entry["hash"] = old["hash"]
+        else:
+            to_hash.append(rel_path)
+        manifest[rel_path] = entry
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = pool.map(
+            hash_file, [os.path.join(folder, rel_path) for rel_path in to_hash]
+        )
+        for rel_path, digest in zip(to_hash, hashes):
+            manifest[rel_path]["hash"] = digest
+
+    if cache_loc is not None:
+        save_manifest(manifest, cache_loc)
+    if verbose:
+        print(
+            f"Manifest of {len(manifest)} files in {folder}, "
+            f"hashed {len(to_hash)} new or changed files"
+        )
+    return manifest
+
+
+def manifest_from_names(names):
+    """A remote manifest of names only, such as from osf ls."""
+    return {name: {"size": None, "mtime": None, "hash": None} for name in names}
+
+
+def plan_sync(local, remote):
+    """
+    Compare a local manifest to a remote manifest.
+
+    A file in both is modified if the hashes differ. Remote files
+    with no known hash, such as those only listed by name, are taken
+    as unchanged.
+
+    Returns
+    -------
+    dict
+        Sorted lists of relative paths under "add", "modify",
+        "delete" and "unchanged".
+
+    """
+    local_keys, remote_keys = set(local), set(remote)
+    both = local_keys & remote_keys
+    modify = {
+        k
+        for k in both
+        if remote[k]["hash"] is not None and remote[k]["hash"] != local[k]["hash"]
+    }
+    return {
+        "add": sorted(local_keys - remote_keys),
+        "modify": sorted(modify),
+        "delete": sorted(remote_keys - local_keys),
+        "unchanged": sorted(both - modify),
+    }
+
+
+def record_uploads(remote_loc, local, uploaded):
+    """Update the remote manifest at remote_loc with uploaded files."""
+    remote = load_manifest(remote_loc)
+    for rel_path in uploaded:
+        remote[rel_path] = local[rel_path]
+    save_manifest(remote, remote_loc)
+    return remote
@@ -0,0 +1,263 @@
+"""
+Concurrent uploads with retries and a journal to resume from.
+
+The transport that moves each file is pluggable:
+CliTransport runs the osf command line as before,
+OsfClientTransport keeps an osfclient session per thread open,
+and LocalTransport and MemoryTransport stand in for OSF when testing.
+"""
+
+import os
+import random
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class CliTransport:
+    """
+    Upload by running osf upload, one process per file.
+
+    With force, which is the default, an existing file is replaced, so
+    retrying an upload that reached OSF before failing succeeds.
+    """
+
+    def __init__(self, force=True):
+        self.force = force
+
+    def upload(self, local, remote):
+        args = ["osf", "upload"]
+        if self.force:
+            args.append("--force")
+        result = subprocess.run(
+            [*args, local, remote], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        if result.returncode != 0:
+            raise RuntimeError(
+                f"osf upload failed with {result.stderr.decode('utf-8').strip()}"
+            )
+
+
+class OsfClientTransport:
+    """
+    Upload in process with osfclient, reusing one session per thread.
+
+    The password is read from the OSF_PASSWORD environment variable
+    if it is not given, as the osf command line does.
+    """
+
+    def __init__(self, project, username=None, password=None, token=None, force=True):
+        self.project = project
+        self.username = username
+        self.password = password or os.environ.get("OSF_PASSWORD")
+        self.token = token
+        self.force = force
+        self._local = threading.local()
+
+    def _get_storage(self):
+        if not hasattr(self._local, "storage"):
+            from osfclient import OSF
+
+            osf = OSF(username=self.username, password=self.password, token=self.token)
+            self._local.storage = osf.project(self.project).storage("osfstorage")
+        return self._local.storage
+
+    def upload(self, local, remote):
+        storage = self._get_storage()
+        with open(local, "rb") as f:
+            storage.create_file(remote.replace("\\", "/"), f, force=self.force)
+
+
+class LocalTransport:
+    """Upload by copying to a local directory, for dry runs and tests."""
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+
+    def upload(self, local, remote):
+        out_loc = os.path.join(self.out_dir, *remote.replace("\\", "/").split("/"))
+        os.makedirs(os.path.dirname(out_loc), exist_ok=True)
+        shutil.copy2(local, out_loc)
+
+
+class MemoryTransport:
+    """
+    Keep uploads in a dict, failing the first failures tries per file.
+
+    Used to test the retries without touching the disk or network.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.files = {}
+        self.attempts = {}
+        self._lock = threading.Lock()
+
+    def upload(self, local, remote):
+        with self._lock:
+            self.attempts[remote] = self.attempts.get(remote, 0) + 1
+            if self.attempts[remote] <= self.failures:
+                raise ConnectionError(f"Simulated failure uploading {remote}")
+        with open(local, "rb") as f:
+            data = f.read()
+        with self._lock:
+            self.files[remote] = data
+
+
+class UploadJournal:
+    """
+    A file recording each completed upload, so a run can resume.
+
+    Each line is remote, size and modification time separated by tabs.
+    A file is only treated as done if it has not changed since.
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.done = {}
+        self._lock = threading.Lock()
+        if location is not None and os.path.isfile(location):
+            with open(location, "r") as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) == 3:
+                        self.done[parts[0]] = (int(parts[1]), int(parts[2]))
+
+    @staticmethod
+    def _get_key(local):
+        stat = os.stat(local)
+        return stat.st_size, stat.st_mtime_ns
+
+    def is_done(self, local, remote):
+        return self.done.get(remote) == self._get_key(local)
+
+    def mark_done(self, local, remote):
+        key = self._get_key(local)
+        with self._lock:
+            self.done[remote] = key
+            if self.location is not None:
+                with open(self.location, "a") as f:
+                    f.write(f"{remote}\t{key[0]}\t{key[1]}\n")
+
+
+def upload_with_retries(transport, local, remote, retries=5, backoff=1.0):
+    """
+    Upload one file, retrying with exponential backoff.
+
+    Waits backoff * 2 ** attempt seconds plus some jitter between tries,
+    and raises the last error if every try fails.
+    """
+    for attempt in range(retries + 1):
+        try:
+            transport.upload(local, remote)
+            return attempt + 1
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt + random.uniform(0, backoff))
+
+
+def upload_all(
+    locals_,
+    remotes_,
+    transport,
+    workers=8,
+    retries=5,
+    backoff=1.0,
+    journal_loc=None,
+    verbose=True,
+):
+    """
+    Upload every local file to its remote path concurrently.
+
+    Parameters
+    ----------
+    locals_ : list of str
+        The files to upload.
+    remotes_ : list of str
+        The path in the project of each file.
+    transport : object
+        Has an upload(local, remote) method that raises on failure,
+        such as CliTransport or LocalTransport.
+    workers : int, optional. Defaults to 8.
+        The uploads in flight at once.
+    retries : int, optional. Defaults to 5.
+        The retries of each file before it is counted as failed.
+    backoff : float, optional. Defaults to 1.0.
+        The seconds before the first retry, doubled for each retry.
+    journal_loc : str, optional. Defaults to None.
+        A journal of finished uploads, which are skipped next time.
+    verbose : bool, optional. Defaults to True.
+        Whether to print the progress of each file.
+
+    Returns
+    -------
+    dict
+        The uploaded, skipped and failed counts, the failed files
+        with their errors, the bytes uploaded and the seconds taken.
+
+    """
+    journal = UploadJournal(journal_loc)
+    summary = {"uploaded": 0, "skipped": 0, "failed": 0, "errors": {}, "bytes": 0}
+    pending = []
+    for local, remote in zip(locals_, remotes_):
+        # A file moved or deleted since it was found fails on its own
+        try:
+            done = journal.is_done(local, remote)
+        except OSError as e:
+            summary["failed"] += 1
+            summary["errors"][local] = repr(e)
+            if verbose:
+                print(f"Failed {local}: {e!r}")
+            continue
+        if done:
+            summary["skipped"] += 1
+        else:
+            pending.append((local, remote))
+    if verbose:
+        print(
+            f"Uploading {len(pending)} files with {workers} workers, "
+            f"{summary['skipped']} already uploaded"
+        )
+
+    def upload_one(local, remote):
+        start_time = time.time()
+        tries = upload_with_retries(transport, local, remote, retries, backoff)
+        journal.mark_done(local, remote)
+        return tries, time.time() - start_time
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(upload_one, local, remote): (local, remote)
+            for local, remote in pending
+        }
+        for i, future in enumerate(as_completed(futures)):
+            local, remote = futures[future]
+            try:
+                tries, seconds = future.result()
+            except Exception as e:
+                summary["failed"] += 1
+                summary["errors"][local] = repr(e)
+                if verbose:
+                    print(f"[{i + 1}/{len(pending)}] Failed {local}: {e!r}")
+                continue
+            size = os.path.getsize(local)
+            summary["uploaded"] += 1
+            summary["bytes"] += size
+            if verbose:
+                print(
+                    f"[{i + 1}/{len(pending)}] Uploaded {local} to {remote} "
+                    f"({size / 1e6:.2f} MB in {seconds:.1f}s, {tries} tries)"
+                )
+
+    summary["seconds"] = time.time() - start_time
+    if verbose:
+        print(
+            f"Uploaded {summary['uploaded']} files "
+            f"({summary['bytes'] / 1e6:.1f} MB) in {summary['seconds']:.1f}s, "
+            f"skipped {summary['skipped']}, failed {summary['failed']}"
+        )
+    return summary